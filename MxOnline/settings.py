@@ -171,6 +171,50 @@ CHANNEL_LAYERS = {
     },
 }
 
+# 用户收藏集合redis缓存，详情页判断是否收藏时不查询数据库
+USER_FAV_CACHE = env.bool('USER_FAV_CACHE', default=True)
+
+# 后台任务: lib.tasks.SyncBackend(同步执行，测试使用), ThreadPoolBackend(进程内线程池),
+# RedisQueueBackend(redis队列，由manage.py run_tasks启动worker消费)；
+# ROUTES为耗时任务单独指定后端：xadmin后台导出可能运行数分钟，在uwsgi进程内执行时worker回收会中断导出，
+# 默认进入redis队列，需启动run_tasks worker
+BACKGROUND_TASKS = {
+    'BACKEND': env('BACKGROUND_TASKS_BACKEND', default='lib.tasks.ThreadPoolBackend'),
+    'OPTIONS': {
+        'max_workers': env.int('BACKGROUND_TASKS_MAX_WORKERS', default=4),
+    },
+    'ROUTES': {
+        'xadmin.plugins.exportjob.run_export_job': env('EXPORT_TASKS_BACKEND', default='lib.tasks.RedisQueueBackend'),
+    },
+}
+# xadmin后台导出文件目录，不能位于MEDIA_ROOT下(/media/不校验权限)，超过XADMIN_EXPORT_JOB_TIMEOUT后删除
+XADMIN_EXPORT_ROOT = env('XADMIN_EXPORT_ROOT', default=os.path.join(BASE_DIR, 'exports'))
+# 通知批量创建时每个后台任务处理的接收者数
+NOTIFICATION_FANOUT_CHUNK_SIZE = env.int('NOTIFICATION_FANOUT_CHUNK_SIZE', default=1000)
+# 通知推送时每批并发group_send的在线用户数
+NOTIFICATION_DELIVERY_BATCH_SIZE = env.int('NOTIFICATION_DELIVERY_BATCH_SIZE', default=100)
+# websocket连接的在线状态过期时间(秒)，连接每隔三分之一过期时间续期一次
+NOTIFICATION_ONLINE_TTL = env.int('NOTIFICATION_ONLINE_TTL', default=90)
+
+# 课程资源、章节、视频、评论单一资源查询的布隆过滤器，按单个模型的预估记录数和误判率计算位数
+BLOOM_FILTER = {
+    'CAPACITY': env.int('BLOOM_FILTER_CAPACITY', default=1000000),
+    'ERROR_RATE': 0.0001,
+    # redis或local，local使用PATH目录下的快照文件，由rebuild_bloom_filters生成
+    'BACKEND': env('BLOOM_FILTER_BACKEND', default='redis'),
+    'PATH': env('BLOOM_FILTER_PATH', default=os.path.join(BASE_DIR, 'data', 'bloom')),
+}
+
+# 课程、机构、讲师全文检索，可选lib.search.MySQLFulltextBackend
+SEARCH_ENGINE = {
+    'BACKEND': env('SEARCH_BACKEND', default='lib.search.RedisSearchBackend'),
+    'OPTIONS': {
+        # 热度(学习人数、收藏数等)在排序中的权重
+        'popularity_weight': 0.1,
+        'max_results': 1000,
+    }
+}
+
 REST_FRAMEWORK_EXTENSIONS = {
     'DEFAULT_CACHE_RESPONSE_TIMEOUT': 5
 }
@@ -213,7 +257,11 @@ SESSION_REDIS = {
     'prefix': env('SESSION_PREFIX', default='session'),
     'socket_timeout': env('SESSION_SOCKET_TIMEOUT', default=1),
     # 修改redis-seesion源码添加自定义过期时间
-    'expiry': env('SESSION_EXPIRY', default=60 * 60 * 24)
+    'expiry': env('SESSION_EXPIRY', default=60 * 60 * 24),
+    # msgpack编码session，不设置时使用django默认的签名base64编码
+    'serializer': env('SESSION_SERIALIZER', default=None),
+    # 读取session时延长过期时间
+    'sliding_expiry': env.bool('SESSION_SLIDING_EXPIRY', default=False),
 }
 
 REST_FRAMEWORK = {
@@ -223,14 +271,14 @@ REST_FRAMEWORK = {
     'EXCEPTION_HANDLER': 'lib.exceptions.custom_exception_handler',
     # drf全局认证，优先级从上往下
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
+        'users.authentication.CachedJSONWebTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
         'rest_framework.authentication.BasicAuthentication',
     ),
     # drf全局过滤器
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
-        'rest_framework.filters.SearchFilter',
+        'lib.search.FullTextSearchFilter',
         'rest_framework.filters.OrderingFilter',
     ),
     # throttling限速机制
@@ -247,6 +295,15 @@ REST_FRAMEWORK = {
 JWT_AUTH = {
     'JWT_EXPIRATION_DELTA': datetime.timedelta(days=7),
     'JWT_AUTH_HEADER_PREFIX': 'JWT',
+    # payload加入由密码派生的令牌版本ver
+    'JWT_PAYLOAD_HANDLER': 'users.authentication.jwt_payload_handler',
+}
+
+# JWT认证的用户快照，redis中保存TIMEOUT秒，进程内LRU保存LOCAL_TIMEOUT秒
+JWT_USER_CACHE = {
+    'TIMEOUT': env.int('JWT_USER_CACHE_TIMEOUT', default=60 * 60),
+    'LOCAL_TIMEOUT': env.int('JWT_USER_CACHE_LOCAL_TIMEOUT', default=10),
+    'LOCAL_SIZE': env.int('JWT_USER_CACHE_LOCAL_SIZE', default=1000),
 }
 
 # social django settings
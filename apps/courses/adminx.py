@@ -2,8 +2,8 @@
 __author__ = 'wuhai'
 import xadmin
 
+from .importers import CourseImporter, LessonImporter, VideoImporter
 from .models import Course, Lesson, Video, CourseResource, BannerCourse
-from organization.models import CourseOrg
 
 
 class LessonInline(object):
@@ -17,44 +17,29 @@ class CourseResourceInline(object):
 
 
 class CourseAdmin(object):
-    list_display = ['name', 'desc', 'detail', 'degree', 'learn_times', 'students', 'get_zj_nums', 'go_to']
+    list_display = ['name', 'desc', 'detail', 'degree', 'learn_times', 'students', 'get_zj_nums', 'video_count', 'go_to']
     search_fields = ['name', 'desc', 'detail', 'degree', 'students']
     list_filter = ['name', 'desc', 'detail', 'degree', 'learn_times', 'students']
     ordering = ['-click_nums']
-    readonly_fields = ['click_nums']
+    readonly_fields = ['click_nums', 'learn_times', 'lesson_count', 'video_count']
     list_editable = ['degree', 'desc']
     exclude = ['fav_nums']
     inlines = [LessonInline, CourseResourceInline]
     style_fields = {"detail": "ueditor"}
-    import_excel = True
+    import_excel = CourseImporter
 
     def queryset(self):
         qs = super(CourseAdmin, self).queryset()
         qs = qs.filter(is_banner=False)
         return qs
 
-    def save_models(self):
-        # 在保存课程的时候统计课程机构的课程数
-        obj = self.new_obj
-        obj.save()
-        if obj.org is not None:
-            course_org = obj.org
-            course_org.course_nums = Course.objects.filter(course_org=course_org).count()
-            course_org.save()
-
-    def post(self, request, *args, **kwargs):
-        if 'excel' in request.FILES:
-            pass
-        # return super(CourseAdmin, self).post(request, args, kwargs)
-        return super(CourseAdmin, self).post(request, kwargs)
-
 
 class BannerCourseAdmin(object):
     list_display = ['name', 'desc', 'detail', 'degree', 'learn_times', 'students']
     search_fields = ['name', 'desc', 'detail', 'degree', 'students']
     list_filter = ['name', 'desc', 'detail', 'degree', 'learn_times', 'students']
     ordering = ['-click_nums']
-    readonly_fields = ['click_nums']
+    readonly_fields = ['click_nums', 'learn_times', 'lesson_count', 'video_count']
     exclude = ['fav_nums']
     inlines = [LessonInline, CourseResourceInline]
 
@@ -68,6 +53,7 @@ class LessonAdmin(object):
     list_display = ['course', 'name', 'created_time']
     search_fields = ['course', 'name']
     list_filter = ['course__name', 'name', 'created_time']
+    import_excel = LessonImporter
 
 
 class VideoAdmin(object):
@@ -75,6 +61,7 @@ class VideoAdmin(object):
     search_fields = ['lesson', 'name']
     list_filter = ['lesson', 'name', 'created_time']
     model_icon = 'fa fa-film'
+    import_excel = VideoImporter
 
 
 class CourseResourceAdmin(object):
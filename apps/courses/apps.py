@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class CoursesConfig(AppConfig):
     name = 'courses'
     verbose_name = u"课程管理"
+
+    def ready(self):
+        from . import signals, search_indexes, rollups
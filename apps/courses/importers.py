@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db import transaction
+
+from .keys import LESSON_CACHE_KEY, VIDEO_CACHE_KEY
+from .models import Course, Lesson, Video
+from lib.importer import ModelImporter
+from lib.redisextend import invalidate_cache
+from lib.tasks import submit_task
+from operation.homepage import schedule_refresh
+
+
+class CourseImporter(ModelImporter):
+    """按课程名新增或更新课程，机构、讲师按名称匹配，未填写用户时为上传用户"""
+    model = Course
+    fields = ('name', 'desc', 'detail', 'degree', 'category', 'tag', 'youneed_know', 'is_banner',
+              'org', 'teacher', 'user')
+    key_fields = ('name',)
+    foreign_keys = {'org': 'name', 'teacher': 'name', 'user': 'username'}
+
+    def get_defaults(self):
+        return {'user': self.user} if self.user is not None else {}
+
+    def after_write(self, created, updated):
+        super(CourseImporter, self).after_write(created, updated)
+        course_ids = [obj.pk for obj in created if obj.pk is not None] + [obj.pk for obj, old in updated]
+        # 一个任务重建本批课程的相关课程，首页只刷新一次
+        submit_task('courses.related.rebuild_related_many', course_ids)
+        schedule_refresh()
+
+
+class LessonImporter(ModelImporter):
+    """按课程下的章节名新增或更新章节"""
+    model = Lesson
+    fields = ('course', 'name')
+    key_fields = ('course', 'name')
+    foreign_keys = {'course': 'name'}
+
+    def after_write(self, created, updated):
+        super(LessonImporter, self).after_write(created, updated)
+        # 新增对象的id此前可能被查询过，同样删除空值缓存
+        keys = {(obj.course_id, obj.pk) for obj in created if obj.pk is not None}
+        keys.update((obj.course_id, obj.pk) for obj, old in updated)
+        keys.update((old['course_id'], obj.pk) for obj, old in updated)
+
+        def invalidate():
+            for course_id, pk in keys:
+                invalidate_cache(LESSON_CACHE_KEY, course_id=course_id, id=pk)
+        transaction.on_commit(invalidate)
+
+
+class VideoImporter(ModelImporter):
+    """按章节下的视频名新增或更新视频，章节按所选课程下的章节名匹配"""
+    model = Video
+    fields = ('course', 'lesson', 'name', 'learn_times', 'url')
+    key_fields = ('lesson', 'name')
+    foreign_keys = {'course': 'name', 'lesson': ('name', 'course')}
+
+    def after_write(self, created, updated):
+        super(VideoImporter, self).after_write(created, updated)
+        keys = {(obj.course_id, obj.lesson_id, obj.pk) for obj in created if obj.pk is not None}
+        for obj, old in updated:
+            keys.add((obj.course_id, obj.lesson_id, obj.pk))
+            keys.add((old['course_id'], old['lesson_id'], obj.pk))
+
+        def invalidate():
+            for course_id, lesson_id, pk in keys:
+                invalidate_cache(LESSON_CACHE_KEY, course_id=course_id, id=lesson_id)
+                if pk is not None:
+                    invalidate_cache(VIDEO_CACHE_KEY, course_id=course_id, lesson_id=lesson_id, id=pk)
+        transaction.on_commit(invalidate)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+# 单一资源缓存key格式，视图get_cache_key与模型变更信号共用，信号模块无需导入视图
+
+RESOURCE_CACHE_KEY = 'course_resource:{id}'
+LESSON_CACHE_KEY = 'courses:{course_id}:lessons:{id}'
+VIDEO_CACHE_KEY = 'courses:{course_id}:lessons:{lesson_id}:videos:{id}'
+COMMENT_CACHE_KEY = 'courses:{course_id}:comments:{id}'
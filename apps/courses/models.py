@@ -1,16 +1,31 @@
 # _*_ encoding:utf-8 _*_
 from datetime import datetime
 
-from django.db import models
+from collections import defaultdict
+from itertools import chain
+
+from django.db import connections, models, router
+from django.db.models import Prefetch
 from django.contrib.auth import get_user_model
-from django.core.serializers import serialize
 
 from DjangoUeditor.models import UEditorField
 from organization.models import CourseOrg, Teacher
+from lib.counters import click_counter
+from lib.utils import modify_counter
 
 User = get_user_model()
 
 
+class CourseQuerySet(models.query.QuerySet):
+
+    def with_details(self):
+        # 批量预取章节、视频，列表序列化时查询数量固定，与分页大小无关；
+        # 学习用户每门课程只取前10个，由CourseListSerializer按页调用Course.prefetch_learn_users
+        return self.prefetch_related(
+            Prefetch('lesson_set', queryset=Lesson.objects.prefetch_related('video_set')),
+        )
+
+
 class Course(models.Model):
     DEGREE_CHOICES = (
         ("cj", "初级"),
@@ -34,15 +49,19 @@ class Course(models.Model):
     is_banner = models.BooleanField(default=False, verbose_name="是否轮播")
     teacher = models.ForeignKey(Teacher, on_delete=models.CASCADE, null=True, blank=True, verbose_name="讲师")
     degree = models.CharField(verbose_name="难度", choices=DEGREE_CHOICES, max_length=2)
+    # 由courses.rollups根据视频统计
     learn_times = models.IntegerField(default=0, verbose_name="学习时长(分钟数)")
+    lesson_count = models.IntegerField(default=0, verbose_name="章节数")
+    video_count = models.IntegerField(default=0, verbose_name="视频数")
     students = models.IntegerField(db_index=True, default=0, verbose_name='学习人数')
     fav_nums = models.IntegerField(db_index=True, default=0, verbose_name='收藏人数')
     image = models.ImageField(blank=True, null=True, upload_to="courses/%Y/%m", verbose_name="封面图", max_length=100)
     click_nums = models.IntegerField(default=0, verbose_name="点击数")
-    tag = models.CharField(default="", verbose_name="课程标签", max_length=10)
+    tag = models.CharField(db_index=True, default="", verbose_name="课程标签", max_length=10)
     youneed_know = models.CharField(default="", max_length=300, verbose_name="课程须知")
     created_time = models.DateTimeField(db_index=True, auto_now_add=True, verbose_name="创建时间")
     updated_time = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+    objects = CourseQuerySet.as_manager()
 
     class Meta:
         db_table = 'course'
@@ -55,10 +74,45 @@ class Course(models.Model):
 
     def get_zj_nums(self):
         # 获取课程章节数
-        return self.lesson_set.all().count()
+        return self.lesson_count
+    get_zj_nums.short_description = "章节数"
+
+    LEARN_USERS_LIMIT = 10
 
     def get_learn_users(self):
-        return [obj.user.username for obj in self.usercourse_set.all()][:10]
+        # 已通过prefetch_learn_users按页读取时直接返回，否则只查询最近10条
+        if hasattr(self, '_learn_users'):
+            return self._learn_users
+        return list(self.learn_users_queryset(self.pk))
+
+    @classmethod
+    def learn_users_queryset(cls, course_id):
+        from operation.models import UserCourse
+        return UserCourse.objects.filter(course_id=course_id).order_by('-created_time') \
+            .values_list('user__username', flat=True)[:cls.LEARN_USERS_LIMIT]
+
+    @classmethod
+    def prefetch_learn_users(cls, courses):
+        """
+        一页课程的最近学习用户，每门课程只读取前10条，不随学习人数增长；
+        数据库支持时用一条UNION ALL查询，否则逐门课程查询
+        """
+        from operation.models import UserCourse
+        courses = [course for course in courses if not hasattr(course, '_learn_users')]
+        if not courses:
+            return
+        querysets = [UserCourse.objects.filter(course_id=course.pk).order_by('-created_time')
+                     .values_list('course_id', 'user__username')[:cls.LEARN_USERS_LIMIT] for course in courses]
+        features = connections[router.db_for_read(UserCourse)].features
+        if len(querysets) > 1 and features.supports_slicing_ordering_in_compound:
+            rows = querysets[0].union(*querysets[1:], all=True)
+        else:
+            rows = chain.from_iterable(querysets)
+        learn_users = defaultdict(list)
+        for course_id, username in rows:
+            learn_users[course_id].append(username)
+        for course in courses:
+            course._learn_users = learn_users[course.pk]
 
     def get_lessons(self):
         # 获取课程所有章节
@@ -66,19 +120,12 @@ class Course(models.Model):
                 for obj in self.lesson_set.all()]
 
     def add_click_nums(self):
-        self.click_nums += 1
-        self.save()
+        # 点击数先缓冲在redis中，由flush_click_nums定时回写
+        self.click_nums = click_counter.incr(self)
         return self.click_nums
 
     def modify_fav_nums(self, incr=True):
-        if incr:
-            self.fav_nums += 1
-        else:
-            self.fav_nums -= 1
-            if self.fav_nums < 0:
-                self.fav_nums = 0
-        self.save()
-        return self.fav_nums
+        return modify_counter(self, 'fav_nums', incr=incr)
 
 
 class BannerCourse(Course):
@@ -106,10 +153,9 @@ class Lesson(models.Model):
         return self.name
 
     def get_videos(self):
-        # 章节视频
-        return serialize('json', self.video_set.all())
-        # return [{'name': obj.name, 'learn_times': obj.learn_times, 'url': obj.url, 'created_time': obj.created_time}
-        #         for obj in self.video_set.all()]
+        # 章节视频，返回原生结构，video_set已预取时不再查询数据库
+        return [{'id': obj.id, 'name': obj.name, 'learn_times': obj.learn_times, 'url': obj.url,
+                 'created_time': obj.created_time} for obj in self.video_set.all()]
 
 
 class VideoQuerySet(models.query.QuerySet):
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from collections import defaultdict
+
+from django.db.models import Count, Q
+from django_redis import get_redis_connection
+
+from .models import Course
+from lib.keyconstructors import bump_object_tags
+from lib.tasks import submit_task
+
+
+class RelatedCourseIndex:
+    """
+    相关课程索引：每个课程一个redis有序集合course_rel:<id>，成员为相关课程id，分数为相关度，只保留前size个。
+    相关度由相同标签、机构、讲师、类别及共同学习用户数加权得到，关系对称，
+    重建某个课程时同时写入对方的集合；用户学习课程时按共同学习关系增量调整分数
+    """
+    weights = {'tag': 5, 'org': 3, 'teacher': 3, 'category': 1, 'learner': 1}
+    # 占位成员，区分已构建但没有相关课程与未构建
+    placeholder = '0'
+    # 增量调整只作用于已构建的集合，未构建的集合读取时完整构建；ARGV: 操作(zadd/zincrby)、分数、成员、保留个数
+    update_script = """
+    if redis.call('exists', KEYS[1]) == 1 then
+        redis.call(ARGV[1], KEYS[1], ARGV[2], ARGV[3])
+        if tonumber(redis.call('zscore', KEYS[1], ARGV[3])) <= 0 then
+            redis.call('zrem', KEYS[1], ARGV[3])
+        end
+        redis.call('zremrangebyrank', KEYS[1], 0, -tonumber(ARGV[4]) - 2)
+    end
+    """
+
+    def __init__(self, alias='learn', prefix='course_rel', size=50, candidate_limit=200, build_timeout=60):
+        """
+        :param build_timeout: 后台构建标记的过期时间，构建任务失败时过期后重新提交
+        """
+        self.alias = alias
+        self.prefix = prefix
+        self.size = size
+        self.candidate_limit = candidate_limit
+        self.build_timeout = build_timeout
+
+    @property
+    def conn(self):
+        return get_redis_connection(self.alias)
+
+    def get_key(self, course_id):
+        return '%s:%s' % (self.prefix, course_id)
+
+    def compute(self, course):
+        """从数据库计算与course的相关度，{课程id: 分数}"""
+        from operation.models import UserCourse
+
+        scores = defaultdict(float)
+        others = Course.objects.exclude(pk=course.pk).order_by('-students')
+        for field, value in (('tag', course.tag), ('org', course.org_id), ('teacher', course.teacher_id)):
+            if value:
+                for pk in others.filter(**{field: value}).values_list('pk', flat=True)[:self.candidate_limit]:
+                    scores[pk] += self.weights[field]
+
+        learners = UserCourse.objects.filter(course=course.pk).values('user')
+        co_learned = UserCourse.objects.filter(user__in=learners).exclude(course=course.pk).values('course') \
+            .annotate(nums=Count('user', distinct=True)).order_by('-nums').values_list('course', 'nums')
+        for pk, nums in co_learned[:self.candidate_limit]:
+            scores[pk] += self.weights['learner'] * nums
+
+        # 类别区分度低，只作为已有候选的加分项
+        if scores:
+            for pk in Course.objects.filter(pk__in=list(scores), category=course.category).values_list('pk', flat=True):
+                scores[pk] += self.weights['category']
+        return scores
+
+    def rebuild(self, course):
+        """
+        重建course的相关课程集合，并同步更新对方集合中course的分数；
+        事务提交后递增涉及课程的对象标签，相关课程接口的cache_response缓存随之失效
+        """
+        key = self.get_key(course.pk)
+        old = set(self.conn.zrange(key, 0, -1)) - {self.placeholder}
+        scores = self.compute(course)
+
+        pipe = self.conn.pipeline()
+        pipe.delete(key)
+        pipe.zadd(key, {self.placeholder: 0})
+        if scores:
+            pipe.zadd(key, {str(pk): score for pk, score in scores.items()})
+            pipe.zremrangebyrank(key, 0, -self.size - 2)
+        for pk, score in scores.items():
+            pipe.eval(self.update_script, 1, self.get_key(pk), 'zadd', score, course.pk, self.size)
+        removed = old - {str(pk) for pk in scores}
+        for pk in removed:
+            pipe.zrem(self.get_key(pk), str(course.pk))
+        pipe.delete(self.get_building_key(course.pk))
+        pipe.execute()
+        bump_object_tags(Course, [course.pk] + list(scores) + [int(pk) for pk in removed])
+
+    def remove(self, course_id):
+        key = self.get_key(course_id)
+        pipe = self.conn.pipeline()
+        for pk in set(self.conn.zrange(key, 0, -1)) - {self.placeholder}:
+            pipe.zrem(self.get_key(pk), str(course_id))
+        pipe.delete(key)
+        pipe.execute()
+
+    def learner_changed(self, course_id, other_course_ids, amount=1):
+        """用户学习(或取消学习)course_id时，与该用户学习的其他课程的共同学习分数增减"""
+        pipe = self.conn.pipeline()
+        score = self.weights['learner'] * amount
+        for pk in other_course_ids:
+            pipe.eval(self.update_script, 1, self.get_key(course_id), 'zincrby', score, pk, self.size)
+            pipe.eval(self.update_script, 1, self.get_key(pk), 'zincrby', score, course_id, self.size)
+        pipe.execute()
+
+    def get_building_key(self, course_id):
+        return '%s:%s:building' % (self.prefix, course_id)
+
+    def get_ids(self, course):
+        """
+        相关课程id，按相关度倒序；未构建时提交后台构建(同一课程同时只提交一次)，
+        本次返回同标签、同机构的热门课程，构建完成后递增课程标签使缓存的结果失效
+        """
+        ids = self.conn.zrevrange(self.get_key(course.pk), 0, self.size - 1)
+        if ids:
+            return [int(pk) for pk in ids if pk != self.placeholder]
+        if self.conn.set(self.get_building_key(course.pk), 1, nx=True, ex=self.build_timeout):
+            submit_task('courses.related.rebuild_related', course.pk)
+        return self.get_fallback_ids(course)
+
+    def get_fallback_ids(self, course):
+        condition = Q(org=course.org_id) if course.org_id else Q()
+        if course.tag:
+            condition |= Q(tag=course.tag)
+        if not condition:
+            return []
+        return list(Course.objects.filter(condition).exclude(pk=course.pk).order_by('-students')
+                    .values_list('pk', flat=True)[:self.size])
+
+
+related_courses = RelatedCourseIndex()
+
+
+def rebuild_related(course_id):
+    """后台任务，课程保存后重建相关课程"""
+    course = Course.objects.filter(pk=course_id).first()
+    if course is not None:
+        related_courses.rebuild(course)
+
+
+def rebuild_related_many(course_ids):
+    """后台任务，批量导入课程后重建相关课程"""
+    for course in Course.objects.filter(pk__in=course_ids):
+        related_courses.rebuild(course)
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db.models import Count, Sum
+
+from .models import Course, Lesson, Video
+from organization.models import CourseOrg, Teacher
+from lib.rollups import Rollup
+
+lesson_rollup = Rollup(Course, Lesson, 'course', {'lesson_count': Count('pk')}).connect()
+video_rollup = Rollup(Course, Video, 'course', {'video_count': Count('pk'), 'learn_times': Sum('learn_times')}).connect()
+org_course_rollup = Rollup(CourseOrg, Course, 'org', {'course_nums': Count('pk')}).connect()
+org_teacher_rollup = Rollup(CourseOrg, Teacher, 'org', {'teacher_nums': Count('pk')}).connect()
+teacher_course_rollup = Rollup(Teacher, Course, 'teacher', {'course_nums': Count('pk')}).connect()
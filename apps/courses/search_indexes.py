@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from lib.search import SearchIndex, register
+from .models import Course
+
+course_index = register(SearchIndex(
+    'course', Course,
+    fields={'name': 3, 'tag': 2, 'desc': 2, 'detail': 1},
+    popularity_fields=('students', 'fav_nums'),
+))
@@ -10,6 +10,7 @@ from rest_framework.validators import UniqueValidator
 
 from .models import Course, CourseResource, Lesson, Video
 from organization.serializers import CourseOrgSerializer
+from lib.counters import CounterListSerializer
 from lib.redisextend import CustomModelSerializer
 from lib.typetools import JsonEncoder
 
@@ -55,6 +56,26 @@ class LessonSerializer(CustomModelSerializer):
         return lesson
 
 
+class CourseSummarySerializer(CustomModelSerializer):
+    """课程摘要，相关课程等列表使用，不包含章节、视频及学习用户"""
+
+    class Meta:
+        model = Course
+        fields = ("id", "name", "desc", "image", "degree", "category", "tag", "learn_times", "lesson_count",
+                  "video_count", "students", "fav_nums", "click_nums", "org", "teacher")
+        list_serializer_class = CounterListSerializer
+
+
+class CourseListSerializer(CounterListSerializer):
+    """课程列表，合并未回写的点击数，返回学习用户时按页读取每门课程的前10个学习用户"""
+
+    def to_representation(self, data):
+        if 'learn_users' in self.child.fields:
+            data = list(data.all() if hasattr(data, 'all') else data)
+            Course.prefetch_learn_users(data)
+        return super(CourseListSerializer, self).to_representation(data)
+
+
 class CourseSerializer(CustomModelSerializer):
     name = serializers.CharField(max_length=50, allow_null=True, validators=[
                                  UniqueValidator(queryset=Course.objects.all(), message="课程名已存在")])
@@ -69,6 +90,12 @@ class CourseSerializer(CustomModelSerializer):
     class Meta:
         model = Course
         fields = "__all__"
+        # 章节数、视频数、学习时长由courses.rollups统计
+        read_only_fields = ("lesson_count", "video_count", "learn_times")
+        # 列表中默认不返回课程详情html、章节视频及学习用户，?expand=lessons,learn_users时返回
+        expandable_fields = ("detail", "lessons", "learn_users")
+        field_prefetches = {"lessons": "lesson_set"}
+        list_serializer_class = CourseListSerializer
 
     def get_lessons(self, obj):
         return obj.get_lessons()
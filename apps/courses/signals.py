@@ -1,39 +1,66 @@
 # -*- coding: utf-8 -*-
 __author__ = 'wuhai'
-from datetime import datetime
-
+from django.db import transaction
 from django.db.models.signals import post_delete, post_save
-from django.core.cache import cache
 
 from .models import Course, Lesson, Video, CourseResource
+from .related import related_courses
+from .keys import LESSON_CACHE_KEY, RESOURCE_CACHE_KEY, VIDEO_CACHE_KEY
+from lib import bloomfilter
+from lib.keyconstructors import bump_instance_tags
+from lib.redisextend import invalidate_cache
+from lib.tasks import submit_task
+
+
+def course_changed(sender=None, instance=None, *args, **kwargs):
+    # 课程列表、详情等cache_response缓存依赖课程标签
+    bump_instance_tags(instance)
+
+
+def course_saved(sender=None, instance=None, *args, **kwargs):
+    # 标签、机构、讲师、类别可能变化，后台重建相关课程
+    submit_task('courses.related.rebuild_related', instance.pk)
+
+
+def course_deleted(sender=None, instance=None, *args, **kwargs):
+    course_id = instance.pk
+    transaction.on_commit(lambda: related_courses.remove(course_id))
+
+
+def lesson_changed(sender=None, instance=None, *args, **kwargs):
+    # 课程序列化包含章节，章节变更同时使所属课程缓存失效
+    bump_instance_tags(instance, (Course, instance.course_id))
+    transaction.on_commit(lambda: invalidate_cache(LESSON_CACHE_KEY, course_id=instance.course_id, id=instance.id))
+
+
+def video_changed(sender=None, instance=None, *args, **kwargs):
+    # 章节、课程序列化均包含视频
+    bump_instance_tags(instance, (Lesson, instance.lesson_id), (Course, instance.course_id))
+
+    def invalidate():
+        invalidate_cache(LESSON_CACHE_KEY, course_id=instance.course_id, id=instance.lesson_id)
+        invalidate_cache(VIDEO_CACHE_KEY, course_id=instance.course_id, lesson_id=instance.lesson_id, id=instance.id)
+    transaction.on_commit(invalidate)
 
 
-def change_updated_at(sender=None, instance=None, *args, **kwargs):
-    # 信号量key的生成规则必须与keyconstructors UpdatedAtKeyBit一致，object更新时间维护才有效
-    key = ':'.join([
-        "ObjectUpdatedAt",
-        instance.__module__,
-        instance.get_queryset().model.__name__,
-        instance.kwargs[instance.lookup_field],
-    ])
-    cache.set(key, datetime.utcnow())
+def resource_changed(sender=None, instance=None, *args, **kwargs):
+    bump_instance_tags(instance, (Course, instance.course_id))
+    transaction.on_commit(lambda: invalidate_cache(RESOURCE_CACHE_KEY, id=instance.id))
 
 
-def delete_updated_at(sender=None, instance=None, *args, **kwargs):
-    key = ':'.join([
-        "ObjectUpdatedAt",
-        instance.__module__,
-        instance.get_queryset().model.__name__,
-        instance.kwargs[instance.lookup_field],
-    ])
-    cache.delete(key)
+# 单一资源缓存查询前的布隆过滤器
+bloomfilter.register_models(CourseResource, Lesson, Video)
 
+post_save.connect(receiver=course_changed, sender=Course)
+post_delete.connect(receiver=course_changed, sender=Course)
+post_save.connect(receiver=course_saved, sender=Course)
+post_delete.connect(receiver=course_deleted, sender=Course)
 
-post_save.connect(receiver=change_updated_at, sender=Course)
-post_delete.connect(receiver=delete_updated_at, sender=Course)
+post_save.connect(receiver=lesson_changed, sender=Lesson)
+post_delete.connect(receiver=lesson_changed, sender=Lesson)
 
-post_save.connect(receiver=change_updated_at, sender=Lesson)
-post_delete.connect(receiver=delete_updated_at, sender=Lesson)
+post_save.connect(receiver=video_changed, sender=Video)
+post_delete.connect(receiver=video_changed, sender=Video)
 
-post_save.connect(receiver=change_updated_at, sender=Video)
-post_delete.connect(receiver=delete_updated_at, sender=Video)
+post_save.connect(receiver=resource_changed, sender=CourseResource)
+post_delete.connect(receiver=resource_changed, sender=CourseResource)
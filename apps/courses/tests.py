@@ -1,3 +1,205 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import io
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
 
-# Create your tests here.
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from rest_framework.test import APITestCase
+
+from courses.importers import CourseImporter
+from courses.models import Course
+from lib.exceptions import ServiceUnavailable
+from lib.keyconstructors import bump_tags, make_tag
+from lib.redisextend import CacheAside
+from lib.utils import BasePagination
+from operation.models import CourseComment
+from organization.models import CourseOrg, OrgCity
+from users.models import UserProfile
+
+
+class CourseTestMixin:
+
+    def setUp(self):
+        # 限速计数保存在redis中，多次运行测试时清除
+        cache.delete_pattern('throttle_*')
+        self.user = UserProfile.objects.create(username='tester', email='tester@example.com')
+        city = OrgCity.objects.create(name='city')
+        self.org = CourseOrg.objects.create(name='org', city=city)
+
+    def create_course(self, name, **kwargs):
+        return Course.objects.create(name=name, degree='cj', org=self.org, user=self.user, **kwargs)
+
+
+class CursorPaginationTest(CourseTestMixin, APITestCase):
+
+    def setUp(self):
+        super(CursorPaginationTest, self).setUp()
+        self.course = self.create_course('course')
+        self.comments = [CourseComment.objects.create(user=self.user, course=self.course, comments='c%d' % i)
+                         for i in range(5)]
+        self.url = '/learn/%s/comment/' % self.course.id
+
+    def get_page(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_keyset_filter(self):
+        ordering = ('created_time', 'id')
+        last = self.comments[1]
+        condition = BasePagination.keyset_filter(ordering, [last.created_time, last.id])
+        after = CourseComment.objects.filter(condition).order_by(*ordering)
+        self.assertEqual(list(after), self.comments[2:])
+
+    def test_walk_pages(self):
+        # 空cursor参数为keyset分页首页，按next链接翻页，不重复不遗漏
+        params = {'cursor': '', 'page_size': 2}
+        ids = []
+        while True:
+            data = self.get_page(params)
+            self.assertNotIn('count', data)
+            ids.extend(item['id'] for item in data['results'])
+            if data['next'] is None:
+                break
+            params = {key: value[0] for key, value in parse_qs(urlparse(data['next']).query).items()}
+        self.assertEqual(ids, [comment.id for comment in self.comments])
+
+        # previous链接返回上一页
+        data = self.get_page(params)
+        previous = {key: value[0] for key, value in parse_qs(urlparse(data['previous']).query).items()}
+        self.assertEqual([item['id'] for item in self.get_page(previous)['results']],
+                         [comment.id for comment in self.comments[2:4]])
+
+    def test_invalid_cursor(self):
+        for cursor in ('not-base64!', 'eyJ2IjpbMV19', 'eyJ2IjpbIngiLCJ5Il0sInIiOjB9'):
+            response = self.client.get(self.url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+
+
+class TagInvalidationTest(CourseTestMixin, APITestCase):
+
+    def setUp(self):
+        super(TagInvalidationTest, self).setUp()
+        self.course = self.create_course('before')
+        # 缓存在redis中跨测试运行保留，先递增版本号避免读到上次运行的缓存
+        bump_tags([make_tag(Course)])
+
+    def get_names(self):
+        response = self.client.get('/learn/course/')
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()['data']['results']]
+
+    def test_bump_model_tag(self):
+        self.assertEqual(self.get_names(), ['before'])
+        # QuerySet.update()不触发信号，缓存仍为旧值
+        Course.objects.filter(pk=self.course.pk).update(name='after')
+        self.assertEqual(self.get_names(), ['before'])
+
+        bump_tags([make_tag(Course)])
+        self.assertEqual(self.get_names(), ['after'])
+
+    def test_object_tag_keeps_list_cache(self):
+        self.assertEqual(self.get_names(), ['before'])
+        Course.objects.filter(pk=self.course.pk).update(name='after')
+        # 对象标签只使详情缓存失效
+        bump_tags([make_tag(Course, self.course.pk)])
+        self.assertEqual(self.get_names(), ['before'])
+
+
+class CacheAsideTest(APITestCase):
+
+    def setUp(self):
+        self.conn = get_redis_connection()
+        self.cache = CacheAside(self.conn, prefix='test_cache_aside', wait_timeout=0.1)
+        self.key = self.cache.make_key('obj')
+        self.conn.delete(self.key, self.cache.lock_key(self.key))
+
+    def tearDown(self):
+        self.conn.delete(self.key, self.cache.lock_key(self.key))
+
+    def test_load_once(self):
+        loader = mock.Mock(return_value={'id': 1})
+        self.assertEqual(self.cache.get('obj', loader), {'id': 1})
+        self.assertEqual(self.cache.get('obj', loader), {'id': 1})
+        loader.assert_called_once_with()
+        # 回填后释放锁
+        self.assertFalse(self.conn.exists(self.cache.lock_key(self.key)))
+
+    def test_null_value(self):
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(self.cache.get('obj', loader, null_expire=30))
+        self.assertIsNone(self.cache.get('obj', loader))
+        loader.assert_called_once_with()
+        self.assertLessEqual(self.conn.ttl(self.key), 30)
+
+    def test_loader_error_releases_lock(self):
+        with self.assertRaises(ValueError):
+            self.cache.get('obj', mock.Mock(side_effect=ValueError))
+        self.assertFalse(self.conn.exists(self.cache.lock_key(self.key)))
+
+    def test_wait_for_fill(self):
+        # 其他请求持有锁，等待期间回填，本请求读取回填值而不回源
+        self.conn.set(self.cache.lock_key(self.key), 'other')
+        loader = mock.Mock(return_value='mine')
+
+        def sleep(seconds):
+            self.cache.fill(self.key, 'theirs')
+        with mock.patch('lib.redisextend.time.sleep', side_effect=sleep):
+            self.assertEqual(self.cache.get('obj', loader), 'theirs')
+        loader.assert_not_called()
+        self.assertEqual(self.conn.get(self.cache.lock_key(self.key)), b'other')
+
+    def test_take_over_expired_lock(self):
+        # 持有者的锁过期后由等待的请求回源
+        self.conn.set(self.cache.lock_key(self.key), 'other')
+
+        def sleep(seconds):
+            self.conn.delete(self.cache.lock_key(self.key))
+        with mock.patch('lib.redisextend.time.sleep', side_effect=sleep):
+            self.assertEqual(self.cache.get('obj', lambda: 'mine'), 'mine')
+        self.assertEqual(self.cache.get('obj', mock.Mock()), 'mine')
+
+    def test_wait_timeout(self):
+        self.conn.set(self.cache.lock_key(self.key), 'other')
+        loader = mock.Mock()
+        with self.assertRaises(ServiceUnavailable):
+            self.cache.get('obj', loader)
+        loader.assert_not_called()
+        # 超时不删除其他请求的锁
+        self.assertEqual(self.conn.get(self.cache.lock_key(self.key)), b'other')
+
+
+class CourseImporterTest(CourseTestMixin, APITestCase):
+
+    def setUp(self):
+        super(CourseImporterTest, self).setUp()
+        self.course = self.create_course('old', desc='old desc')
+        self.unchanged = self.create_course('same', desc='same desc')
+
+    def make_file(self, *rows):
+        content = '\n'.join(','.join(row) for row in (('name', 'desc', '难度', 'org'),) + rows)
+        return io.BytesIO(content.encode('utf-8'))
+
+    def test_dry_run(self):
+        file = self.make_file(('old', 'new desc', '中级', 'org'),
+                              ('same', 'same desc', '初级', 'org'),
+                              ('created', 'desc', '高级', 'org'),
+                              ('bad', 'desc', '初级', 'missing'))
+        report = CourseImporter(user=self.user).run(file, 'courses.csv', dry_run=True)
+
+        self.assertEqual(report.counts, {'new': 1, 'update': 1, 'skip': 1, 'error': 1})
+        rows = {row['line']: row for row in report.rows}
+        self.assertEqual(rows[2]['changes'], {'desc': ('old desc', 'new desc'), 'degree': ('cj', 'zj')})
+        self.assertEqual(rows[4]['action'], 'new')
+        self.assertEqual(rows[5]['action'], 'error')
+        # dry_run不写入数据库
+        self.assertEqual(Course.objects.count(), 2)
+        self.course.refresh_from_db()
+        self.assertEqual((self.course.desc, self.course.degree), ('old desc', 'cj'))
+
+    def test_duplicate_rows(self):
+        file = self.make_file(('created', 'a', '初级', 'org'), ('created', 'b', '初级', 'org'))
+        report = CourseImporter(user=self.user).run(file, 'courses.csv', dry_run=True)
+        self.assertEqual((report.counts['new'], report.counts['error']), (1, 1))
@@ -13,12 +13,13 @@ from rest_framework import mixins, viewsets, filters, status
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
 from rest_framework.decorators import action
 
+from .keys import COMMENT_CACHE_KEY, LESSON_CACHE_KEY, RESOURCE_CACHE_KEY, VIDEO_CACHE_KEY
 from .models import Course, CourseResource, Lesson, Video
+from .related import related_courses
 from .serializers import CourseSerializer, LessonSerializer, CourseResourceSerializer, VideoSerializer
-from lib.exceptions import ValidationError
 from lib.keyconstructors import ListKeyConstructor, ObjectKeyConstructor
 from lib.permissions import IsOwnerOrReadOnly, IsOwnerOrReadOnlyForCourse
-from lib.utils import BasePagination, get_object
+from lib.utils import BasePagination, ListResponseMixin, get_object, order_by_pks
 from lib.response import Response
 from lib.redisextend import CustomModelViewSet
 from notifications.views import notification_handler
@@ -29,7 +30,7 @@ User = get_user_model()
 logger = logging.getLogger()
 
 
-class CourseModelViewSet(CustomModelViewSet):
+class CourseModelViewSet(ListResponseMixin, CustomModelViewSet):
     conn = get_redis_connection('learn')
 
 
@@ -51,6 +52,7 @@ class CourseViewSet(viewsets.ModelViewSet):
     # filter_backends = (DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter)
     filter_fields = ("degree", "category")
     search_fields = ("name", "desc", "detail")
+    search_index = 'course'
     ordering_fields = ("students", "created_time", "fav_nums")
     lookup_field = 'id'
 
@@ -70,7 +72,11 @@ class CourseViewSet(viewsets.ModelViewSet):
             return self.get_serializer(queryset, many=many)
 
     def get_queryset(self):
-        return Course.objects.all().select_related('org', 'user', 'teacher')
+        queryset = Course.objects.all().select_related('org', 'user', 'teacher')
+        if self.action not in ('list', 'retrieve'):
+            # 写操作不需要序列化章节视频
+            return queryset
+        return CourseSerializer.sparse_queryset(queryset.with_details(), self.request, many=self.action == 'list')
 
     def perform_create(self, serializer):
         obj = serializer.save()
@@ -78,40 +84,33 @@ class CourseViewSet(viewsets.ModelViewSet):
         others_user = User.objects.all().exclude(pk=self.request.user.id)
         notification_handler(actor=self.request.user, recipient=others_user, verb='B', action_object=obj)
 
-    # @cache_response(timeout=60 * 60 * 24, key_func=ListKeyConstructor())
+    @cache_response(timeout=60 * 60 * 24, key_func=ListKeyConstructor())
     def list(self, request, *args, **kwargs):
         courses = self.filter_queryset(self.get_queryset())
         serializer = self.get_custom_serializer(courses)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     @action(methods=['GET'], detail=True, url_path='rel', url_name='relate_coures')  # detail表示是否单一资源
+    @cache_response(timeout=60 * 60 * 24, key_func=ObjectKeyConstructor())
     def get_relate_coures(self, request, *args, **kwargs):
         course = self.get_object()
-        # 查询tag关联除自身之外的课程
-        rel_coures = Course.objects.filter(tag=course.tag).exclude(id=course.id)
+        # 相关课程从预计算的相关课程索引读取，按相关度排序；返回格式与课程列表相同
+        queryset = Course.objects.all().select_related('org', 'user', 'teacher').with_details()
+        rel_coures = order_by_pks(CourseSerializer.sparse_queryset(queryset, request), related_courses.get_ids(course))
         serializer = self.get_custom_serializer(rel_coures)
         return Response({'rel_courses': serializer.data}, status=status.HTTP_200_OK)
 
     def retrieve(self, request, *args, **kwargs):
-        # 是否收藏课程
-        has_fav_course = False
-        # 是否收藏机构
-        has_fav_org = False
         course = self.get_object()
-
-        if request.user.is_authenticated:
-            if UserFavorite.objects.filter(user=request.user, fav_id=course.id, fav_type=1):
-                has_fav_course = True
-            # 确定course.org不为None
-            if course.org and UserFavorite.objects.filter(user=request.user, fav_id=course.org.id, fav_type=2):
-                has_fav_org = True
+        # 一次判断是否收藏课程和机构，course.org_id为None时忽略
+        faved = UserFavorite.objects.get_faved(request.user, [(1, course.id), (2, course.org_id)])
 
         course.add_click_nums()
         course_serializer = self.get_serializer(course)
         return Response({
             'course': course_serializer.data,
-            'has_fav_course': has_fav_course,
-            'has_fav_org': has_fav_org
+            'has_fav_course': (1, course.id) in faved,
+            'has_fav_org': (2, course.org_id) in faved
         }, status=status.HTTP_200_OK)
 
 
@@ -129,6 +128,7 @@ class CourseResourceViewSet(CourseModelViewSet):
     """
     serializer_class = CourseResourceSerializer
     pagination_class = BasePagination
+    cache_key_format = RESOURCE_CACHE_KEY
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ("name", "course__degree", "course__category")
     lookup_field = 'id'
@@ -147,21 +147,10 @@ class CourseResourceViewSet(CourseModelViewSet):
 
         if int(course_id) < 0:
             return Response(code=-1, msg="course id is invalid.", status=status.HTTP_400_BAD_REQUEST)
-        elif int(course_id) > 0:
-            resources = CourseResource.objects.filter(course__pk=int(course_id))
-        else:
-            resources = CourseResource.objects.all()
-        resources_serializer = CourseResourceSerializer(resources, many=True)
-        return Response(resources_serializer.data, status=status.HTTP_200_OK)
-
-    def retrieve(self, request, *args, **kwargs):
-        cr_id = self.kwargs.get('id', -1)
-
-        if int(cr_id) < 0:
-            return Response(code=-1, msg="course resource id is invalid.", status=status.HTTP_400_BAD_REQUEST)
-        cache_key = ':'.join(('course_resource', cr_id))
-        d_retrieve = self.cache_retrieve(cache_key)
-        return Response(data=d_retrieve, status=status.HTTP_200_OK)
+        resources = self.filter_queryset(self.get_queryset())
+        if int(course_id) > 0:
+            resources = resources.filter(course__pk=int(course_id))
+        return self.list_response(resources)
 
 
 class LessonViewSet(CourseModelViewSet):
@@ -178,6 +167,7 @@ class LessonViewSet(CourseModelViewSet):
     """
     serializer_class = LessonSerializer
     pagination_class = BasePagination
+    cache_key_format = LESSON_CACHE_KEY
     filter_fields = ("name",)
     search_fields = ("name",)
     ordering_fields = ("created_time",)
@@ -192,25 +182,14 @@ class LessonViewSet(CourseModelViewSet):
     def get_queryset(self):
         return Lesson.objects.filter(course=self.kwargs.get('course_id')).select_related('course')
 
-    def retrieve(self, request, *args, **kwargs):
-        lesson_id = self.kwargs.get('id', -1)
-        course_id = self.kwargs.get('course_id', -1)
-
-        if int(lesson_id) < 0 or int(course_id) < 0:
-            return Response(code=-1, msg="course or lesson id is invalid.", status=status.HTTP_400_BAD_REQUEST)
-        cache_key = ':'.join(('courses', course_id, 'lessons', lesson_id))
-        d_retrieve = self.cache_retrieve(cache_key)
-        return Response(data=d_retrieve, status=status.HTTP_200_OK)
-
     def list(self, request, *args, **kwargs):
         # 限制只获取某一个课程的章节
         course_id = self.kwargs.get('course_id', -1)
 
         if int(course_id) < 0:
             return Response(code=-1, msg="course id is invalid.", status=status.HTTP_400_BAD_REQUEST)
-        lessons = Lesson.objects.filter(course=int(course_id))
-        lessons_serializer = LessonSerializer(lessons, many=True)
-        return Response(lessons_serializer.data, status=status.HTTP_200_OK)
+        lessons = self.filter_queryset(self.get_queryset()).prefetch_related('video_set')
+        return self.list_response(lessons)
 
 
 class VideoViewSet(CourseModelViewSet):
@@ -228,6 +207,7 @@ class VideoViewSet(CourseModelViewSet):
     """
     serializer_class = VideoSerializer
     pagination_class = BasePagination
+    cache_key_format = VIDEO_CACHE_KEY
     filter_fields = ("name",)
     search_fields = ("name",)
     ordering_fields = ("created_time",)
@@ -246,30 +226,15 @@ class VideoViewSet(CourseModelViewSet):
         course_id = self.kwargs.get('course_id')
         lesson_id = self.request.query_params.get('lesson_id')
 
-        videos = Video.objects.get_course_videos(course_id)
+        videos = self.filter_queryset(Video.objects.get_course_videos(course_id))
         if lesson_id:
             # 获取指定章节视频
             videos = videos.get_lesson_videos(lesson_id)
-        video_serializer = self.get_serializer(videos, many=True)
-        return Response(video_serializer.data, status=status.HTTP_200_OK)
-
-    def retrieve(self, request, *args, **kwargs):
-        cache_key = self.get_cache_key(**kwargs)
-        d_retrieve = self.cache_retrieve(cache_key)
-        return Response(data=d_retrieve, status=status.HTTP_200_OK)
-
-    def get_cache_key(self, **kwargs):
-        video_id = self.kwargs.get('id', -1)
-        course_id = self.kwargs.get('course_id', -1)
-        lesson_id = self.request.query_params.get('lesson_id', -1)
-
-        if int(video_id) < 0 or int(lesson_id) < 0 or int(course_id) < 0:
-            raise ValidationError(code=-1, detail="course or lesson or video id is invalid.")
-        return ':'.join(('courses', course_id, 'lessons', lesson_id, 'videos', video_id))
+        return self.list_response(videos)
 
     def update(self, request, *args, **kwargs):
         partial = kwargs.pop('partial', True)
-        cache_key = self.get_cache_key(**kwargs)
+        cache_key = self.get_cache_key()
 
         instance = self.get_object()
         serializer = self.get_serializer(instance, data=request.data, partial=partial)
@@ -294,6 +259,8 @@ class CourseCommentViewSet(CourseModelViewSet):
     """
     serializer_class = CourseCommentSerializer
     pagination_class = BasePagination
+    cursor_ordering = ('created_time', 'id')
+    cache_key_format = COMMENT_CACHE_KEY
     lookup_field = 'id'
 
     def get_permissions(self):
@@ -320,6 +287,5 @@ class CourseCommentViewSet(CourseModelViewSet):
 
         if int(course_id) < 0:
             return Response(code=-1, msg="course id is invalid.", status=status.HTTP_400_BAD_REQUEST)
-        course_comment = CourseComment.objects.filter(course=int(course_id)).order_by("created_time")
-        course_comment_serializer = self.get_serializer(course_comment, many=True)
-        return Response(course_comment_serializer.data, status=status.HTTP_200_OK)
+        course_comment = CourseComment.objects.filter(course=int(course_id)).order_by("created_time", "id")
+        return self.list_response(course_comment)
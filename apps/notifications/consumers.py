@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 # -*- coding:utf-8 -*-
 # __author__ = 'wuhai'
+import asyncio
 import json
 
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncJsonWebsocketConsumer, AsyncWebsocketConsumer
+from django.conf import settings
+
+from .delivery import mark_offline, mark_online, user_group
 
 
 class NotificationsConsumer(AsyncJsonWebsocketConsumer):
@@ -15,13 +20,26 @@ class NotificationsConsumer(AsyncJsonWebsocketConsumer):
             # 未登录用户拒绝连接
             await self.close()
         else:
-            await self.channel_layer.group_add('notifications', self.channel_name)
+            # 加入用户自己的频道组，并记录在线状态
+            self.group_name = user_group(self.scope['user'].id)
+            await self.channel_layer.group_add(self.group_name, self.channel_name)
+            await sync_to_async(mark_online)(self.scope['user'].id, self.channel_name)
+            self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
             await self.accept()
 
+    async def heartbeat(self):
+        """连接存活期间定时续期在线状态，间隔为过期时间的三分之一"""
+        while True:
+            await asyncio.sleep(settings.NOTIFICATION_ONLINE_TTL / 3)
+            await sync_to_async(mark_online)(self.scope['user'].id, self.channel_name)
+
     async def receive(self, text_data=None, bytes_data=None, **kwargs):
         """将接收到的消息返回给前端"""
         await self.send(text_data=json.dumps(text_data))
 
     async def disconnect(self, code):
         """断开连接"""
-        await self.channel_layer.group_discard('notifications', self.channel_name)
+        if getattr(self, 'group_name', None):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+            self.heartbeat_task.cancel()
+            await sync_to_async(mark_offline)(self.scope['user'].id, self.channel_name)
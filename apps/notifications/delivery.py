@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = 'wuhai'
+import asyncio
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+# 在线用户的websocket连接，每个用户一个ZSET，成员为channel_name，分数为连接心跳的过期时间；
+# 连接由consumer定时续期，进程崩溃未断开的连接过期后不再计为在线，整个key也随最后一次心跳过期
+ONLINE_KEY = 'notifications:online:%s'
+
+
+def user_group(user_id):
+    """每个用户一个频道组，通知只推送给接收者"""
+    return 'notifications.user.%s' % user_id
+
+
+def mark_online(user_id, channel_name):
+    """登记或续期一个连接，连接建立及每次心跳时调用"""
+    ttl = settings.NOTIFICATION_ONLINE_TTL
+    key = ONLINE_KEY % user_id
+    now = time.time()
+    pipe = get_redis_connection('default').pipeline()
+    # 顺便清理同一用户已过期的连接
+    pipe.zremrangebyscore(key, '-inf', now)
+    pipe.zadd(key, {channel_name: now + ttl})
+    pipe.expire(key, ttl)
+    pipe.execute()
+
+
+def mark_offline(user_id, channel_name):
+    get_redis_connection('default').zrem(ONLINE_KEY % user_id, channel_name)
+
+
+def get_online_users(user_ids):
+    """从接收者中筛选出有未过期连接的用户，一次往返"""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return []
+    now = time.time()
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for user_id in user_ids:
+        pipe.zcount(ONLINE_KEY % user_id, now, '+inf')
+    return [user_id for user_id, count in zip(user_ids, pipe.execute()) if count]
+
+
+def deliver(user_ids, payload):
+    """
+    向接收者推送通知，只推送给在线用户，同一用户只推送一次；
+    每批group_send在同一个事件循环中并发发送，避免逐条同步往返
+    :return: 推送的用户数
+    """
+    online_ids = get_online_users(dict.fromkeys(user_ids))
+    if not online_ids:
+        return 0
+    batch_size = settings.NOTIFICATION_DELIVERY_BATCH_SIZE
+    channel_layer = get_channel_layer()
+
+    async def send_all():
+        for i in range(0, len(online_ids), batch_size):
+            await asyncio.gather(*[channel_layer.group_send(user_group(user_id), payload)
+                                   for user_id in online_ids[i:i + batch_size]])
+
+    async_to_sync(send_all)()
+    return len(online_ids)
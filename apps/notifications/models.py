@@ -80,6 +80,10 @@ class Notification(models.Model):
         verbose_name = "通知"
         verbose_name_plural = verbose_name
         ordering = ("-created_at",)
+        indexes = [
+            # 通知列表keyset分页
+            models.Index(fields=['recipient', 'created_at', 'uuid'], name='notification_keyset_idx'),
+        ]
 
     def __str__(self):
         ctx = {
@@ -98,9 +102,14 @@ class Notification(models.Model):
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
         if not self.slug:
-            self.slug = slugify(f'{self.recipient} {self.uuid} {self.verb}')
+            self.slug = self.make_slug(self.recipient, self.uuid, self.verb)
         super(Notification, self).save()
 
+    @staticmethod
+    def make_slug(recipient, uuid, verb):
+        # recipient可以是用户实例或用户名，批量创建时预先计算slug
+        return slugify(f'{recipient} {uuid} {verb}')
+
     def mark_as_read(self):
         if self.unread:
             self.unread = False
@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+# -*- coding:utf-8 -*-
+# __author__ = 'wuhai'
+import uuid
+
+from django.contrib.auth import get_user_model
+
+from .delivery import deliver
+from .models import Notification
+
+User = get_user_model()
+
+
+def fanout_notifications(actor_id, recipient_ids, verb, content_type_id=None, object_id=None, slug=None,
+                         payload=None):
+    """
+    后台批量创建通知，由notification_handler按块提交
+    :param recipient_ids:   本块接收者id列表
+    :param payload:         不为空时创建完成后推送websocket消息给本块在线的接收者
+    :return:                创建的通知数
+    """
+    usernames = dict(User.objects.filter(pk__in=recipient_ids).values_list('pk', 'username'))
+    notifications = []
+    for recipient_id in recipient_ids:
+        if recipient_id not in usernames:
+            continue
+        notify_uuid = uuid.uuid4()
+        notifications.append(Notification(
+            uuid=notify_uuid,
+            actor_id=actor_id,
+            recipient_id=recipient_id,
+            verb=verb,
+            slug=slug or Notification.make_slug(usernames[recipient_id], notify_uuid, verb),
+            content_type_id=content_type_id,
+            object_id=object_id,
+        ))
+    Notification.objects.bulk_create(notifications, batch_size=len(notifications) or None)
+
+    if payload is not None:
+        deliver([obj.recipient_id for obj in notifications], payload)
+    return len(notifications)
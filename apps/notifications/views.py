@@ -2,31 +2,42 @@
 # -*- coding:utf-8 -*-
 # __author__ = 'wuhai'
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
 from django.db.models.query import QuerySet
 from django.shortcuts import redirect, render
+from django.utils import timezone
 from rest_framework import mixins, viewsets, filters, status
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view, permission_classes
 
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-
 from .models import Notification
 from .serializers import NotificationSerializer
-from lib.utils import get_object
+from lib.response import Response
+from lib.tasks import submit_task
+from lib.utils import BasePagination, get_object
 
 
 class NotificationUnreadView(mixins.ListModelMixin, viewsets.GenericViewSet):
     """未读通知列表"""
     serializer_class = NotificationSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = BasePagination
+    cursor_ordering = ('-created_at', '-uuid')
 
     def get_queryset(self, **kwargs):
         return self.request.user.notifications.all()
         # return self.request.user.notifications.unread()
 
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return Response(self.get_paginated_response(self.get_serializer(page, many=True).data).data)
+        return Response(self.get_serializer(queryset, many=True).data)
+
 
 @api_view(["GET", "POST"])
 @permission_classes((IsAuthenticated,))
@@ -58,7 +69,7 @@ def mark_as_read(request, uuid, *args, **kwargs):
 
 def notification_handler(actor=None, recipient=None, verb=None, action_object=None, **kwargs):
     """
-    通知处理器
+    通知处理器，接收者按块提交后台任务批量创建，请求中只做一次接收者id查询
     :param actor:           request.user对象
     :param recipient:       User Instance 接收者实例，可以是一个或者多个接收者
     :param verb:            str 通知类别
@@ -66,34 +77,30 @@ def notification_handler(actor=None, recipient=None, verb=None, action_object=No
     :param kwargs:          key, id_value等
     :return:                None
     """
-    msg = None
     key = kwargs.pop('key', 'notification')
     id_value = kwargs.pop('id_value', None)
     slug = kwargs.pop('slug', None)
 
     if isinstance(recipient, Group):
-        recipients = recipient.user_set.all()
-    elif isinstance(recipient, (QuerySet, list)):
-        recipients = recipient
+        recipient_ids = list(recipient.user_set.values_list('pk', flat=True))
+    elif isinstance(recipient, QuerySet):
+        recipient_ids = list(recipient.values_list('pk', flat=True))
+    elif isinstance(recipient, list):
+        recipient_ids = [getattr(obj, 'pk', obj) for obj in recipient]
     # request.user == recipient或recipient为空不通知
     elif actor == recipient or not recipient:
         return
     else:
-        recipients = [recipient]
-
-    channel_layer = get_channel_layer()
-    for recipient in recipients:
-        newnotify = Notification.objects.create(
-            actor=actor,
-            recipient=recipient,
-            slug=slug,
-            verb=verb,
-            action_object=action_object
-        )
-        if msg is None:
-            msg = newnotify.__str__()
-        newnotify.save()
+        recipient_ids = [recipient.pk]
+    if not recipient_ids:
+        return
 
+    content_type_id = object_id = None
+    if action_object is not None:
+        content_type_id = ContentType.objects.get_for_model(action_object).id
+        object_id = str(action_object.pk)
+    # 未保存的通知实例只用于生成消息文本，不查询数据库
+    msg = Notification(actor=actor, verb=verb, action_object=action_object, created_at=timezone.now()).__str__()
     payload = {
         'type': 'receive',
         'key': key,
@@ -101,5 +108,9 @@ def notification_handler(actor=None, recipient=None, verb=None, action_object=No
         'id_value': id_value,
         'msg': msg,
     }
-    async_to_sync(channel_layer.group_send)("notifications", payload)
 
+    chunk_size = settings.NOTIFICATION_FANOUT_CHUNK_SIZE
+    for i in range(0, len(recipient_ids), chunk_size):
+        # 每块创建完成后只推送给本块的接收者
+        submit_task('notifications.tasks.fanout_notifications', actor.pk, recipient_ids[i:i + chunk_size], verb,
+                    content_type_id=content_type_id, object_id=object_id, slug=slug, payload=payload)
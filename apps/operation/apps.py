@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class OperationConfig(AppConfig):
     name = 'operation'
     verbose_name = u"用户操作"
+
+    def ready(self):
+        from . import signals
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import hashlib
+import time
+import uuid
+
+from django.db import transaction
+from django_redis import get_redis_connection
+from rest_framework.renderers import JSONRenderer
+
+from .models import Banner
+from .serializers import BannerSerializer
+from courses.models import Course
+from courses.serializers import CourseSummarySerializer
+from lib.exceptions import ServiceUnavailable
+from lib.redisextend import CacheAside
+from lib.tasks import submit_task
+
+# 首页数据预渲染为完整的json响应体，与etag一起保存在hash中，首页请求只需一次往返；
+# hash设置过期时间，后台重建失败时最多保留HOMEPAGE_EXPIRE秒，剩余时间不足时读取请求提交后台重建
+HOMEPAGE_KEY = 'homepage'
+HOMEPAGE_EXPIRE = 60 * 60
+HOMEPAGE_REFRESH_AFTER = 60 * 10
+# 已提交重建任务的标记，合并短时间内的多次变更
+REFRESH_FLAG_KEY = 'homepage:refresh'
+REFRESH_FLAG_EXPIRE = 60
+# 首页数据不存在时只允许一个请求同步渲染，其余请求等待
+RENDER_LOCK_KEY = 'homepage:lock'
+RENDER_LOCK_EXPIRE = 10
+RENDER_WAIT_TIMEOUT = 2
+
+
+def get_conn():
+    return get_redis_connection('default')
+
+
+def render_homepage():
+    """渲染首页响应体，结构与lib.response.Response一致"""
+    banners = Banner.objects.all().order_by('index')
+    courses = CourseSummarySerializer.sparse_queryset(Course.objects.filter(is_banner=False), None)[:5]
+    banner_courses = CourseSummarySerializer.sparse_queryset(Course.objects.filter(is_banner=True), None)[:5]
+    return JSONRenderer().render({
+        'code': 0,
+        'msg': 'Success',
+        'data': {
+            'all_banners': BannerSerializer(banners, many=True).data,
+            'not_banner_courses': CourseSummarySerializer(courses, many=True).data,
+            'banner_courses': CourseSummarySerializer(banner_courses, many=True).data,
+        }
+    })
+
+
+def refresh_homepage():
+    """重新渲染并保存首页数据，返回(etag, body)"""
+    conn = get_conn()
+    # 先清除标记，渲染期间的新变更会重新提交任务
+    conn.delete(REFRESH_FLAG_KEY)
+    body = render_homepage()
+    etag = hashlib.md5(body).hexdigest()
+    pipe = conn.pipeline()
+    pipe.hset(HOMEPAGE_KEY, mapping={'etag': etag, 'body': body})
+    pipe.expire(HOMEPAGE_KEY, HOMEPAGE_EXPIRE)
+    pipe.execute()
+    return etag, body
+
+
+def get_homepage():
+    """读取预渲染的首页数据，临近过期时提交后台重建，不存在时加锁同步渲染"""
+    pipe = get_conn().pipeline(transaction=False)
+    pipe.hmget(HOMEPAGE_KEY, ['etag', 'body'])
+    pipe.ttl(HOMEPAGE_KEY)
+    (etag, body), ttl = pipe.execute()
+    if body is None:
+        return render_locked()
+    if 0 <= ttl < HOMEPAGE_EXPIRE - HOMEPAGE_REFRESH_AFTER:
+        schedule_refresh()
+    return etag.decode(), body
+
+
+def render_locked(interval=0.02, max_interval=0.2):
+    """
+    首页数据不存在时拿到锁的请求同步渲染，其余请求退避重读；
+    超过RENDER_WAIT_TIMEOUT仍未渲染完成时抛出ServiceUnavailable，不重复渲染
+    """
+    conn = get_conn()
+    deadline = time.time() + RENDER_WAIT_TIMEOUT
+    while True:
+        token = uuid.uuid4().hex
+        if conn.set(RENDER_LOCK_KEY, token, nx=True, ex=RENDER_LOCK_EXPIRE):
+            try:
+                return refresh_homepage()
+            finally:
+                conn.eval(CacheAside.release_script, 1, RENDER_LOCK_KEY, token)
+        if time.time() >= deadline:
+            raise ServiceUnavailable()
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+        etag, body = conn.hmget(HOMEPAGE_KEY, ['etag', 'body'])
+        if body is not None:
+            return etag.decode(), body
+
+
+def schedule_refresh():
+    """事务提交后提交后台重建任务，已有待执行的任务时不重复提交"""
+    def submit():
+        if get_conn().set(REFRESH_FLAG_KEY, 1, nx=True, ex=REFRESH_FLAG_EXPIRE):
+            submit_task('operation.homepage.refresh_homepage')
+    transaction.on_commit(submit)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import math
+import time
+
+import mmh3
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+
+from lib.bloomfilter import LocalBloomFilter, PyBloomFilter
+
+
+class LegacyBloomFilter:
+    """改写前的PyBloomFilter，每个探测位一次SETBIT/GETBIT往返，仅用于对比"""
+    SEEDS = [543, 460, 171, 876, 796, 607, 650, 81, 837, 545, 591, 946, 846, 521, 913, 636, 878, 735, 414, 372,
+             344, 324, 223, 180, 327, 891, 798, 933, 493, 293, 836, 10, 6, 544, 924, 849, 438, 41, 862, 648, 338,
+             465, 562, 693, 979, 52, 763, 103, 387, 374, 349, 94, 384, 680, 574, 480, 307, 580, 71, 535, 300, 53,
+             481, 519, 644, 219, 686, 236, 424, 326, 244, 212, 909, 202, 951, 56, 812, 901, 926, 250, 507, 739, 371,
+             63, 584, 154, 7, 284, 617, 332, 472, 140, 605, 262, 355, 526, 647, 923, 199, 518]
+
+    def __init__(self, capacity, error_rate, conn, key):
+        self.m = math.ceil(capacity * math.log2(math.e) * math.log2(1 / error_rate))
+        self.k = math.ceil(math.log1p(2) * self.m / capacity)
+        self.blocknum = math.ceil(math.ceil(self.m / 8 / 1024 / 1024) / 512)
+        self.seeds = self.SEEDS[0:self.k]
+        self.key = key
+        self.N = 2 ** 31 - 1
+        self.redis = conn
+
+    def add(self, value):
+        name = self.key + "_" + str(ord(value[0]) % self.blocknum)
+        for hash in self.get_hashs(value):
+            self.redis.setbit(name, hash, 1)
+
+    def is_exist(self, value):
+        name = self.key + "_" + str(ord(value[0]) % self.blocknum)
+        exist = True
+        for hash in self.get_hashs(value):
+            exist = exist & self.redis.getbit(name, hash)
+        return exist
+
+    def get_hashs(self, value):
+        return [hash if hash >= 0 else self.N - hash for hash in (mmh3.hash(value, seed) for seed in self.seeds)]
+
+
+class Command(BaseCommand):
+    help = "对比改写前后布隆过滤器及本地布隆过滤器的写入、查询吞吐量和实际误判率，使用临时键，结束后删除"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nums', type=int, default=10000, help="写入及查询的值个数")
+        parser.add_argument('--capacity', type=int, default=1000000)
+        parser.add_argument('--error-rate', type=float, default=0.0001)
+        parser.add_argument('--batch-size', type=int, default=500, help="新实现批量接口每批的值个数")
+        parser.add_argument('--alias', default='default', help="redis连接别名")
+
+    def timeit(self, label, nums, func):
+        start = time.perf_counter()
+        result = func()
+        cost = time.perf_counter() - start
+        self.stdout.write("%-28s %8.3fs %12.0f ops/s" % (label, cost, nums / cost if cost else float('inf')))
+        return result
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection(options['alias'])
+        nums, batch_size = options['nums'], options['batch_size']
+        added = ['bench-%d' % i for i in range(nums)]
+        missing = ['miss-%d' % i for i in range(nums)]
+        batches = lambda values: [values[i:i + batch_size] for i in range(0, len(values), batch_size)]
+
+        legacy = LegacyBloomFilter(options['capacity'], options['error_rate'], conn, 'bloom:benchmark:legacy')
+        bloom = PyBloomFilter(options['capacity'], options['error_rate'], conn, 'bloom:benchmark:new')
+        self.stdout.write("legacy: k=%d blocks=%d    new: k=%d m=%d blocks=%d" % (
+            legacy.k, legacy.blocknum, bloom.k, bloom.m, bloom.blocknum))
+        try:
+            self.timeit('legacy add', nums, lambda: [legacy.add(value) for value in added])
+            legacy_fp = self.timeit('legacy is_exist', nums, lambda: sum(legacy.is_exist(value) for value in missing))
+            self.timeit('new add', nums, lambda: [bloom.add(value) for value in added])
+            self.timeit('new is_exist', nums, lambda: sum(bloom.is_exist(value) for value in missing))
+            bloom.clear()
+            self.timeit('new add_many', nums, lambda: [bloom.add_many(values) for values in batches(added)])
+            new_fp = self.timeit('new contains_many', nums,
+                                 lambda: sum(sum(bloom.contains_many(values)) for values in batches(missing)))
+            if not all(bloom.contains_many(added)):
+                self.stderr.write("new filter missed added values")
+            local = LocalBloomFilter(options['capacity'], options['error_rate'])
+            self.timeit('local add_many', nums, lambda: [local.add_many(values) for values in batches(added)])
+            self.timeit('local contains_many', nums,
+                        lambda: sum(sum(local.contains_many(values)) for values in batches(missing)))
+            self.stdout.write("false positives: legacy %d/%d, new %d/%d" % (legacy_fp, nums, new_fp, nums))
+        finally:
+            conn.delete(*['%s_%s' % (legacy.key, i) for i in range(legacy.blocknum)])
+            bloom.clear()
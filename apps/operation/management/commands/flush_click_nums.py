@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import time
+
+from django.core.management.base import BaseCommand
+
+from courses.models import Course
+from organization.models import CourseOrg, Teacher
+from lib.counters import click_counter
+
+
+class Command(BaseCommand):
+    help = "将redis中缓冲的课程、机构、讲师点击数批量回写数据库"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help="循环回写间隔(秒)，0表示只执行一次")
+        parser.add_argument('--batch-size', type=int, default=500, help="每条UPDATE语句包含的记录数")
+
+    def handle(self, *args, **options):
+        while True:
+            for model in (Course, CourseOrg, Teacher):
+                nums = click_counter.flush(model, batch_size=options['batch_size'])
+                if nums:
+                    self.stdout.write("%s: flushed %d rows" % (model._meta.label, nums))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
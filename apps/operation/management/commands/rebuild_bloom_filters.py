@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand
+
+from lib.bloomfilter import get_model_filters
+
+
+class Command(BaseCommand):
+    help = "从数据库构建课程资源、章节、视频、评论的布隆过滤器，构建完成后才开始拦截不存在的id"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true', help="先清空再构建，去除已删除id造成的误判")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="每批读取的主键数")
+
+    def handle(self, *args, **options):
+        for bloom in get_model_filters():
+            nums = bloom.rebuild(clear=options['clear'], chunk_size=options['chunk_size'])
+            self.stdout.write("%s: %d ids added" % (bloom.model._meta.label, nums))
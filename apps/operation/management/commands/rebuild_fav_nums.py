@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from operation.models import UserFavorite, FAV_TYPE_MODELS
+from lib.keyconstructors import bump_object_tags
+from lib.search import update_popularity
+
+
+class Command(BaseCommand):
+    help = "根据用户收藏记录重新统计课程、机构、讲师的收藏数，修正计数偏差"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="每批检查的记录数")
+        parser.add_argument('--dry-run', action='store_true', help="只统计需要修正的记录数，不写数据库")
+
+    @staticmethod
+    def get_fav_nums(fav_type):
+        """收藏数相关子查询，在UPDATE语句中统计，读取与写入之间的收藏、取消收藏不会被覆盖"""
+        nums = UserFavorite.objects.filter(fav_type=fav_type, fav_id=OuterRef('pk')).order_by() \
+            .values('fav_id').annotate(nums=Count('pk')).values('nums')
+        return Coalesce(Subquery(nums, output_field=IntegerField()), 0)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for fav_type, model in FAV_TYPE_MODELS.items():
+            fav_nums = self.get_fav_nums(fav_type)
+            pks = list(model._default_manager.order_by('pk').values_list('pk', flat=True))
+            updated = 0
+            for i in range(0, len(pks), batch_size):
+                # 先找出计数不一致的记录，只UPDATE这些记录
+                changed = list(model._default_manager.filter(pk__in=pks[i:i + batch_size]).order_by()
+                               .annotate(real_nums=fav_nums).exclude(fav_nums=F('real_nums'))
+                               .values_list('pk', flat=True))
+                if changed and not options['dry_run']:
+                    model._default_manager.filter(pk__in=changed).update(fav_nums=fav_nums)
+                    # update不触发信号，手动使修正对象的详情缓存失效并刷新搜索热度
+                    bump_object_tags(model, changed)
+                    update_popularity(model, changed, fields=['fav_nums'])
+                updated += len(changed)
+            self.stdout.write("%s: %d rows fixed" % (model._meta.label, updated))
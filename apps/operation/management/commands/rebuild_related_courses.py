@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand
+
+from courses.models import Course
+from courses.related import related_courses
+
+
+class Command(BaseCommand):
+    help = "重建所有课程的相关课程索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="每批读取的课程数")
+
+    def handle(self, *args, **options):
+        total = 0
+        for course in Course.objects.order_by('pk').iterator(chunk_size=options['chunk_size']):
+            related_courses.rebuild(course)
+            total += 1
+        self.stdout.write("%d courses rebuilt" % total)
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand
+
+from lib.rollups import Rollup
+
+
+class Command(BaseCommand):
+    help = "重新统计课程章节数、视频数、学习时长及机构、讲师的课程数、教师数"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="每条UPDATE语句包含的记录数")
+
+    def handle(self, *args, **options):
+        for rollup in Rollup.registry:
+            nums = rollup.rebuild(batch_size=options['batch_size'])
+            self.stdout.write("%s <- %s: %d rows rebuilt" % (
+                rollup.parent._meta.label, rollup.child._meta.label, nums))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from lib.search import get_backend, get_indexes
+
+
+class Command(BaseCommand):
+    help = "重建课程、机构、讲师的全文检索索引"
+
+    def add_arguments(self, parser):
+        parser.add_argument('indexes', nargs='*', help="索引名，默认全部")
+        parser.add_argument('--chunk-size', type=int, default=500, help="每批读取写入的记录数")
+        parser.add_argument('--fulltext', action='store_true', help="MySQLFulltextBackend创建ngram全文索引")
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        chunk_size = options['chunk_size']
+        for index in get_indexes():
+            if options['indexes'] and index.name not in options['indexes']:
+                continue
+            if options['fulltext']:
+                with connection.cursor() as cursor:
+                    cursor.execute(backend.create_index_sql(index))
+                self.stdout.write("%s: fulltext index created" % index.name)
+                continue
+
+            # 写入临时索引，完成后替换，重建期间检索仍使用旧索引
+            target = backend.begin_rebuild(index)
+            chunk = []
+            total = 0
+            for instance in index.get_queryset().iterator(chunk_size=chunk_size):
+                chunk.append(instance)
+                if len(chunk) >= chunk_size:
+                    backend.bulk_update(target, chunk)
+                    total += len(chunk)
+                    chunk = []
+            backend.bulk_update(target, chunk)
+            total += len(chunk)
+            backend.finish_rebuild(index, target)
+            self.stdout.write("%s: %d documents indexed" % (index.name, total))
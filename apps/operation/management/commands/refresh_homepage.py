@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import time
+
+from django.core.management.base import BaseCommand
+
+from operation.homepage import refresh_homepage
+
+
+class Command(BaseCommand):
+    help = "重新渲染首页轮播图及课程数据，章节、视频、学习用户等变更由定时刷新同步"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=0, help="循环刷新间隔(秒)，0表示只执行一次")
+
+    def handle(self, *args, **options):
+        while True:
+            etag, body = refresh_homepage()
+            self.stdout.write("homepage refreshed: %s, %d bytes" % (etag, len(body)))
+            if not options['interval']:
+                break
+            time.sleep(options['interval'])
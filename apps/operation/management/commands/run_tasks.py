@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.core.management.base import BaseCommand, CommandError
+
+from lib.tasks import get_queue_backend
+
+
+class Command(BaseCommand):
+    help = "启动后台任务worker，消费RedisQueueBackend队列中的任务"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=int, default=5, help="队列阻塞读取超时(秒)")
+
+    def handle(self, *args, **options):
+        backend = get_queue_backend()
+        if backend is None:
+            raise CommandError("Neither BACKGROUND_TASKS['BACKEND'] nor ['ROUTES'] uses lib.tasks.RedisQueueBackend.")
+        self.stdout.write("Worker started, queue: %s" % backend.queue)
+        while True:
+            backend.work(timeout=options['timeout'])
@@ -1,14 +1,20 @@
 # _*_ encoding:utf-8 _*_
 from datetime import datetime
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import OuterRef, Q, Subquery
 from django.contrib.auth import get_user_model
+from django_redis import get_redis_connection
 
 from courses.models import Course
 from organization.models import CourseOrg, Teacher
 
 User = get_user_model()
 
+# 收藏类型与收藏对象模型的对应关系
+FAV_TYPE_MODELS = {1: Course, 2: CourseOrg, 3: Teacher}
+
 
 class Banner(models.Model):
     title = models.CharField(max_length=100, verbose_name="标题")
@@ -50,22 +56,83 @@ class CourseComment(models.Model):
         verbose_name = "课程评论"
         verbose_name_plural = verbose_name
         ordering = ('course', '-created_time')
+        indexes = [
+            # 课程评论列表keyset分页
+            models.Index(fields=['course', 'created_time', 'id'], name='course_comment_keyset_idx'),
+        ]
 
 
 class UserFavoriteQuerySet(models.query.QuerySet):
     """User Favorite QuerySet"""
+    # 用户收藏集合缓存，成员格式'fav_type:fav_id'，空集合用占位成员表示
+    cache_key = 'user_fav:%s'
+    cache_placeholder = '0:0'
+    cache_expire = 60 * 60 * 24
+
+    def get_faved(self, user, pairs):
+        """
+        判断用户收藏了哪些对象，最多一次查询
+        :param user: 用户实例
+        :param pairs: [(fav_type, fav_id), ...]
+        :return: 已收藏的(fav_type, fav_id)集合
+        """
+        pairs = [(int(fav_type), int(fav_id)) for fav_type, fav_id in pairs if fav_id]
+        if not pairs or not user.is_authenticated:
+            return set()
+        if getattr(settings, 'USER_FAV_CACHE', False):
+            return self._get_cached_faved(user, pairs)
+
+        ids_map = {}
+        for fav_type, fav_id in pairs:
+            ids_map.setdefault(fav_type, []).append(fav_id)
+        condition = Q()
+        for fav_type, fav_ids in ids_map.items():
+            condition |= Q(fav_type=fav_type, fav_id__in=fav_ids)
+        return set(self.filter(condition, user=user).values_list('fav_type', 'fav_id'))
+
+    def _get_cached_faved(self, user, pairs):
+        conn = get_redis_connection('learn')
+        key = self.cache_key % user.id
+        # exists与sismember在同一次往返中完成
+        pipe = conn.pipeline(transaction=False)
+        pipe.exists(key)
+        for fav_type, fav_id in pairs:
+            pipe.sismember(key, '%d:%d' % (fav_type, fav_id))
+        exists, *members = pipe.execute()
+        if exists:
+            return {pair for pair, is_member in zip(pairs, members) if is_member}
+
+        # 缓存不存在时一次加载用户全部收藏
+        faved = set(self.filter(user=user).values_list('fav_type', 'fav_id'))
+        pipe = conn.pipeline()
+        pipe.sadd(key, self.cache_placeholder, *['%d:%d' % pair for pair in faved])
+        pipe.expire(key, self.cache_expire)
+        pipe.execute()
+        return faved & set(pairs)
+
+    def clean_fav_cache(self, user):
+        # 收藏或取消收藏写入数据库后调用，事务提交后才删除用户收藏集合缓存，
+        # 避免并发的get_faved在提交前重新加载旧集合
+        key = self.cache_key % user.id
+        transaction.on_commit(lambda: get_redis_connection('learn').delete(key))
 
     def get_fav_courses(self):
-        fav_courses = self.filter(fav_type=1).select_related('user')
-        return [Course.objects.get(id=fav_course.fav_id) for fav_course in fav_courses]
+        return self.get_fav_objects(1)
 
     def get_fav_orgs(self):
-        fav_orgs = self.filter(fav_type=2).select_related('user')
-        return [CourseOrg.objects.get(id=fav_org.fav_id) for fav_org in fav_orgs]
+        return self.get_fav_objects(2)
 
     def get_fav_teachers(self):
-        fav_teachers = self.filter(fav_type=3).select_related('user')
-        return [Teacher.objects.get(id=fav_teacher.fav_id) for fav_teacher in fav_teachers]
+        return self.get_fav_objects(3)
+
+    def get_fav_objects(self, fav_type):
+        """
+        收藏对象的惰性queryset，fav_id__in子查询过滤并按收藏时间倒序，分页在数据库中完成
+        """
+        favs = self.filter(fav_type=fav_type)
+        fav_time = favs.filter(fav_id=OuterRef('pk')).order_by('-created_time').values('created_time')[:1]
+        return FAV_TYPE_MODELS[fav_type].objects.filter(pk__in=favs.values('fav_id')) \
+            .annotate(fav_time=Subquery(fav_time)).order_by('-fav_time', '-pk')
 
 
 class UserFavorite(models.Model):
@@ -89,18 +156,52 @@ class UserFavorite(models.Model):
 
 class MessageQuerySet(models.query.QuerySet):
     """User Message QuerySet"""
+    # 用户未读消息数缓存
+    unread_key = 'user_msg_unread:%s'
+    unread_expire = 60 * 60 * 24 * 7
+    # key存在时才增减，不存在时由get_unread_msg_nums从数据库重新统计
+    incr_script = """
+    if redis.call('exists', KEYS[1]) == 1 then
+        return redis.call('incrby', KEYS[1], ARGV[1])
+    end
+    return nil
+    """
 
     def get_unread_msgs(self):
         return self.filter(has_read=False).select_related('user')
 
-    def get_unread_msg_nums(self):
-        return self.filter(has_read=False).count()
-
-    def clean_unread_msgs(self):
-        all_unread_messages = self.get_unread_msgs()
-        for unread_message in all_unread_messages:
-            unread_message.has_read = True
-            unread_message.save()
+    def get_unread_msg_nums(self, user=None):
+        if user is None:
+            return self.filter(has_read=False).count()
+        conn = get_redis_connection('learn')
+        key = self.unread_key % user.id
+        nums = conn.get(key)
+        if nums is None:
+            nums = self.filter(user=user, has_read=False).count()
+            # SET NX：统计期间其他请求已写入并增减过的值不被覆盖
+            if not conn.set(key, nums, ex=self.unread_expire, nx=True):
+                nums = conn.get(key) or nums
+        return max(int(nums), 0)
+
+    def incr_unread_msg_nums(self, user_id, amount=1):
+        conn = get_redis_connection('learn')
+        return conn.eval(self.incr_script, 1, self.unread_key % user_id, amount)
+
+    def reset_unread_msg_nums(self, user_id):
+        return get_redis_connection('learn').delete(self.unread_key % user_id)
+
+    def clean_unread_msgs(self, user=None):
+        """
+        一条UPDATE标记已读，传入user时只处理该用户的消息；
+        未读数减去实际标记的条数而不是置0，UPDATE之后新到的消息仍计入未读
+        """
+        queryset = self.filter(has_read=False)
+        if user is not None:
+            queryset = queryset.filter(user=user)
+        updated = queryset.update(has_read=True)
+        if user is not None and updated:
+            transaction.on_commit(lambda: self.incr_unread_msg_nums(user.id, -updated))
+        return updated
 
 
 class UserMessage(models.Model):
@@ -115,6 +216,12 @@ class UserMessage(models.Model):
         verbose_name = "用户消息"
         verbose_name_plural = verbose_name
         ordering = ('user', '-created_time')
+        indexes = [
+            # 用户消息列表及未读统计、标记已读
+            models.Index(fields=['user', 'has_read', 'created_time'], name='user_message_unread_idx'),
+            # 用户消息列表keyset分页
+            models.Index(fields=['user', 'created_time', 'id'], name='user_message_keyset_idx'),
+        ]
 
 
 class UserCourse(models.Model):
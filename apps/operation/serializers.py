@@ -7,6 +7,7 @@ from rest_framework.validators import UniqueTogetherValidator
 from rest_framework import serializers
 
 from .models import UserFavorite, UserAsk, UserCourse, UserMessage, CourseComment, Banner
+from lib.redisextend import CustomModelSerializer
 
 User = get_user_model()
 
@@ -60,7 +61,7 @@ class UserCourseSerializer(serializers.ModelSerializer):
         ]
 
 
-class CourseCommentSerializer(serializers.ModelSerializer):
+class CourseCommentSerializer(CustomModelSerializer):
     user = serializers.HiddenField(
         default=serializers.CurrentUserDefault()
     )
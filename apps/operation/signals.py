@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .homepage import schedule_refresh
+from .models import UserMessage, UserCourse, CourseComment, Banner
+from courses.models import Course
+from courses.related import related_courses
+from courses.keys import COMMENT_CACHE_KEY
+from lib import bloomfilter
+from lib.keyconstructors import bump_instance_tags, bump_object_tags
+from lib.redisextend import invalidate_cache
+
+
+def incr_unread_msg_nums(sender=None, instance=None, created=False, *args, **kwargs):
+    # 新增未读消息，事务提交后用户未读数加一，回滚时不计数；修改消息时无法确定原已读状态，删除缓存重新统计
+    user_id = instance.user_id
+    if not created:
+        transaction.on_commit(lambda: UserMessage.objects.reset_unread_msg_nums(user_id))
+    elif not instance.has_read:
+        transaction.on_commit(lambda: UserMessage.objects.incr_unread_msg_nums(user_id, 1))
+
+
+def decr_unread_msg_nums(sender=None, instance=None, *args, **kwargs):
+    if not instance.has_read:
+        user_id = instance.user_id
+        transaction.on_commit(lambda: UserMessage.objects.incr_unread_msg_nums(user_id, -1))
+
+
+def user_course_changed(sender=None, instance=None, *args, **kwargs):
+    # 课程详情包含学习用户，只使该课程的详情缓存失效，不影响课程列表缓存
+    bump_instance_tags(instance)
+    bump_object_tags(Course, [instance.course_id])
+
+
+def learner_changed(sender=None, instance=None, created=None, *args, **kwargs):
+    # 用户新学习或取消学习课程，调整与该用户其他课程的共同学习分数；重复记录不重复计算
+    if created is False:
+        return
+    learned = UserCourse.objects.filter(user=instance.user_id).exclude(pk=instance.pk)
+    if learned.filter(course=instance.course_id).exists():
+        return
+    others = list(learned.values_list('course', flat=True).distinct())
+    if others:
+        amount = -1 if created is None else 1
+        transaction.on_commit(lambda: related_courses.learner_changed(instance.course_id, others, amount))
+
+
+def homepage_changed(sender=None, instance=None, *args, **kwargs):
+    # 首页包含轮播图、轮播课程及最新课程
+    schedule_refresh()
+
+
+def comment_changed(sender=None, instance=None, *args, **kwargs):
+    transaction.on_commit(lambda: invalidate_cache(COMMENT_CACHE_KEY, course_id=instance.course_id, id=instance.id))
+
+
+bloomfilter.register_models(CourseComment)
+
+post_save.connect(receiver=incr_unread_msg_nums, sender=UserMessage)
+post_delete.connect(receiver=decr_unread_msg_nums, sender=UserMessage)
+
+post_save.connect(receiver=user_course_changed, sender=UserCourse)
+post_delete.connect(receiver=user_course_changed, sender=UserCourse)
+post_save.connect(receiver=learner_changed, sender=UserCourse)
+post_delete.connect(receiver=learner_changed, sender=UserCourse)
+
+post_save.connect(receiver=homepage_changed, sender=Banner)
+post_delete.connect(receiver=homepage_changed, sender=Banner)
+post_save.connect(receiver=homepage_changed, sender=Course)
+post_delete.connect(receiver=homepage_changed, sender=Course)
+
+post_save.connect(receiver=comment_changed, sender=CourseComment)
+post_delete.connect(receiver=comment_changed, sender=CourseComment)
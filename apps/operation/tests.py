@@ -1,3 +1,66 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
 from django.test import TestCase
 
-# Create your tests here.
+from courses.models import Course
+from lib.counters import RedisCounter
+from users.models import UserProfile
+
+
+class RedisCounterTest(TestCase):
+
+    def setUp(self):
+        self.counter = RedisCounter('click_nums', prefix='test_counter')
+        self.conn = self.counter.conn
+        self.key = self.counter.get_key(Course)
+        self.conn.delete(self.key, self.key + ':flushing', self.key + ':plan')
+        user = UserProfile.objects.create(username='tester', email='tester@example.com')
+        self.courses = [Course.objects.create(name='c%d' % i, degree='cj', user=user) for i in range(2)]
+
+    def tearDown(self):
+        self.conn.delete(self.key, self.key + ':flushing', self.key + ':plan')
+
+    def reload(self, course):
+        return Course.objects.get(pk=course.pk)
+
+    def test_incr_and_merge(self):
+        course, other = self.courses
+        self.assertEqual(self.counter.incr(course), 1)
+        self.assertEqual(self.counter.incr(course, 2), 3)
+        # 未回写时数据库值不变，读取时合并增量
+        self.assertEqual(self.reload(course).click_nums, 0)
+        merged = self.counter.merge([self.reload(course), self.reload(other)])
+        self.assertEqual([obj.click_nums for obj in merged], [3, 0])
+
+    def test_flush(self):
+        course, other = self.courses
+        self.counter.incr(course, 3)
+        self.counter.incr(other)
+        self.assertEqual(self.counter.flush(Course), 2)
+        self.assertEqual([self.reload(obj).click_nums for obj in self.courses], [3, 1])
+        self.assertEqual(self.counter.get(self.reload(course)), 3)
+        self.assertFalse(self.conn.exists(self.key, self.key + ':flushing', self.key + ':plan'))
+        self.assertEqual(self.counter.flush(Course), 0)
+
+    def test_replay_plan(self):
+        course, other = self.courses
+        self.counter.incr(course, 2)
+        self.counter.incr(other, 5)
+        # 模拟回写中断：plan已写入，course已UPDATE，other尚未UPDATE，增量未删除
+        self.conn.rename(self.key, self.key + ':flushing')
+        plans = self.counter.get_plans(Course, self.key + ':plan', [(course.pk, 2), (other.pk, 5)])
+        self.assertEqual(plans, {course.pk: (0, 2), other.pk: (0, 5)})
+        Course.objects.filter(pk=course.pk).update(click_nums=2)
+        # 中断期间的新点击写入新hash
+        self.counter.incr(course)
+
+        # 已回写的记录不重复计入flushing中的增量
+        self.assertEqual(self.counter.get(self.reload(course)), 3)
+        self.assertEqual(self.counter.get(self.reload(other)), 5)
+
+        # 按原plan重做，已执行的UPDATE条件不成立
+        self.assertEqual(self.counter.flush(Course), 2)
+        self.assertEqual([self.reload(obj).click_nums for obj in self.courses], [2, 5])
+        self.assertFalse(self.conn.exists(self.key + ':flushing', self.key + ':plan'))
+        self.assertEqual(self.counter.flush(Course), 1)
+        self.assertEqual(self.reload(course).click_nums, 3)
@@ -1,9 +1,12 @@
 # _*_ encoding:utf-8 _*_
+from django.http import HttpResponse
+from django.utils.http import parse_etags, quote_etag
 from rest_framework import mixins, viewsets, status
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
 from rest_framework.decorators import api_view, permission_classes, action
 from rest_framework_extensions.cache.decorators import cache_response
 
+from .homepage import get_homepage
 from .models import UserAsk, UserFavorite, Banner, UserCourse
 from .serializers import UserAskSerializer, UserFavoriteSerializer, BannerSerializer, UserCourseSerializer
 from courses.models import Course
@@ -45,17 +48,15 @@ class BannerViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
         return Banner.objects.all().order_by('index')
 
     def list(self, request, *args, **kwargs):
-        all_banners = self.filter_queryset(self.get_queryset())
-        banners_serializer = self.get_serializer(all_banners, many=True)
-        courses = Course.objects.filter(is_banner=False)[:5]
-        banner_courses = Course.objects.filter(is_banner=True)[:5]
-        nb_courses_serializer = CourseSerializer(courses, many=True)
-        b_courese_serializer = CourseSerializer(banner_courses, many=True)
-        return Response({
-            'all_banners': banners_serializer.data,
-            'not_banner_courses': nb_courses_serializer.data,
-            'banner_courses': b_courese_serializer.data,
-        }, status=status.HTTP_200_OK)
+        # 首页数据由operation.homepage预渲染，轮播图、课程变更后后台重建，这里只读取一次redis
+        etag, body = get_homepage()
+        etag = quote_etag(etag)
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
 
 
 class AddFavViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
@@ -66,6 +67,10 @@ class AddFavViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.
     def get_queryset(self):
         return UserFavorite.objects.filter(user=self.request.user).select_related('user')
 
+    def perform_destroy(self, instance):
+        instance.delete()
+        UserFavorite.objects.clean_fav_cache(self.request.user)
+
     def obj_map(self, fav_type=None, fav_id=None):
         if int(fav_type) == 1:
             obj = get_object(Course, object_id=int(fav_id))
@@ -88,16 +93,18 @@ class AddFavViewSet(mixins.CreateModelMixin, mixins.DestroyModelMixin, viewsets.
             return Response(code=-1, msg='Fav id or Fav type is invalid.', status=status.HTTP_400_BAD_REQUEST)
 
         obj, serializer = self.obj_map(fav_type, fav_id)
-        exist_records = UserFavorite.objects.filter(user=request.user, fav_id=int(fav_id), fav_type=int(fav_type))
-        if exist_records:
+        # 直接删除，删除成功则表示用户取消收藏
+        deleted, _ = UserFavorite.objects.filter(user=request.user, fav_id=int(fav_id), fav_type=int(fav_type)).delete()
+        if deleted:
             # 记录已经存在， 则表示用户取消收藏, fav_nums减一
-            exist_records.delete()
+            UserFavorite.objects.clean_fav_cache(request.user)
             obj.modify_fav_nums(incr=False)
             return Response(status=status.HTTP_204_NO_CONTENT)
         else:
             # 记录不存在， 则表示用户收藏, fav_nums加一
             user_fav = UserFavorite()
             user_fav.create(user=request.user, fav_id=int(fav_id), fav_type=int(fav_type))
+            UserFavorite.objects.clean_fav_cache(request.user)
             # 收藏课程才通知
             if int(fav_type) == 1:
                 notification_handler(self.request.user, obj.user, 'L', obj, id_value=str(obj.id))
@@ -13,8 +13,9 @@ class OrgCityAdmin(object):
 
 
 class CourseOrgAdmin(object):
-    list_display = ['name', 'desc', 'click_nums', 'fav_nums']
+    list_display = ['name', 'desc', 'click_nums', 'fav_nums', 'course_nums', 'teacher_nums']
     search_fields = ['name', 'desc', 'click_nums', 'fav_nums']
+    readonly_fields = ['course_nums', 'teacher_nums']
     list_filter = ['name', 'desc', 'click_nums', 'fav_nums']
     relfield_style = 'fk-ajax'
     style_fields = {"desc": "ueditor"}
@@ -22,7 +23,8 @@ class CourseOrgAdmin(object):
 
 
 class TeacherAdmin(object):
-    list_display = ['org', 'name', 'work_years', 'work_company']
+    list_display = ['org', 'name', 'work_years', 'work_company', 'course_nums']
+    readonly_fields = ['course_nums']
     search_fields = ['org', 'name', 'work_years', 'work_company']
     list_filter = ['org', 'name', 'work_years', 'work_company']
     model_icon = 'fa fa-user-md'
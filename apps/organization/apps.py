@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class OrganizationConfig(AppConfig):
     name = 'organization'
     verbose_name = "机构管理"
+
+    def ready(self):
+        from . import signals, search_indexes
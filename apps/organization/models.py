@@ -3,6 +3,8 @@ from datetime import datetime
 
 from django.db import models
 from DjangoUeditor.models import UEditorField
+from lib.counters import click_counter
+from lib.utils import modify_counter
 
 
 class OrgCity(models.Model):
@@ -33,6 +35,7 @@ class CourseOrg(models.Model):
     city = models.ForeignKey(OrgCity, on_delete=models.CASCADE, verbose_name="所在城市")
     students = models.IntegerField(default=0, verbose_name="学习人数")
     course_nums = models.IntegerField(default=0, verbose_name="课程数")
+    teacher_nums = models.IntegerField(default=0, verbose_name="教师数")
     created_time = models.DateTimeField(db_index=True, auto_now_add=True, verbose_name="创建时间")
     updated_time = models.DateTimeField(auto_now=True, verbose_name="更新时间")
 
@@ -46,17 +49,14 @@ class CourseOrg(models.Model):
 
     def get_teacher_nums(self):
         #获取课程机构的教师数量
-        return self.teacher_set.all().count()
+        return self.teacher_nums
+
+    def add_click_nums(self):
+        self.click_nums = click_counter.incr(self)
+        return self.click_nums
 
     def modify_fav_nums(self, incr=True):
-        if incr:
-            self.fav_nums += 1
-        else:
-            self.fav_nums -= 1
-            if self.fav_nums < 0:
-                self.fav_nums = 0
-        self.save()
-        return self.fav_nums
+        return modify_counter(self, 'fav_nums', incr=incr)
 
 
 class Teacher(models.Model):
@@ -69,6 +69,7 @@ class Teacher(models.Model):
     click_nums = models.IntegerField(default=0, verbose_name="点击数")
     fav_nums = models.IntegerField(default=0, verbose_name="收藏数")
     age = models.IntegerField(default=18, verbose_name="年龄")
+    course_nums = models.IntegerField(default=0, verbose_name="课程数")
     image = models.ImageField(blank=True, null=True, upload_to="teacher/%Y/%m", verbose_name="头像", max_length=100)
     created_time = models.DateTimeField(db_index=True, auto_now_add=True, verbose_name="创建时间")
     updated_time = models.DateTimeField(auto_now=True, verbose_name="更新时间")
@@ -82,14 +83,11 @@ class Teacher(models.Model):
         return self.name
 
     def get_course_nums(self):
-        return self.course_set.all().count()
+        return self.course_nums
+
+    def add_click_nums(self):
+        self.click_nums = click_counter.incr(self)
+        return self.click_nums
 
     def modify_fav_nums(self, incr=True):
-        if incr:
-            self.fav_nums += 1
-        else:
-            self.fav_nums -= 1
-            if self.fav_nums < 0:
-                self.fav_nums = 0
-        self.save()
-        return self.fav_nums
+        return modify_counter(self, 'fav_nums', incr=incr)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from lib.search import SearchIndex, register
+from .models import CourseOrg, Teacher
+
+org_index = register(SearchIndex(
+    'org', CourseOrg,
+    fields={'name': 3, 'tag': 2, 'address': 1, 'desc': 1},
+    popularity_fields=('students', 'fav_nums'),
+))
+
+teacher_index = register(SearchIndex(
+    'teacher', Teacher,
+    fields={'name': 3, 'work_company': 1, 'work_position': 1, 'points': 1},
+    popularity_fields=('fav_nums', 'click_nums'),
+))
@@ -5,24 +5,25 @@ from rest_framework import serializers
 from django.db.models import Q
 
 from .models import CourseOrg, OrgCity, Teacher
+from lib.counters import CounterListSerializer
 
 
 class CourseOrgSerializer(serializers.ModelSerializer):
-    # 统计机构老师数量
-    teacher_nums = serializers.SerializerMethodField(read_only=True)
-
-    def get_teacher_nums(self, obj):
-        return obj.get_teacher_nums()
 
     class Meta:
         model = CourseOrg
         fields = "__all__"
+        # 课程数、教师数由courses.rollups统计
+        read_only_fields = ("course_nums", "teacher_nums")
+        list_serializer_class = CounterListSerializer
 
 
 class TeacherSerializer(serializers.ModelSerializer):
     class Meta:
         model = Teacher
         fields = "__all__"
+        read_only_fields = ("course_nums",)
+        list_serializer_class = CounterListSerializer
 
 
 class CitySerializer(serializers.ModelSerializer):
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db.models.signals import post_delete, post_save
+
+from .models import CourseOrg, Teacher
+from lib.keyconstructors import bump_instance_tags
+
+
+def org_changed(sender=None, instance=None, *args, **kwargs):
+    bump_instance_tags(instance)
+
+
+def teacher_changed(sender=None, instance=None, *args, **kwargs):
+    bump_instance_tags(instance, (CourseOrg, instance.org_id))
+
+
+post_save.connect(receiver=org_changed, sender=CourseOrg)
+post_delete.connect(receiver=org_changed, sender=CourseOrg)
+
+post_save.connect(receiver=teacher_changed, sender=Teacher)
+post_delete.connect(receiver=teacher_changed, sender=Teacher)
@@ -6,8 +6,8 @@ from rest_framework.permissions import IsAuthenticated, AllowAny, IsAuthenticate
 from .models import CourseOrg, OrgCity, Teacher
 from .serializers import CourseOrgSerializer, CitySerializer, TeacherSerializer
 from courses.models import Course
-from courses.serializers import CourseSerializer
-from lib.utils import BasePagination, get_object
+from courses.serializers import CourseSummarySerializer
+from lib.utils import BasePagination, ListResponseMixin, get_object
 from lib.response import Response
 from operation.models import UserFavorite
 
@@ -19,6 +19,7 @@ class OrgViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
     filter_fields = ("name", "category", 'city')
     search_fields = ("name", "desc")
+    search_index = 'org'
     ordering_fields = ("students", "click_nums", "_time", "course_nums")
     lookup_field = 'id'
 
@@ -33,17 +34,13 @@ class OrgViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
 
     def retrieve(self, request, *args, **kwargs):
         org = self.get_object()
-        org.click_nums += 1
-        org.save()
+        org.add_click_nums()
 
-        has_fav = False
-        if request.user.is_authenticated:
-            if UserFavorite.objects.filter(user=request.user, fav_id=org.id, fav_type=2):
-                has_fav = True
+        faved = UserFavorite.objects.get_faved(request.user, [(2, org.id)])
         serializer = self.get_serializer(org)
         return Response({
-            'course_org': serializer,
-            'has_fav': has_fav
+            'course_org': serializer.data,
+            'has_fav': bool(faved)
         })
 
 
@@ -60,7 +57,7 @@ class CityViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
         return OrgCity.objects.all()
 
 
-class TeacherViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
+class TeacherViewSet(ListResponseMixin, viewsets.ModelViewSet, viewsets.GenericViewSet):
     """
     机构教师
     """
@@ -69,51 +66,39 @@ class TeacherViewSet(viewsets.ModelViewSet, viewsets.GenericViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
     filter_fields = ("name", "work_company", 'work_position')
     search_fields = ("name",)
+    search_index = 'teacher'
     ordering_fields = ("click_nums",)
     lookup_field = 'id'
 
     def get_queryset(self):
-        return Teacher.objects.all().select_related('org')
+        return Teacher.objects.all().select_related('org').order_by('-created_time')
 
     def list(self, request, *args, **kwargs):
         org_id = request.query_params.get('org_id', -1)
 
         if int(org_id) > 0:
             course_org = get_object(CourseOrg, org_id)
-            has_fav = False
-            if request.user.is_authenticated:
-                if UserFavorite.objects.filter(user=request.user, fav_id=course_org.id, fav_type=2):
-                    has_fav = True
+            faved = UserFavorite.objects.get_faved(request.user, [(2, course_org.id)])
             teachers = course_org.teacher_set.all()
             teachers_serializer = self.get_serializer(teachers, many=True)
             return Response({
                 'teachers': teachers_serializer.data,
-                'has_fav': has_fav
+                'has_fav': bool(faved)
             })
         else:
-            teachers_serializer = self.get_serializer(self.get_queryset(), many=True)
-            return Response({
-                'teachers': teachers_serializer.data,
-            })
+            return self.list_response(self.filter_queryset(self.get_queryset()), key='teachers')
 
     def retrieve(self, request, *args, **kwargs):
         teacher = self.get_object()
+        teacher.add_click_nums()
         teacher_serializer = self.get_serializer(teacher)
-        teacher.click_nums += 1
-        teacher.save()
-        all_courses = Course.objects.filter(teacher=teacher)
-        courses_serializer = CourseSerializer(all_courses, many=True)
-
-        has_teacher_faved = False
-        has_org_faved = False
-        if request.user.is_authenticated:
-            if UserFavorite.objects.filter(user=request.user, fav_type=3, fav_id=teacher.id):
-                has_teacher_faved = True
-            if UserFavorite.objects.filter(user=request.user, fav_type=2, fav_id=teacher.org.id):
-                has_org_faved = True
+        all_courses = CourseSummarySerializer.sparse_queryset(Course.objects.filter(teacher=teacher), request)
+        courses_serializer = CourseSummarySerializer(all_courses, many=True, context={'request': request})
+
+        faved = UserFavorite.objects.get_faved(request.user, [(3, teacher.id), (2, teacher.org_id)])
         return Response({
             "teacher": teacher_serializer.data,
             "rel_courses": courses_serializer.data,
-            "has_teacher_faved": has_teacher_faved,
-            "has_org_faved": has_org_faved
+            "has_teacher_faved": (3, teacher.id) in faved,
+            "has_org_faved": (2, teacher.org_id) in faved
         })
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     name = 'users'
     verbose_name = u"用户信息"
+
+    def ready(self):
+        from . import signals
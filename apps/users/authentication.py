@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import router
+from django.utils.crypto import salted_hmac
+from django.utils.translation import ugettext as _
+from rest_framework import exceptions
+from rest_framework_jwt.authentication import JSONWebTokenAuthentication, jwt_get_username_from_payload
+from rest_framework_jwt.utils import jwt_payload_handler as base_jwt_payload_handler
+
+from lib.localcache import LocalLRUCache
+
+User = get_user_model()
+
+USER_SNAPSHOT_KEY = 'jwt_user:%s'
+# 用户快照代数，用户变更时更新；快照记录写入前读到的代数，与当前代数不一致时作废，
+# 避免变更前从数据库读到的旧快照在清除之后才写入redis
+USER_GENERATION_KEY = 'jwt_user_gen:%s'
+USER_CACHE = getattr(settings, 'JWT_USER_CACHE', {})
+_local_users = LocalLRUCache(maxsize=USER_CACHE.get('LOCAL_SIZE', 1000), timeout=USER_CACHE.get('LOCAL_TIMEOUT', 10))
+
+
+def get_token_version(user):
+    """令牌版本，由密码hash派生，修改、重置密码后之前签发的令牌失效"""
+    return salted_hmac('users.authentication.token_version', user.password).hexdigest()[:8]
+
+
+def jwt_payload_handler(user):
+    """在默认payload中加入令牌版本ver"""
+    payload = base_jwt_payload_handler(user)
+    payload['ver'] = get_token_version(user)
+    return payload
+
+
+def get_snapshot_fields():
+    # 快照不包含密码hash，读取user.password时再单独查询
+    return [field.attname for field in User._meta.concrete_fields if field.attname != 'password']
+
+
+def make_user_snapshot(user, generation=None):
+    """用户快照：(令牌版本, 除密码外各字段值, 代数)"""
+    return get_token_version(user), tuple(getattr(user, attname) for attname in get_snapshot_fields()), generation
+
+
+def get_user_snapshot(user_id, local=True):
+    """依次从进程内LRU、redis、数据库读取用户快照，用户不存在返回None"""
+    key = USER_SNAPSHOT_KEY % user_id
+    snapshot = _local_users.get(key) if local else None
+    if snapshot is not None:
+        return snapshot
+    generation_key = USER_GENERATION_KEY % user_id
+    # 快照与代数一次读取，代数一致的快照才有效
+    cached = cache.get_many([key, generation_key])
+    snapshot, generation = cached.get(key), cached.get(generation_key)
+    if snapshot is None or len(snapshot) != 3 or snapshot[2] != generation:
+        user = User._default_manager.filter(pk=user_id).first()
+        if user is None:
+            return None
+        snapshot = make_user_snapshot(user, generation)
+        cache.set(key, snapshot, USER_CACHE.get('TIMEOUT', 60 * 60))
+    _local_users.set(key, snapshot)
+    return snapshot
+
+
+def clear_user_snapshot(user_id):
+    """用户变更事务提交后调用，更新代数使提交前读到的快照全部作废"""
+    key = USER_SNAPSHOT_KEY % user_id
+    _local_users.delete(key)
+    # 代数比快照多保留一倍时间，快照过期前代数不会先过期
+    cache.set(USER_GENERATION_KEY % user_id, uuid.uuid4().hex, USER_CACHE.get('TIMEOUT', 60 * 60) * 2)
+    cache.delete(key)
+
+
+def hydrate_user(snapshot):
+    """由快照构造已保存的用户实例，password为延迟字段"""
+    return User.from_db(router.db_for_read(User), get_snapshot_fields(), snapshot[1])
+
+
+class CachedJSONWebTokenAuthentication(JSONWebTokenAuthentication):
+    """
+    JWT认证，按payload中的user_id读取用户快照构造request.user，命中缓存时不查询数据库。
+    用户保存、删除后清除redis中的快照；其他进程LRU中的快照最多保留LOCAL_TIMEOUT秒，
+    令牌版本与LRU快照不一致时以redis为准，仍不一致说明密码已修改，令牌失效
+    """
+
+    def authenticate_credentials(self, payload):
+        user_id = payload.get('user_id')
+        username = jwt_get_username_from_payload(payload)
+        if not user_id or not username:
+            raise exceptions.AuthenticationFailed(_('Invalid payload.'))
+
+        # 升级前签发的令牌没有ver，不校验版本
+        version = payload.get('ver')
+        snapshot = get_user_snapshot(user_id)
+        if snapshot is not None and version is not None and snapshot[0] != version:
+            snapshot = get_user_snapshot(user_id, local=False)
+        if snapshot is None:
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+        if version is not None and snapshot[0] != version:
+            raise exceptions.AuthenticationFailed(_('Signature has expired.'))
+
+        user = hydrate_user(snapshot)
+        if user.get_username() != username:
+            raise exceptions.AuthenticationFailed(_('Invalid signature.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User account is disabled.'))
+        return user
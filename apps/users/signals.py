@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
 __author__ = 'wuhai'
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
 
+from .authentication import clear_user_snapshot
+
 User = get_user_model()
 
 
@@ -14,3 +17,13 @@ User = get_user_model()
 #         password = instance.password
 #         instance.set_password(password)
 #         instance.save()
+
+
+def user_changed(sender=None, instance=None, *args, **kwargs):
+    # 修改资料、密码、禁用、删除后清除JWT认证使用的用户快照
+    user_id = instance.pk
+    transaction.on_commit(lambda: clear_user_snapshot(user_id))
+
+
+post_save.connect(receiver=user_changed, sender=User)
+post_delete.connect(receiver=user_changed, sender=User)
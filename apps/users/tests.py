@@ -1,3 +1,48 @@
-from django.test import TestCase
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from redis_sessions.session import RedisServer
+
+
+class SessionHashRingTest(SimpleTestCase):
+    keys = ['session%05d' % i for i in range(4000)]
+
+    def setUp(self):
+        self.server = RedisServer('session')
+
+    def assign(self, pool):
+        return {key: self.server.get_server(key, pool)[0] for key in self.keys}
+
+    def test_balanced(self):
+        pool = [{'host': 'redis%d' % i} for i in range(4)]
+        assigned = self.assign(pool)
+        # 同一key总是分配到同一台服务器
+        self.assertEqual(assigned, self.assign(pool))
+        for server_key in range(len(pool)):
+            share = list(assigned.values()).count(server_key) / len(self.keys)
+            self.assertGreater(share, 0.15)
+            self.assertLess(share, 0.35)
+
+    def test_add_server(self):
+        pool = [{'host': 'redis%d' % i} for i in range(3)]
+        before = self.assign(pool)
+        after = self.assign(pool + [{'host': 'redis3'}])
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # 只有新服务器弧段上的session迁移，且都迁移到新服务器
+        self.assertTrue(all(after[key] == 3 for key in moved))
+        self.assertLess(len(moved) / len(self.keys), 0.35)
+
+    def test_remove_server(self):
+        pool = [{'host': 'redis%d' % i} for i in range(4)]
+        before = self.assign(pool)
+        after = self.assign(pool[:2] + pool[3:])
+        # 移除redis2后，其余服务器上的session不迁移
+        for key in self.keys:
+            if before[key] != 2:
+                self.assertEqual(pool[before[key]], (pool[:2] + pool[3:])[after[key]])
+
+    def test_weight(self):
+        pool = [{'host': 'redis0', 'weight': 3}, {'host': 'redis1'}]
+        shares = list(self.assign(pool).values())
+        self.assertGreater(shares.count(0), shares.count(1) * 2)
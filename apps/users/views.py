@@ -4,11 +4,11 @@ import re
 from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from rest_framework import mixins, viewsets, status, authentication
-from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAuthenticated, AllowAny, SAFE_METHODS
+from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework_jwt.serializers import jwt_encode_handler, jwt_payload_handler
-from rest_framework_jwt.authentication import JSONWebTokenAuthentication
 
+from .authentication import CachedJSONWebTokenAuthentication
 from .serializers import UserRegSerializer, UserSerializer, ResetPwdSerializer, \
     ModifyPwdSerializer, EmailModifySerializer
 from courses.serializers import CourseSerializer
@@ -42,10 +42,14 @@ class UserView(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.Update
     """
     serializer_class = UserSerializer
     queryset = User.objects.all()
-    authentication_classes = (JSONWebTokenAuthentication, authentication.SessionAuthentication)
+    authentication_classes = (CachedJSONWebTokenAuthentication, authentication.SessionAuthentication)
 
     def get_object(self):
-        obj = get_object(User, self.request.user.id)
+        # 读取个人信息时直接使用认证时构造的request.user，不再查询；
+        # request.user可能来自滞后的快照，修改时从数据库重新读取，避免save写回旧字段覆盖并发修改
+        obj = self.request.user
+        if self.request.method not in SAFE_METHODS:
+            obj = User.objects.get(pk=obj.pk)
         self.check_object_permissions(self.request, obj)  # 单一资源检查权限
         return obj
 
@@ -87,7 +91,8 @@ class ModifyPwdView(mixins.UpdateModelMixin, viewsets.GenericViewSet):
     permission_classes = (IsAuthenticated,)
 
     def get_object(self):
-        obj = get_object(User, self.request.user.id)
+        # request.user可能来自滞后的快照，从数据库重新读取后修改
+        obj = User.objects.get(pk=self.request.user.pk)
         self.check_object_permissions(self.request, obj)
         return obj
 
@@ -112,7 +117,8 @@ class ModifyEmailView(mixins.UpdateModelMixin, viewsets.GenericViewSet):
     permission_classes = (IsAuthenticated,)
 
     def get_object(self):
-        obj = get_object(User, self.request.user.id)
+        # request.user可能来自滞后的快照，从数据库重新读取后修改
+        obj = User.objects.get(pk=self.request.user.pk)
         self.check_object_permissions(self.request, obj)
         return obj
 
@@ -138,7 +144,9 @@ class UserFavCourseView(mixins.ListModelMixin, viewsets.GenericViewSet):
     pagination_class = BasePagination
 
     def get_queryset(self):
-        return UserFavorite.objects.filter(user=self.request.user).get_fav_courses()
+        queryset = UserFavorite.objects.filter(user=self.request.user).get_fav_courses() \
+            .select_related('org', 'user', 'teacher').with_details()
+        return CourseSerializer.sparse_queryset(queryset, self.request)
 
 
 class UserFavOrgView(UserFavCourseView):
@@ -148,7 +156,7 @@ class UserFavOrgView(UserFavCourseView):
     serializer_class = CourseOrgSerializer
 
     def get_queryset(self):
-        return UserFavorite.objects.filter(user=self.request.user).get_fav_orgs()
+        return UserFavorite.objects.filter(user=self.request.user).get_fav_orgs().select_related('city')
 
 
 class UserFavTeacherView(UserFavCourseView):
@@ -158,7 +166,7 @@ class UserFavTeacherView(UserFavCourseView):
     serializer_class = TeacherSerializer
 
     def get_queryset(self):
-        return UserFavorite.objects.filter(user=self.request.user.id).get_fav_teachers()
+        return UserFavorite.objects.filter(user=self.request.user.id).get_fav_teachers().select_related('org')
 
 
 class UserMessageView(mixins.ListModelMixin, viewsets.GenericViewSet):
@@ -177,13 +185,20 @@ class UserMessageView(mixins.ListModelMixin, viewsets.GenericViewSet):
         page = self.paginate_queryset(all_msg)
 
         if page is not None:
-            msg_serializer = self.get_serializer(page, many=True)
+            messages = self.get_paginated_response(self.get_serializer(page, many=True).data).data
         else:
-            msg_serializer = self.get_serializer(all_msg, many=True)
+            messages = self.get_serializer(all_msg, many=True).data
         # 用户进入个人消息后清空未读消息的记录
-        UserMessage.objects.clean_unread_msgs()
+        UserMessage.objects.clean_unread_msgs(request.user)
         return Response({
-            "messages": msg_serializer.data
+            "messages": messages
+        }, status=status.HTTP_200_OK)
+
+    @action(methods=['GET'], detail=False, url_path='unread', url_name='unread')
+    def unread(self, request, *args, **kwargs):
+        # 未读消息数优先读取redis计数，不存在时统计一次
+        return Response({
+            "unread_nums": UserMessage.objects.get_unread_msg_nums(request.user)
         }, status=status.HTTP_200_OK)
 
 
@@ -1,128 +1,228 @@
 import redis
+from bisect import bisect
+from collections import namedtuple
 from datetime import datetime, timedelta
+from hashlib import md5
 
 try:
     from django.utils.encoding import force_unicode
 except ImportError:  # Python 3.*
     from django.utils.encoding import force_str as force_unicode
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+from django.core.exceptions import ImproperlyConfigured
 from django.utils import timezone
-from django.contrib.sessions.backends.base import SessionBase, CreateError
+from django.contrib.sessions.backends.base import SessionBase, CreateError, VALID_KEY_CHARS
+from django.utils.crypto import get_random_string
 from redis_sessions import settings
 
 
+# Connection options of one server, never modified once built
+ServerOptions = namedtuple('ServerOptions', 'host port db password url unix_domain_socket_path')
+
+
 class RedisServer():
+    """
+    Resolves the connection of a session key.
+
+    Every server gets one connection, built on first use from its own
+    ServerOptions. With SESSION_REDIS_POOL the server is picked on a
+    consistent hash ring of the whole session key, so adding or removing a
+    server only moves the sessions on its own arcs of the ring.
+    """
     __redis = {}
+    __ring = None
 
     def __init__(self, session_key):
         self.session_key = session_key
-        self.connection_key = ''
 
-        if settings.SESSION_REDIS_SENTINEL_LIST is not None:
-            self.connection_type = 'sentinel'
         if settings.SESSION_REDIS_CONNECTION_OBJECT is not None:
             self.connection_type = 'connection_object'
+            self.connection_key = self.connection_type
+            return
+        if settings.SESSION_REDIS_SENTINEL_LIST is not None:
+            self.connection_type = 'sentinel'
+            self.connection_key = self.connection_type
+            self.options = self.get_options({})
+            return
+
+        if settings.SESSION_REDIS_POOL is not None:
+            server_key, server = self.get_server(session_key, settings.SESSION_REDIS_POOL)
+            self.connection_key = str(server_key)
+            self.options = self.get_options(server)
         else:
-            if settings.SESSION_REDIS_POOL is not None:
-                server_key, server = self.get_server(session_key, settings.SESSION_REDIS_POOL)
-                self.connection_key = str(server_key)
-                settings.SESSION_REDIS_HOST = getattr(server, 'host', 'localhost')
-                settings.SESSION_REDIS_PORT = getattr(server, 'port', 6379)
-                settings.SESSION_REDIS_DB = getattr(server, 'db', 0)
-                settings.SESSION_REDIS_PASSWORD = getattr(server, 'password', None)
-                settings.SESSION_REDIS_URL = getattr(server, 'url', None)
-                settings.SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH = getattr(server,'unix_domain_socket_path', None)
-
-            if settings.SESSION_REDIS_URL is not None:
-                self.connection_type = 'redis_url'
-            elif settings.SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH is not None:
-                self.connection_type = 'redis_unix_url'
-            elif settings.SESSION_REDIS_HOST is not None:
-                self.connection_type = 'redis_host'
+            self.connection_key = ''
+            self.options = self.get_options(None)
 
+        if self.options.url is not None:
+            self.connection_type = 'redis_url'
+        elif self.options.unix_domain_socket_path is not None:
+            self.connection_type = 'redis_unix_url'
+        else:
+            self.connection_type = 'redis_host'
         self.connection_key += self.connection_type
 
+    @staticmethod
+    def get_options(server):
+        """Options of a pool entry, or of the SESSION_REDIS_* settings when server is None."""
+        if server is None:
+            return ServerOptions(
+                settings.SESSION_REDIS_HOST, settings.SESSION_REDIS_PORT, settings.SESSION_REDIS_DB,
+                settings.SESSION_REDIS_PASSWORD, settings.SESSION_REDIS_URL,
+                settings.SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH)
+        return ServerOptions(
+            server.get('host', 'localhost'), server.get('port', 6379), server.get('db', settings.SESSION_REDIS_DB),
+            server.get('password', None), server.get('url', None), server.get('unix_domain_socket_path', None))
+
+    @classmethod
+    def get_ring(cls, servers_pool):
+        """Sorted (points, server indexes) of the pool, weight * SESSION_REDIS_POOL_VNODES points per server."""
+        if cls.__ring is None or cls.__ring[0] is not servers_pool:
+            nodes = []
+            for server_key, server in enumerate(servers_pool):
+                options = cls.get_options(server)
+                name = options.url or options.unix_domain_socket_path or '%s:%s/%s' % (
+                    options.host, options.port, options.db)
+                for i in range(server.get('weight', 1) * settings.SESSION_REDIS_POOL_VNODES):
+                    nodes.append((cls.hash('%s-%d' % (name, i)), server_key))
+            nodes.sort()
+            cls.__ring = (servers_pool, [point for point, server_key in nodes],
+                          [server_key for point, server_key in nodes])
+        return cls.__ring[1], cls.__ring[2]
+
+    @staticmethod
+    def hash(value):
+        return int(md5(value.encode('utf-8')).hexdigest()[:16], 16)
+
     def get_server(self, key, servers_pool):
-        total_weight = sum([row.get('weight', 1) for row in servers_pool])
-        pos = 0
-        for i in range(3, -1, -1):
-            pos = pos * 2 ** 8 + ord(key[i])
-        pos = pos % total_weight
-
-        pool = iter(servers_pool)
-        server = next(pool)
-        server_key = 0
-        i = 0
-        while i < total_weight:
-            if i <= pos < (i + server.get('weight', 1)):
-                return server_key, server
-            i += server.get('weight', 1)
-            server = next(pool)
-            server_key += 1
-
-        return
+        points, server_keys = self.get_ring(servers_pool)
+        server_key = server_keys[bisect(points, self.hash(key)) % len(points)]
+        return server_key, servers_pool[server_key]
 
     def get(self):
         if self.connection_key in self.__redis:
             return self.__redis[self.connection_key]
 
         if self.connection_type == 'connection_object':
-            self.__redis[self.connection_key] = settings.SESSION_REDIS_CONNECTION_OBJECT
+            connection = settings.SESSION_REDIS_CONNECTION_OBJECT
         elif self.connection_type == 'sentinel':
             from redis.sentinel import Sentinel
-            self.__redis[self.connection_key] = Sentinel(
+            connection = Sentinel(
                 settings.SESSION_REDIS_SENTINEL_LIST,
                 socket_timeout=settings.SESSION_REDIS_SOCKET_TIMEOUT,
                 retry_on_timeout=settings.SESSION_REDIS_RETRY_ON_TIMEOUT,
-                db=getattr(settings, 'SESSION_REDIS_DB', 0),
-                password=getattr(settings, 'SESSION_REDIS_PASSWORD', None)
+                db=self.options.db,
+                password=self.options.password
             ).master_for(settings.SESSION_REDIS_SENTINEL_MASTER_ALIAS)
-
         elif self.connection_type == 'redis_url':
-            self.__redis[self.connection_key] = redis.StrictRedis.from_url(
-                settings.SESSION_REDIS_URL,
+            connection = redis.StrictRedis.from_url(
+                self.options.url,
                 socket_timeout=settings.SESSION_REDIS_SOCKET_TIMEOUT
             )
         elif self.connection_type == 'redis_host':
-            self.__redis[self.connection_key] = redis.StrictRedis(
-                host=settings.SESSION_REDIS_HOST,
-                port=settings.SESSION_REDIS_PORT,
+            connection = redis.StrictRedis(
+                host=self.options.host,
+                port=self.options.port,
                 socket_timeout=settings.SESSION_REDIS_SOCKET_TIMEOUT,
                 retry_on_timeout=settings.SESSION_REDIS_RETRY_ON_TIMEOUT,
-                db=settings.SESSION_REDIS_DB,
-                password=settings.SESSION_REDIS_PASSWORD
+                db=self.options.db,
+                password=self.options.password
             )
-        elif self.connection_type == 'redis_unix_url':
-            self.__redis[self.connection_key] = redis.StrictRedis(
-                unix_socket_path=settings.SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH,
+        else:
+            connection = redis.StrictRedis(
+                unix_socket_path=self.options.unix_domain_socket_path,
                 socket_timeout=settings.SESSION_REDIS_SOCKET_TIMEOUT,
                 retry_on_timeout=settings.SESSION_REDIS_RETRY_ON_TIMEOUT,
-                db=settings.SESSION_REDIS_DB,
-                password=settings.SESSION_REDIS_PASSWORD,
+                db=self.options.db,
+                password=self.options.password,
             )
 
-        return self.__redis[self.connection_key]
+        # concurrent first uses may both build a client, the last one wins
+        self.__redis[self.connection_key] = connection
+        return connection
 
 
 class SessionStore(SessionBase):
     """
     Implements Redis database session store.
+
+    The session is read on first access. A session which was read and not
+    modified is saved with a single EXPIRE instead of being encoded and
+    written again, new sessions are created atomically with SET NX EX.
     """
+    # connections without GETEX (Redis < 6.2)
+    no_getex = set()
+
     def __init__(self, session_key=None):
         super(SessionStore, self).__init__(session_key)
-        self.server = RedisServer(session_key).get()
+        if settings.SESSION_REDIS_SERIALIZER == 'msgpack' and msgpack is None:
+            raise ImproperlyConfigured("SESSION_REDIS['serializer'] = 'msgpack' requires the msgpack package.")
+        # the session was read from redis and still holds the stored data
+        self._loaded = False
+
+    @property
+    def server(self):
+        return self.get_server(self._get_or_create_session_key())
+
+    @staticmethod
+    def get_server(session_key):
+        return RedisServer(session_key).get()
+
+    def get_session_data(self, session_key):
+        """Stored data of the session, refreshing its expiry when SESSION_REDIS_SLIDING_EXPIRY is set."""
+        server = self.get_server(session_key)
+        key = self.get_real_stored_key(session_key)
+        if not settings.SESSION_REDIS_SLIDING_EXPIRY:
+            return server.get(key)
+        age = self.get_expiry_age()
+        if id(server) not in self.no_getex:
+            try:
+                return server.execute_command('GETEX', key, 'EX', age)
+            except redis.ResponseError as e:
+                if 'unknown command' not in str(e).lower():
+                    raise
+                self.no_getex.add(id(server))
+        pipe = server.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.expire(key, age)
+        return pipe.execute()[0]
 
     def load(self):
         try:
-            session_data = self.server.get(
-                self.get_real_stored_key(self._get_or_create_session_key())
-            )
-            return self.decode(force_unicode(session_data))
+            session_data = self.get_session_data(self._get_or_create_session_key())
         except:
+            session_data = None
+        if session_data is None:
+            # unknown or expired key, a new key is generated on save
             self._session_key = None
             return {}
+        self._loaded = True
+        return self.decode(session_data)
+
+    def encode(self, session_dict):
+        if settings.SESSION_REDIS_SERIALIZER == 'msgpack':
+            # redis is trusted storage, like the cache session backend the data is not signed
+            return msgpack.packb(session_dict, use_bin_type=True)
+        return super(SessionStore, self).encode(session_dict)
+
+    def decode(self, session_data):
+        if settings.SESSION_REDIS_SERIALIZER == 'msgpack':
+            try:
+                session = msgpack.unpackb(session_data, raw=False)
+            except Exception:
+                # also sessions written with the default encoding before switching
+                return {}
+            return session if isinstance(session, dict) else {}
+        return super(SessionStore, self).decode(force_unicode(session_data))
 
     def exists(self, session_key):
-        return self.server.exists(self.get_real_stored_key(session_key))
+        return self.get_server(session_key).exists(self.get_real_stored_key(session_key))
+
+    def _get_new_session_key(self):
+        # SET NX in save(must_create=True) rejects existing keys, no EXISTS round trip
+        return get_random_string(32, VALID_KEY_CHARS)
 
     def create(self):
         while True:
@@ -160,24 +260,17 @@ class SessionStore(SessionBase):
     def save(self, must_create=False):
         if self.session_key is None:
             return self.create()
-        if must_create and self.exists(self._get_or_create_session_key()):
-            raise CreateError
+        age = self.get_expiry_age()
+        if not must_create and not self.modified and (self._loaded or not hasattr(self, '_session_cache')):
+            # unchanged session, only slide the expiry; EXPIRE fails when the key is gone
+            if self.server.expire(self.get_real_stored_key(self.session_key), age):
+                return
         data = self.encode(self._get_session(no_load=must_create))
-        if redis.VERSION[0] >= 2:
-            self.server.setex(
-                self.get_real_stored_key(self._get_or_create_session_key()),
-                self.get_expiry_age(),
-                data
-            )
-        else:
-            self.server.set(
-                self.get_real_stored_key(self._get_or_create_session_key()),
-                data
-            )
-            self.server.expire(
-                self.get_real_stored_key(self._get_or_create_session_key()),
-                self.get_expiry_age()
-            )
+        if self.session_key is None:
+            # the key expired before the session was loaded
+            return self.create()
+        if not self.server.set(self.get_real_stored_key(self.session_key), data, ex=age, nx=must_create):
+            raise CreateError
 
     def delete(self, session_key=None):
         if session_key is None:
@@ -185,7 +278,7 @@ class SessionStore(SessionBase):
                 return
             session_key = self.session_key
         try:
-            self.server.delete(self.get_real_stored_key(session_key))
+            self.get_server(session_key).delete(self.get_real_stored_key(session_key))
         except:
             pass
 
@@ -13,6 +13,12 @@ SESSION_REDIS_PREFIX = SESSION_REDIS.get('prefix', '')
 SESSION_REDIS_PASSWORD = SESSION_REDIS.get('password', None)
 SESSION_REDIS_UNIX_DOMAIN_SOCKET_PATH = SESSION_REDIS.get('unix_domain_socket_path', None)
 SESSION_REDIS_URL = SESSION_REDIS.get('url', None)
+# 'msgpack' stores the session dict as raw msgpack instead of Django's signed base64 encoding
+SESSION_REDIS_SERIALIZER = SESSION_REDIS.get('serializer', None)
+# Refresh the expiry when a session is read, with GETEX on Redis >= 6.2
+SESSION_REDIS_SLIDING_EXPIRY = SESSION_REDIS.get('sliding_expiry', False)
+# Points per unit of weight on the consistent hash ring of SESSION_REDIS_POOL
+SESSION_REDIS_POOL_VNODES = SESSION_REDIS.get('vnodes', 160)
 
 
 """
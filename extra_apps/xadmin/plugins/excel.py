@@ -1,20 +1,80 @@
 # coding:utf-8
 
 import xadmin
-from xadmin.views import BaseAdminPlugin, ListAdminView
+from django.core.exceptions import PermissionDenied, ValidationError
 from django.template import loader
+from django.template.response import TemplateResponse
+from xadmin.views import BaseAdminPlugin, ListAdminView, ModelAdminView
+from xadmin.views.base import csrf_protect_m, filter_hook
 from xadmin.plugins.utils import get_context_dict
 
 
 #excel 导入
 class ListImportExcelPlugin(BaseAdminPlugin):
-    import_excel = False
 
     def init_request(self, *args, **kwargs):
-        return bool(self.import_excel)
+        # import_excel为lib.importer.ModelImporter的子类，类属性不会合并到插件，从admin_view读取
+        return bool(getattr(self.admin_view, 'import_excel', None))
 
     def block_top_toolbar(self, context, nodes):
-        nodes.append(loader.render_to_string('xadmin/excel/model_list.top_toolbar.import.html', context=get_context_dict(context)))
+        context = get_context_dict(context)
+        context['import_excel_url'] = self.admin_view.model_admin_url('import_excel')
+        nodes.append(loader.render_to_string('xadmin/excel/model_list.top_toolbar.import.html', context=context))
 
 
-xadmin.site.register_plugin(ListImportExcelPlugin, ListAdminView)
\ No newline at end of file
+class ImportExcelView(ModelAdminView):
+    """上传xlsx/xls/csv文件，勾选预览时只生成差异报告，否则分批写入后显示导入报告"""
+    # lib.importer.ModelImporter的子类
+    import_excel = None
+    import_template = 'xadmin/excel/import_report.html'
+
+    def init_request(self, *args, **kwargs):
+        if not self.import_excel or not (self.has_add_permission() and self.has_change_permission()):
+            raise PermissionDenied
+
+    def get_importer(self):
+        return self.import_excel(user=self.user)
+
+    def get_context(self):
+        importer_class = self.import_excel
+        context = super(ImportExcelView, self).get_context()
+        context.update({
+            'title': u"导入%s" % self.opts.verbose_name,
+            'fields': [importer_class.model._meta.get_field(name).verbose_name for name in importer_class.fields],
+            'key_fields': [importer_class.model._meta.get_field(name).verbose_name
+                           for name in importer_class.key_fields],
+            'list_url': self.model_admin_url('changelist'),
+        })
+        return context
+
+    @filter_hook
+    def get(self, request, *args, **kwargs):
+        return TemplateResponse(request, self.import_template, self.get_context())
+
+    @filter_hook
+    @csrf_protect_m
+    def post(self, request, *args, **kwargs):
+        context = self.get_context()
+        file = request.FILES.get('excel')
+        if file is None:
+            context['error'] = u"请选择需要导入的文件"
+            return TemplateResponse(request, self.import_template, context)
+
+        try:
+            report = self.get_importer().run(file, name=file.name, dry_run=request.POST.get('dry_run') == 'on')
+        except ValidationError as e:
+            context['error'] = ' '.join(e.messages)
+            return TemplateResponse(request, self.import_template, context)
+        except Exception as e:
+            context['error'] = u"导入失败: %s" % e
+            return TemplateResponse(request, self.import_template, context)
+
+        if not report.dry_run:
+            self.message_user(u"导入完成，新增 %(new)d 条，修改 %(update)d 条，未变化 %(skip)d 条，出错 %(error)d 条"
+                              % report.counts, 'warning' if report.counts['error'] else 'success')
+        context['report'] = report
+        return TemplateResponse(request, self.import_template, context)
+
+
+xadmin.site.register_plugin(ListImportExcelPlugin, ListAdminView)
+xadmin.site.register_modelview(r'^import_excel/$', ImportExcelView, name='%s_%s_import_excel')
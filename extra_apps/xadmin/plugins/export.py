@@ -1,21 +1,29 @@
 import io
+import csv
 import datetime
 import sys
+import tempfile
+from decimal import Decimal
 from future.utils import iteritems
 
-from django.http import HttpResponse
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
 from django.template import loader
 from django.utils import six
 from django.utils.encoding import force_text, smart_text
 from django.utils.html import escape
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 from django.utils.xmlutils import SimplerXMLGenerator
 from django.db.models import BooleanField, NullBooleanField
 
+from lib.utils import ListResponseMixin
+from xadmin.plugins.exportjob import submit_export_job
 from xadmin.plugins.utils import get_context_dict
 from xadmin.sites import site
 from xadmin.views import BaseAdminPlugin, ListAdminView
-from xadmin.util import json
+from xadmin.util import json, lookup_field
 from xadmin.views.list import ALL_VAR
 
 try:
@@ -33,9 +41,9 @@ except:
 
 class ExportMenuPlugin(BaseAdminPlugin):
 
-    list_export = ('xlsx', 'xls', 'csv', 'xml', 'json')
+    list_export = ('xlsx', 'xls', 'csv', 'xml', 'json', 'jsonl')
     export_names = {'xlsx': 'Excel 2007', 'xls': 'Excel', 'csv': 'CSV',
-                    'xml': 'XML', 'json': 'JSON'}
+                    'xml': 'XML', 'json': 'JSON', 'jsonl': 'JSON Lines'}
 
     def init_request(self, *args, **kwargs):
         self.list_export = [
@@ -53,15 +61,33 @@ class ExportMenuPlugin(BaseAdminPlugin):
                                                  context=get_context_dict(context)))
 
 
-class ExportPlugin(BaseAdminPlugin):
+class ExportPlugin(ListResponseMixin, BaseAdminPlugin):
 
     export_mimes = {'xlsx': 'application/vnd.ms-excel',
                     'xls': 'application/vnd.ms-excel', 'csv': 'text/csv',
-                    'xml': 'application/xhtml+xml', 'json': 'application/json'}
+                    'xml': 'application/xhtml+xml', 'json': 'application/json',
+                    'jsonl': 'application/x-ndjson'}
+
+    # Export types written chunk by chunk when exporting all data, the
+    # other types still build the whole result list in memory. Chunks come
+    # from ListResponseMixin.iter_chunks, which reads keyset chunks with one
+    # bounded query each.
+    stream_export_types = ('csv', 'json', 'jsonl', 'xlsx')
+    export_chunk_size = 2000
+    # Called with the number of rows written so far after each chunk,
+    # set by background export jobs to report progress.
+    export_progress = None
 
     def init_request(self, *args, **kwargs):
         return self.request.GET.get('_do_') == 'export'
 
+    @property
+    def export_type(self):
+        return self.request.GET.get('export_type', 'csv')
+
+    def is_stream_export(self):
+        return self.request.GET.get('all', 'off') == 'on' and self.export_type in self.stream_export_types
+
     def _format_value(self, o):
         if (o.field is None and getattr(o.attr, 'boolean', False)) or \
            (o.field and isinstance(o.field, (BooleanField, NullBooleanField))):
@@ -218,20 +244,150 @@ class ExportPlugin(BaseAdminPlugin):
         return json.dumps({'objects': results}, ensure_ascii=False,
                           indent=(self.request.GET.get('export_json_format', 'off') == 'on') and 4 or None)
 
+    def _get_file_name(self):
+        return self.opts.verbose_name.replace(' ', '_')
+
+    def _set_disposition(self, response, file_type):
+        response['Content-Disposition'] = ('attachment; filename=%s.%s' % (
+            self._get_file_name(), file_type)).encode('utf-8')
+        return response
+
     def get_response(self, response, context, *args, **kwargs):
-        file_type = self.request.GET.get('export_type', 'csv')
+        file_type = self.export_type
         response = HttpResponse(
             content_type="%s; charset=UTF-8" % self.export_mimes[file_type])
-
-        file_name = self.opts.verbose_name.replace(' ', '_')
-        response['Content-Disposition'] = ('attachment; filename=%s.%s' % (
-            file_name, file_type)).encode('utf-8')
+        self._set_disposition(response, file_type)
 
         response.write(getattr(self, 'get_%s_export' % file_type)(context))
         return response
 
+    def get_jsonl_export(self, context):
+        return ''.join(json.dumps(obj, ensure_ascii=False) + '\n' for obj in self._get_objects(context))
+
+    # Streaming export of all data
+
+    def _get_export_columns(self):
+        """[(field_name, header text)] of the exported list_display columns."""
+        return [(c.field_name, force_text(c.text)) for c in self.admin_view.result_headers().cells if c.export]
+
+    def _export_value(self, obj, field_name):
+        """Raw value of a column, without building the ResultItem display graph."""
+        try:
+            f, attr, value = lookup_field(field_name, obj, self.admin_view)
+        except (AttributeError, ObjectDoesNotExist):
+            return None
+        if f is not None:
+            if f.many_to_many:
+                return ', '.join(force_text(o) for o in value.all())
+            if f.flatchoices:
+                value = dict(f.flatchoices).get(value, value)
+        if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+            return timezone.localtime(value).replace(tzinfo=None)
+        if value is None or isinstance(value, (bool, int, float, Decimal, datetime.date, datetime.time, str)):
+            return value
+        return force_text(value)
+
+    def _iter_rows(self, columns):
+        prefetches = []
+        for field_name, text in columns:
+            try:
+                if self.opts.get_field(field_name).many_to_many:
+                    prefetches.append(field_name)
+            except FieldDoesNotExist:
+                pass
+        done = 0
+        for chunk in self.iter_chunks(self.admin_view.list_queryset.prefetch_related(*prefetches)):
+            for obj in chunk:
+                yield [self._export_value(obj, field_name) for field_name, text in columns]
+            done += len(chunk)
+            if self.export_progress is not None:
+                self.export_progress(done)
+
+    def stream_csv_export(self, columns):
+        class Echo(object):
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+        if self.request.GET.get('export_csv_header', 'off') == 'on':
+            yield writer.writerow([text for field_name, text in columns])
+        for row in self._iter_rows(columns):
+            yield writer.writerow(row)
+
+    def stream_jsonl_export(self, columns):
+        headers = [text for field_name, text in columns]
+        for row in self._iter_rows(columns):
+            yield json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+    def stream_json_export(self, columns):
+        headers = [text for field_name, text in columns]
+        indent = (self.request.GET.get('export_json_format', 'off') == 'on') and 4 or None
+        yield '{"objects": ['
+        for i, row in enumerate(self._iter_rows(columns)):
+            yield (i and ', ' or '') + json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder,
+                                                  ensure_ascii=False, indent=indent)
+        yield ']}'
+
+    def get_stream_xlsx_export(self, columns):
+        """
+        Writes the workbook to a temporary file in xlsxwriter's
+        constant_memory mode, which flushes each row to disk once the next
+        row starts, and returns the file.
+        """
+        output = tempfile.TemporaryFile()
+        book = xlsxwriter.Workbook(output, {'constant_memory': True, 'remove_timezone': True})
+        sheet = book.add_worksheet(
+            u"%s %s" % (_(u'Sheet'), force_text(self.opts.verbose_name)))
+        styles = {'datetime': book.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'}),
+                  'date': book.add_format({'num_format': 'yyyy-mm-dd'}),
+                  'time': book.add_format({'num_format': 'hh:mm:ss'}),
+                  'header': book.add_format({'font': 'name Times New Roman', 'color': 'red', 'bold': 'on', 'num_format': '#,##0.00'}),
+                  'default': book.add_format()}
+
+        rowx = 0
+        if self.request.GET.get('export_xlsx_header', 'off') == 'on':
+            for colx, (field_name, text) in enumerate(columns):
+                sheet.write(rowx, colx, text, styles['header'])
+            rowx += 1
+        for row in self._iter_rows(columns):
+            for colx, value in enumerate(row):
+                if isinstance(value, datetime.datetime):
+                    cell_style = styles['datetime']
+                elif isinstance(value, datetime.date):
+                    cell_style = styles['date']
+                elif isinstance(value, datetime.time):
+                    cell_style = styles['time']
+                else:
+                    cell_style = styles['default']
+                sheet.write(rowx, colx, value, cell_style)
+            rowx += 1
+        book.close()
+
+        output.seek(0)
+        return output
+
+    def get_stream_response(self):
+        file_type = self.export_type
+        columns = self._get_export_columns()
+        content_type = "%s; charset=UTF-8" % self.export_mimes[file_type]
+        if file_type == 'xlsx':
+            response = FileResponse(self.get_stream_xlsx_export(columns), content_type=content_type)
+        else:
+            response = StreamingHttpResponse(getattr(self, 'stream_%s_export' % file_type)(columns),
+                                             content_type=content_type)
+        return self._set_disposition(response, file_type)
+
     # View Methods
     def get_result_list(self, __):
+        if self.request.GET.get('export_background', 'off') == 'on':
+            return submit_export_job(self.admin_view)
+        if self.is_stream_export():
+            # Skip the changelist page, its COUNT and the ResultRow/ResultItem
+            # graph; rows are read from the filtered queryset chunk by chunk
+            # while the response is sent.
+            self.admin_view.list_queryset = self.admin_view.get_list_queryset()
+            self.admin_view.ordering_field_columns = self.admin_view.get_ordering_field_columns()
+            return self.get_stream_response()
         if self.request.GET.get('all', 'off') == 'on':
             self.admin_view.list_per_page = sys.maxsize
         return __()
@@ -0,0 +1,209 @@
+"""
+Background export jobs for the list export plugin.
+
+An export submitted with ``export_background=on`` is stored as a job in the
+cache and run by ``lib.tasks`` instead of inside the request. The worker
+replays the list request of the submitting user with ``all=on``, writes the
+export response chunk by chunk under ``XADMIN_EXPORT_ROOT`` and records its
+progress on the job. The admin polls the job page and downloads the file
+once the job is done.
+
+``XADMIN_EXPORT_ROOT`` must not be served publicly, files are only handed
+out by the permission checked download view, and files older than
+``XADMIN_EXPORT_JOB_TIMEOUT`` are removed when the next job runs.
+
+Route ``run_export_job`` to a queue backend with a separate worker
+(``BACKGROUND_TASKS['ROUTES']``): an in-process thread pool loses the job
+when the web worker is recycled. A job which made no progress for
+``XADMIN_EXPORT_JOB_STALE_TIMEOUT`` seconds is reported as failed.
+"""
+import os
+import tempfile
+import time
+import uuid
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse
+from django.template.response import TemplateResponse
+from django.test import RequestFactory
+from django.utils.encoding import force_text
+from django.utils.translation import ugettext as _
+
+from lib.tasks import submit_task
+from xadmin.sites import site
+from xadmin.views import ListAdminView, ModelAdminView
+
+JOB_KEY = 'xadmin_export_job:%s'
+JOB_TIMEOUT = getattr(settings, 'XADMIN_EXPORT_JOB_TIMEOUT', 60 * 60 * 24)
+JOB_STALE_TIMEOUT = getattr(settings, 'XADMIN_EXPORT_JOB_STALE_TIMEOUT', 60 * 10)
+EXPORT_ROOT = getattr(settings, 'XADMIN_EXPORT_ROOT', os.path.join(tempfile.gettempdir(), 'xadmin_exports'))
+# GET params which only control how the export is started
+JOB_PARAMS = ('_do_', 'export_background')
+
+
+def get_job(job_id):
+    return cache.get(JOB_KEY % job_id)
+
+
+def save_job(job, **updates):
+    job.update(updates, updated=time.time())
+    cache.set(JOB_KEY % job['id'], job, JOB_TIMEOUT)
+    return job
+
+
+def get_job_file(job):
+    return os.path.join(EXPORT_ROOT, '%s.%s' % (job['id'], job['export_type']))
+
+
+def is_stale(job):
+    """A pending or running job whose worker has not reported for JOB_STALE_TIMEOUT."""
+    return job['status'] in ('pending', 'running') and time.time() - job['updated'] > JOB_STALE_TIMEOUT
+
+
+def cleanup_exports():
+    """Removes export files, finished or partial, older than JOB_TIMEOUT, their jobs are gone too."""
+    if not os.path.isdir(EXPORT_ROOT):
+        return
+    expired = time.time() - JOB_TIMEOUT
+    for entry in os.scandir(EXPORT_ROOT):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < expired:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+
+def submit_export_job(admin_view):
+    """Enqueues an export of the current filtered list and redirects to the job page."""
+    request = admin_view.request
+    query = [(key, value) for key, values in request.GET.lists() if key not in JOB_PARAMS
+             for value in values]
+    query = [(key, value) for key, value in query if key != 'all'] + [('_do_', 'export'), ('all', 'on')]
+    job = save_job({
+        'id': uuid.uuid4().hex,
+        'model': admin_view.opts.label_lower,
+        'user': request.user.pk,
+        'path': request.path,
+        'query': query,
+        'export_type': request.GET.get('export_type', 'csv'),
+        'file_name': admin_view.opts.verbose_name.replace(' ', '_'),
+        'status': 'pending',
+        'total': None,
+        'done': 0,
+        'error': None,
+        'created': time.time(),
+    })
+    submit_task('xadmin.plugins.exportjob.run_export_job', job['id'])
+    return HttpResponseRedirect(admin_view.model_admin_url('export_job', job['id']))
+
+
+def run_export_job(job_id):
+    """Task entry point, runs one export job and records the result on it."""
+    cleanup_exports()
+    job = get_job(job_id)
+    if job is None or job['status'] != 'pending':
+        return
+    save_job(job, status='running')
+    try:
+        write_export(job)
+    except Exception as e:
+        save_job(job, status='failed', error=force_text(e))
+        raise
+    save_job(job, status='done')
+
+
+def write_export(job):
+    from xadmin.plugins.export import ExportPlugin
+
+    model = apps.get_model(job['model'])
+    view_class = site.get_view_class(ListAdminView, site._registry[model])
+    request = RequestFactory().get(job['path'], job['query'])
+    request.user = get_user_model()._default_manager.get(pk=job['user'])
+    request.session = import_module(settings.SESSION_ENGINE).SessionStore()
+
+    view = view_class(request)
+
+    def progress(done):
+        save_job(job, done=done, total=getattr(view, 'result_count', None))
+    for plugin in view.plugins:
+        if isinstance(plugin, ExportPlugin):
+            plugin.export_progress = progress
+
+    response = view.get(request)
+    if response.status_code != 200:
+        raise ValueError(_('Export failed with status %s.') % response.status_code)
+
+    path = get_job_file(job)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        with open(path + '.part', 'wb') as f:
+            if response.streaming:
+                for chunk in response.streaming_content:
+                    f.write(chunk)
+            else:
+                f.write(response.content)
+        os.replace(path + '.part', path)
+    finally:
+        response.close()
+        if os.path.exists(path + '.part'):
+            os.unlink(path + '.part')
+
+
+class ExportJobView(ModelAdminView):
+    """Job page, returns the job status as json for ajax polling."""
+
+    def init_request(self, *args, **kwargs):
+        if not self.has_view_permission():
+            raise PermissionDenied
+
+    def get_job(self, job_id):
+        job = get_job(job_id)
+        if job is None or job['user'] != self.user.pk or job['model'] != self.opts.label_lower:
+            raise Http404
+        if is_stale(job):
+            job = save_job(job, status='failed', error=_('The export worker stopped responding, please retry.'))
+        return job
+
+    def get_status(self, job):
+        status = dict((key, job[key]) for key in ('id', 'status', 'total', 'done', 'error'))
+        status['download_url'] = self.model_admin_url('export_job_download', job['id']) \
+            if job['status'] == 'done' else None
+        return status
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = self.get_job(job_id)
+        status = self.get_status(job)
+        if request.is_ajax() or request.GET.get('format') == 'json':
+            return JsonResponse(status)
+
+        context = self.get_context()
+        context.update({
+            'title': _('Export %s') % force_text(self.opts.verbose_name_plural),
+            'job': status,
+            'list_url': self.model_admin_url('changelist'),
+        })
+        return TemplateResponse(request, 'xadmin/views/export_job.html', context)
+
+
+class ExportJobDownloadView(ExportJobView):
+
+    def get(self, request, job_id, *args, **kwargs):
+        job = self.get_job(job_id)
+        path = get_job_file(job)
+        if job['status'] != 'done' or not os.path.exists(path):
+            raise Http404
+        from xadmin.plugins.export import ExportPlugin
+        response = FileResponse(open(path, 'rb'), content_type="%s; charset=UTF-8" % (
+            ExportPlugin.export_mimes.get(job['export_type'], 'application/octet-stream')))
+        response['Content-Disposition'] = ('attachment; filename=%s.%s' % (
+            job['file_name'], job['export_type'])).encode('utf-8')
+        return response
+
+
+site.register_modelview(r'^export_job/(\w+)/$', ExportJobView, name='%s_%s_export_job')
+site.register_modelview(r'^export_job/(\w+)/download/$', ExportJobDownloadView, name='%s_%s_export_job_download')
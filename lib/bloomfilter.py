@@ -1,61 +1,377 @@
 # -*- coding: utf-8 -*-
+import json
 import math
+import mmap
+import os
+import struct
+import tempfile
 import time
 
 import mmh3
-import BitVector
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_save
+from django_redis import get_redis_connection
+
+MASK64 = (1 << 64) - 1
+
+
+def get_size(capacity, error_rate):
+    """按预计数量和错误率计算(总bit位数m, 最优hash次数k)"""
+    m = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    k = max(1, round(m / capacity * math.log(2)))
+    return m, k
+
+
+def split_hash(value):
+    """一次mmh3.hash128得到双重哈希使用的两个64位哈希"""
+    if not isinstance(value, (str, bytes)):
+        value = str(value)
+    hash = mmh3.hash128(value, signed=False)
+    return hash & MASK64, hash >> 64
 
 
 class PyBloomFilter:
-    # 内置100个随机种子
-    SEEDS = [543, 460, 171, 876, 796, 607, 650, 81, 837, 545, 591, 946, 846, 521, 913, 636, 878, 735, 414, 372,
-             344, 324, 223, 180, 327, 891, 798, 933, 493, 293, 836, 10, 6, 544, 924, 849, 438, 41, 862, 648, 338,
-             465, 562, 693, 979, 52, 763, 103, 387, 374, 349, 94, 384, 680, 574, 480, 307, 580, 71, 535, 300, 53,
-             481, 519, 644, 219, 686, 236, 424, 326, 244, 212, 909, 202, 951, 56, 812, 901, 926, 250, 507, 739, 371,
-             63, 584, 154, 7, 284, 617, 332, 472, 140, 605, 262, 355, 526, 647, 923, 199, 518]
+    """
+    布隆过滤器：按capacity和error_rate计算位数m与哈希次数k，每个值只计算一次mmh3.hash128，
+    由两个64位哈希双重哈希(h1 + i * h2)得到k个探测位。
+    有redis连接时一个值的k个探测位在一次pipeline往返中完成，批量接口一次往返处理全部值；
+    没有redis连接时使用进程内的LocalBloomFilter
+    """
+    # redis字符串最大512M，即2^32位，超过时按哈希分为多个块
+    MAX_BLOCK_BITS = 1 << 32
 
     # capacity是预先估计要去重的数量
     # error_rate表示错误率
     # conn表示redis的连接客户端
     # key表示在redis中的键的名字前缀
     def __init__(self, capacity=1000000000, error_rate=0.00000001, conn=None, key='BloomFilter'):
-        self.m = math.ceil(capacity * math.log2(math.e) * math.log2(1 / error_rate))  # 需要的总bit位数
-        self.k = math.ceil(math.log1p(2) * self.m / capacity)  # 需要最少的hash次数
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.m, self.k = get_size(capacity, error_rate)
         self.mem = math.ceil(self.m / 8 / 1024 / 1024)  # 需要的多少M内存
-        self.blocknum = math.ceil(self.mem / 512)  # 需要多少个512M的内存块,value的第一个字符必须是ascii码，所有最多有256个内存块
-        self.seeds = self.SEEDS[0:self.k]
+        self.blocknum = math.ceil(self.m / self.MAX_BLOCK_BITS)  # 需要多少个512M的内存块
+        self.block_bits = math.ceil(self.m / self.blocknum)
         self.key = key
-        self.N = 2 ** 31 - 1
         self.redis = conn
-        if not self.redis:
-            # 默认如果没有redis连接，在内存中使用512M的内存块去重
-            self.bitset = BitVector.BitVector(size=1 << 32)
-        # print(self.mem)
-        # print(self.k)
+        self.local = LocalBloomFilter(capacity, error_rate) if conn is None else None
+
+    def get_name(self, block):
+        return '%s_%s' % (self.key, block)
+
+    def get_names(self):
+        return [self.get_name(block) for block in range(self.blocknum)]
+
+    def get_offsets(self, value):
+        """返回(块序号, k个探测位)"""
+        h1, h2 = split_hash(value)
+        # 块序号使用h2高位，与块内探测位相互独立；步长为0时k个探测位会重合
+        block = (h2 >> 32) % self.blocknum
+        h1, h2 = h1 % self.block_bits, h2 % self.block_bits or 1
+        return block, [(h1 + i * h2) % self.block_bits for i in range(self.k)]
+
+    def add_many(self, values):
+        if self.local is not None:
+            return self.local.add_many(values)
+        offsets = [self.get_offsets(value) for value in values]
+        if not offsets:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for block, positions in offsets:
+            name = self.get_name(block)
+            for position in positions:
+                pipe.setbit(name, position, 1)
+        pipe.execute()
+
+    def contains_many(self, values):
+        """返回与values顺序一致的布尔值列表"""
+        if self.local is not None:
+            return self.local.contains_many(values)
+        offsets = [self.get_offsets(value) for value in values]
+        if not offsets:
+            return []
+        pipe = self.redis.pipeline(transaction=False)
+        for block, positions in offsets:
+            name = self.get_name(block)
+            for position in positions:
+                pipe.getbit(name, position)
+        bits = pipe.execute()
+        return [all(bits[i * self.k:(i + 1) * self.k]) for i in range(len(offsets))]
+
+    def add(self, value):
+        self.add_many([value])
+
+    def is_exist(self, value):
+        return self.contains_many([value])[0]
+
+    def clear(self):
+        if self.local is not None:
+            self.local.clear()
+        else:
+            self.redis.delete(*self.get_names())
+
+
+class LocalBloomFilter:
+    """
+    进程内布隆过滤器，探测位由numpy按批向量化计算，查询没有网络往返。
+    写入时才分配位数组；snapshot先写临时文件再os.replace原子替换，load以只读mmap映射快照，
+    多个uWSGI worker映射同一文件时共享操作系统页缓存，不重复占用内存；
+    设置path后每隔check_interval秒检查快照文件是否被替换，替换后重新映射
+    """
+    MAGIC = b'PYBLOOM1'
+    # 文件头：MAGIC、元数据json长度，之后依次为元数据json和位数组
+    HEADER = struct.Struct('<8sI')
+
+    def __init__(self, capacity=1000000, error_rate=0.0001, path=None, check_interval=60):
+        self.m, self.k = get_size(capacity, error_rate)
+        self.path = path
+        self.check_interval = check_interval
+        # 快照中保存的附加信息
+        self.meta = {}
+        self.bits = None
+        self._mmap = None
+        self._file_id = None
+        self._checked = 0
+
+    def get_offsets(self, values):
+        """返回形如(len(values), k)的探测位数组"""
+        hashes = np.array([split_hash(value) for value in values], dtype=np.uint64).reshape(-1, 2)
+        h1 = hashes[:, 0] % np.uint64(self.m)
+        h2 = hashes[:, 1] % np.uint64(self.m)
+        h2[h2 == 0] = 1
+        # h1、h2均小于m，i * h2不会溢出uint64
+        steps = np.arange(self.k, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % np.uint64(self.m)
+
+    def add_many(self, values):
+        offsets = self.get_offsets(values).ravel()
+        if not offsets.size:
+            return
+        if self.bits is None:
+            self.bits = np.zeros((self.m + 7) // 8, dtype=np.uint8)
+        elif not self.bits.flags.writeable:
+            # 已映射只读快照，写入前复制为私有数组
+            self.bits, self._mmap = self.bits.copy(), None
+        masks = np.left_shift(1, offsets & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, (offsets >> np.uint64(3)).astype(np.intp), masks)
+
+    def contains_many(self, values):
+        """返回与values顺序一致的布尔值列表"""
+        self.refresh()
+        if self.bits is None:
+            return [False] * len(values)
+        offsets = self.get_offsets(values)
+        bits = self.bits[(offsets >> np.uint64(3)).astype(np.intp)] >> (offsets & np.uint64(7)).astype(np.uint8) & 1
+        return bits.all(axis=1).tolist()
 
     def add(self, value):
-        name = self.key + "_" + str(ord(value[0]) % self.blocknum)
-        hashs = self.get_hashs(value)
-        for hash in hashs:
-            self.redis.setbit(name, hash, 1)
+        self.add_many([value])
 
     def is_exist(self, value):
-        name = self.key + "_" + str(ord(value[0]) % self.blocknum)
-        hashs = self.get_hashs(value)
-        exist = True
-        for hash in hashs:
-            exist = exist & self.redis.getbit(name, hash)
-        return exist
-
-    def get_hashs(self, value):
-        hashs = list()
-        for seed in self.seeds:
-            hash = mmh3.hash(value, seed)
-            if hash >= 0:
-                hashs.append(hash)
-            else:
-                hashs.append(self.N - hash)
-        return hashs
+        return self.contains_many([value])[0]
+
+    def clear(self):
+        self.bits, self._mmap, self.meta = None, None, {}
+
+    def snapshot(self, path=None, **meta):
+        """把位数组及meta原子写入快照文件，读取方不会看到写了一半的文件"""
+        path = path or self.path
+        self.meta = dict(meta, m=self.m, k=self.k)
+        data = json.dumps(self.meta).encode('utf-8')
+        bits = self.bits if self.bits is not None else np.zeros((self.m + 7) // 8, dtype=np.uint8)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, len(data)))
+                f.write(data)
+                bits.tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load(self, path=None):
+        """只读映射快照文件，m、k以快照为准；文件不存在返回False"""
+        path = path or self.path
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return False
+        with f:
+            stat = os.fstat(f.fileno())
+            magic, size = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError("%s is not a bloom filter snapshot" % path)
+            meta = json.loads(f.read(size).decode('utf-8'))
+            # mmap在文件关闭后仍然有效；文件被替换后旧映射保持旧内容直到重新load
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.m, self.k, self.meta = meta['m'], meta['k'], meta
+        self.bits = np.frombuffer(mm, dtype=np.uint8, count=(self.m + 7) // 8, offset=self.HEADER.size + size)
+        self._mmap, self._file_id, self.path = mm, (stat.st_ino, stat.st_mtime_ns), path
+        return True
+
+    def refresh(self, force=False):
+        """快照文件被替换后重新映射"""
+        if self.path is None or (self.bits is not None and self.bits.flags.writeable):
+            return
+        now = time.monotonic()
+        if not force and now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (stat.st_ino, stat.st_mtime_ns) != self._file_id:
+            self.load()
+
+
+class ModelBloomFilter:
+    """
+    模型主键布隆过滤器，挡在缓存查询之前：判定不存在的id直接返回空对象，不查询数据库也不写空值缓存。
+    新增对象由post_save信号加入，删除的id仍会判定为可能存在，由空值缓存兜底；
+    rebuild_bloom_filters命令从数据库全量构建后设置ready标记，未构建完成时不拦截
+    """
+
+    def __init__(self, model, capacity=1000000, error_rate=0.0001, alias='default'):
+        self.model = model
+        self.alias = alias
+        self.key = 'bloom:%s' % model._meta.label_lower
+        self.ready_key = self.key + ':ready'
+        self.bloom = PyBloomFilter(capacity=capacity, error_rate=error_rate, conn=self.conn, key=self.key)
+
+    @property
+    def conn(self):
+        return get_redis_connection(self.alias)
+
+    def is_ready(self):
+        return bool(self.conn.exists(self.ready_key))
+
+    def add(self, pk):
+        self.bloom.add(str(pk))
+
+    def add_many(self, pks):
+        self.bloom.add_many([str(pk) for pk in pks])
+
+    def might_contain(self, pk):
+        """未构建完成时返回True，不影响正常查询；ready标记与k个探测位在同一次pipeline往返中读取"""
+        block, positions = self.bloom.get_offsets(str(pk))
+        name = self.bloom.get_name(block)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.exists(self.ready_key)
+        for position in positions:
+            pipe.getbit(name, position)
+        ready, *bits = pipe.execute()
+        return not ready or all(bits)
+
+    def rebuild(self, clear=False, chunk_size=1000):
+        """
+        从数据库加入全部主键；clear为True时先清空，清空期间不拦截，可去除已删除id带来的误判
+        """
+        if clear:
+            self.conn.delete(self.ready_key)
+            self.bloom.clear()
+        nums = 0
+        for pks in self.iter_pks(chunk_size):
+            self.bloom.add_many([str(pk) for pk in pks])
+            nums += len(pks)
+        self.conn.set(self.ready_key, 1)
+        return nums
+
+    def iter_pks(self, chunk_size=1000):
+        """分批读取全部主键"""
+        pks = []
+        for pk in self.model._default_manager.order_by().values_list('pk', flat=True).iterator(chunk_size=chunk_size):
+            pks.append(pk)
+            if len(pks) >= chunk_size:
+                yield pks
+                pks = []
+        if pks:
+            yield pks
+
+
+class LocalModelBloomFilter(ModelBloomFilter):
+    """
+    使用本地快照文件的模型主键布隆过滤器，查询没有网络往返。
+    快照记录构建时的最大主键，新增对象的自增主键大于该值，不加入过滤器也不会被拦截；
+    rebuild在构建进程中生成新快照，各进程检查到文件替换后重新映射
+    """
+
+    def __init__(self, model, capacity=1000000, error_rate=0.0001, path=None, check_interval=60):
+        self.model = model
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.key = 'bloom:%s' % model._meta.label_lower
+        self.path = os.path.join(path, '%s.bloom' % model._meta.label_lower)
+        self.bloom = LocalBloomFilter(capacity, error_rate, path=self.path, check_interval=check_interval)
+
+    def is_ready(self):
+        self.bloom.refresh()
+        return self.bloom.bits is not None
+
+    def add(self, pk):
+        # 新增对象主键大于快照的max_pk，查询时直接放行
+        pass
+
+    def add_many(self, pks):
+        pass
+
+    def might_contain(self, pk):
+        if not self.is_ready():
+            return True
+        max_pk = self.bloom.meta.get('max_pk')
+        try:
+            if max_pk is None or int(pk) > max_pk:
+                return True
+        except (TypeError, ValueError):
+            return True
+        return self.bloom.is_exist(str(pk))
+
+    def rebuild(self, clear=False, chunk_size=1000):
+        """全量构建新快照后原子替换，本地快照总是重新构建，clear参数无影响"""
+        bloom = LocalBloomFilter(self.capacity, self.error_rate, path=self.path)
+        nums, max_pk = 0, 0
+        for pks in self.iter_pks(chunk_size):
+            bloom.add_many([str(pk) for pk in pks])
+            nums, max_pk = nums + len(pks), max(max_pk, *pks)
+        bloom.snapshot(max_pk=max_pk)
+        self.bloom.refresh(force=True)
+        return nums
+
+
+_model_filters = {}
+
+
+def get_model_filter(model):
+    """模型对应的布隆过滤器，未注册返回None"""
+    return _model_filters.get(model._meta.concrete_model)
+
+
+def get_model_filters():
+    return list(_model_filters.values())
+
+
+def register_models(*models):
+    """为模型创建布隆过滤器，新增对象在事务提交后加入"""
+    config = getattr(settings, 'BLOOM_FILTER', {})
+    options = {'capacity': config.get('CAPACITY', 1000000), 'error_rate': config.get('ERROR_RATE', 0.0001)}
+    for model in models:
+        if config.get('BACKEND', 'redis') == 'local':
+            bloom = LocalModelBloomFilter(model, path=config['PATH'], **options)
+        else:
+            bloom = ModelBloomFilter(model, **options)
+        _model_filters[model] = bloom
+
+        def add(sender=None, instance=None, created=False, bloom=bloom, *args, **kwargs):
+            if created:
+                pk = instance.pk
+                transaction.on_commit(lambda: bloom.add(pk))
+        post_save.connect(receiver=add, sender=model, weak=False, dispatch_uid='bloom_%s' % bloom.key)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db.models import Case, F, IntegerField, Value, When
+from django_redis import get_redis_connection
+from rest_framework import serializers
+
+from .keyconstructors import bump_object_tags
+from .search import update_popularity
+
+
+class RedisCounter:
+    """
+    redis缓冲计数器：请求中只对hash执行HINCRBY记录增量，不写数据库；
+    由定时任务flush批量回写数据库，读取时数据库值加上未回写的增量
+    """
+
+    def __init__(self, field='click_nums', alias='learn', prefix='counter'):
+        self.field = field
+        self.alias = alias
+        self.prefix = prefix
+
+    @property
+    def conn(self):
+        return get_redis_connection(self.alias)
+
+    def get_key(self, model):
+        # 代理模型(如BannerCourse)与原模型共用同一个计数key
+        return ':'.join((self.prefix, self.field, model._meta.concrete_model._meta.label_lower))
+
+    def get_pendings(self, instances):
+        """
+        实例未回写的增量：新hash与正在回写的flushing hash之和，一次往返；
+        回写计划中的记录数据库值已是回写后的值时，flushing中的增量已计入，不再累加
+        """
+        key = self.get_key(instances[0].__class__)
+        pks = [obj.pk for obj in instances]
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.hmget(key, pks)
+        pipe.hmget(key + ':flushing', pks)
+        pipe.hmget(key + ':plan', pks)
+        pendings = []
+        for obj, pending, flushing, plan in zip(instances, *pipe.execute()):
+            if plan is not None and int(plan.split(':')[1]) == getattr(obj, self.field):
+                flushing = 0
+            pendings.append(int(pending or 0) + int(flushing or 0))
+        return pendings
+
+    def incr(self, instance, amount=1):
+        """增加计数，返回数据库值与未回写增量之和"""
+        self.conn.hincrby(self.get_key(instance.__class__), instance.pk, amount)
+        return self.get(instance)
+
+    def get(self, instance):
+        return getattr(instance, self.field) + self.get_pendings([instance])[0]
+
+    def merge(self, instances):
+        """批量合并未回写增量到实例字段，一次往返"""
+        instances = list(instances)
+        if not instances:
+            return instances
+        for obj, pending in zip(instances, self.get_pendings(instances)):
+            setattr(obj, self.field, getattr(obj, self.field) + pending)
+        return instances
+
+    def flush(self, model, batch_size=500):
+        """
+        将缓冲增量批量回写数据库
+        每批先把回写前后的值记录到plan hash，再以"字段仍为回写前的值"为条件UPDATE，最后删除增量和plan；
+        UPDATE后、删除前中断时，下次按同一plan重做，已写入的记录条件不成立，不会重复累加
+        :param model: 计数所属模型
+        :param batch_size: 每条UPDATE语句包含的记录数
+        :return: 回写的记录数
+        """
+        key = self.get_key(model)
+        flushing_key = key + ':flushing'
+        plan_key = key + ':plan'
+        conn = self.conn
+        lock = conn.lock(key + ':lock', timeout=300)
+        if not lock.acquire(blocking=False):
+            # 其他进程正在回写
+            return 0
+        try:
+            # 上次回写中断残留的flushing_key优先处理，否则将当前增量整体转移，新的点击写入新hash
+            if not conn.exists(flushing_key):
+                if not conn.exists(key):
+                    return 0
+                conn.rename(key, flushing_key)
+            pending = [(int(pk), int(delta)) for pk, delta in conn.hgetall(flushing_key).items()]
+            for i in range(0, len(pending), batch_size):
+                batch = pending[i:i + batch_size]
+                pks = [pk for pk, _ in batch]
+                plans = self.get_plans(model, plan_key, batch)
+                # 单条CASE UPDATE，只更新计数字段，不触发save与updated_time
+                value = Case(*[When(pk=pk, then=Value(new), **{self.field: old}) for pk, (old, new) in plans.items()],
+                             default=F(self.field), output_field=IntegerField())
+                if plans:
+                    model._default_manager.filter(pk__in=list(plans)).update(**{self.field: value})
+                    bump_object_tags(model, plans)
+                    update_popularity(model, list(plans), fields=[self.field])
+                pipe = conn.pipeline()
+                pipe.hdel(flushing_key, *pks)
+                pipe.hdel(plan_key, *pks)
+                pipe.execute()
+            conn.delete(flushing_key, plan_key)
+            return len(pending)
+        finally:
+            lock.release()
+
+    def get_plans(self, model, plan_key, batch):
+        """
+        一批记录的回写计划{pk: (回写前的值, 回写后的值)}，已有计划(上次中断)直接沿用，
+        其余按数据库当前值计算后写入plan_key再执行UPDATE；已删除的记录及零增量不回写
+        """
+        conn = self.conn
+        deltas = dict(batch)
+        plans = {}
+        for pk, plan in zip(deltas, conn.hmget(plan_key, list(deltas))):
+            if plan is not None:
+                plans[pk] = tuple(int(value) for value in plan.split(':'))
+        missing = [pk for pk in deltas if pk not in plans and deltas[pk]]
+        if missing:
+            current = model._default_manager.filter(pk__in=missing).values_list('pk', self.field)
+            new_plans = {pk: (value, value + deltas[pk]) for pk, value in current}
+            if new_plans:
+                conn.hset(plan_key, mapping={pk: '%d:%d' % plan for pk, plan in new_plans.items()})
+            plans.update(new_plans)
+        return plans
+
+
+click_counter = RedisCounter('click_nums')
+
+
+class CounterListSerializer(serializers.ListSerializer):
+    """列表序列化前一次合并各计数字段未回写的增量，返回的点击数与详情页一致"""
+    counters = (click_counter,)
+
+    def to_representation(self, data):
+        counters = [counter for counter in self.counters if counter.field in self.child.fields]
+        if counters:
+            data = list(data.all() if hasattr(data, 'all') else data)
+            for counter in counters:
+                counter.merge(data)
+        return super(CounterListSerializer, self).to_representation(data)
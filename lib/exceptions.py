@@ -23,6 +23,12 @@ class ValidationError(APIException):
         return str(self.detail)
 
 
+class ServiceUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = _('Service temporarily unavailable, try again later.')
+    default_code = 'service_unavailable'
+
+
 def custom_exception_handler(exc, context):
     """自定义返回"""
     response = exception_handler(exc, context)
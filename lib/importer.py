@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import codecs
+import csv
+import os
+from collections import defaultdict
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import bloomfilter, search
+from .keyconstructors import bump_tags, make_tag
+from .rollups import Rollup
+
+
+def read_rows(file, name=None, encoding='utf-8-sig'):
+    """按扩展名流式读取xlsx、xls、csv文件，逐行返回单元格值列表，第一行为表头"""
+    ext = os.path.splitext(name or getattr(file, 'name', '') or '')[1].lower()
+    if ext == '.xlsx':
+        import openpyxl
+        book = openpyxl.load_workbook(file, read_only=True, data_only=True)
+        try:
+            for row in book.active.iter_rows(values_only=True):
+                yield [normalize_cell(value) for value in row]
+        finally:
+            book.close()
+    elif ext == '.xls':
+        import xlrd
+        # xls最多65536行，xlrd只能整体读取，按需加载工作表
+        book = xlrd.open_workbook(file_contents=file.read(), on_demand=True)
+        try:
+            sheet = book.sheet_by_index(0)
+            for i in range(sheet.nrows):
+                row = []
+                for cell in sheet.row(i):
+                    value = cell.value
+                    if cell.ctype == xlrd.XL_CELL_DATE:
+                        value = xlrd.xldate.xldate_as_datetime(value, book.datemode)
+                    elif cell.ctype == xlrd.XL_CELL_EMPTY:
+                        value = None
+                    row.append(normalize_cell(value))
+                yield row
+        finally:
+            book.release_resources()
+    elif ext == '.csv':
+        for row in csv.reader(codecs.iterdecode(file, encoding)):
+            yield [normalize_cell(value) for value in row]
+    else:
+        raise ValidationError("不支持的文件类型%s，只能导入xlsx、xls、csv文件" % ext)
+
+
+def normalize_cell(value):
+    # 表格中的整数常被读成浮点数，空白单元格统一为None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+
+class ImportReport:
+    """导入结果及差异报告，只保留前limit行的明细"""
+    actions = ('new', 'update', 'skip', 'error')
+
+    def __init__(self, dry_run=False, limit=500):
+        self.dry_run = dry_run
+        self.limit = limit
+        self.counts = dict.fromkeys(self.actions, 0)
+        self.rows = []
+        self.columns = []
+        self.ignored_columns = []
+
+    def add(self, line, action, key=None, changes=None, errors=None):
+        self.counts[action] += 1
+        if len(self.rows) < self.limit and action != 'skip':
+            self.rows.append({'line': line, 'action': action, 'key': key,
+                              'changes': changes or {}, 'errors': errors or []})
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    @property
+    def truncated(self):
+        return self.total - self.counts['skip'] > len(self.rows)
+
+
+class ModelImporter:
+    """
+    批量导入：流式读取xlsx/xls/csv，每batch_size行为一批，按列批量转换校验；
+    外键按预先加载的映射解析，已有对象每批一次查询，每批在一个事务中bulk_create新增、bulk_update修改，
+    出错的行跳过并记入报告；dry_run只生成差异报告不写入。
+    bulk写入不触发模型信号，写入后统一重新统计汇总列，事务提交后递增缓存标签、更新检索索引和布隆过滤器
+    """
+    model = None
+    # 允许导入的字段名，表头可以是字段名或verbose_name，id列用于按主键更新
+    fields = ()
+    # 识别已有对象的字段，匹配到则更新，否则新增
+    key_fields = ()
+    # 外键字段: 关联模型上的匹配字段，或(匹配字段, 本模型上限定范围的外键)，
+    # 如{'lesson': ('name', 'course')}表示按所选课程下的章节名匹配章节
+    foreign_keys = {}
+    batch_size = 1000
+
+    def __init__(self, user=None, report_limit=500):
+        self.user = user
+        self.defaults = self.get_defaults()
+        self.report_limit = report_limit
+        self.opts = self.model._meta
+        self._lookups = {}
+
+    def get_defaults(self):
+        """新增对象未提供的字段值，如上传用户"""
+        return {}
+
+    # 表头
+
+    def get_columns(self, headers, report):
+        """表头映射为字段，返回[(列序号, 字段)]"""
+        names = {}
+        for name in self.fields:
+            field = self.opts.get_field(name)
+            names[name] = names[str(field.verbose_name)] = field
+        names['id'] = names['ID'] = self.opts.pk
+        columns = []
+        for i, header in enumerate(headers):
+            field = names.get(str(header).strip()) if header is not None else None
+            if field is None:
+                report.ignored_columns.append(header)
+            else:
+                columns.append((i, field))
+                report.columns.append(field.name)
+        return columns
+
+    # 外键
+
+    def get_lookup(self, field):
+        """外键的匹配映射，整个导入只查询一次：{匹配值: 主键}，重名的值映射为None"""
+        if field.name not in self._lookups:
+            config = self.foreign_keys[field.name]
+            lookup_field, scope = config if isinstance(config, tuple) else (config, None)
+            related = field.related_model
+            values = [lookup_field, 'pk'] if scope is None else \
+                [related._meta.get_field(scope).attname, lookup_field, 'pk']
+            lookup = {}
+            for row in related._default_manager.order_by().values_list(*values):
+                key = row[0] if scope is None else row[:2]
+                lookup[key] = None if key in lookup else row[-1]
+            self._lookups[field.name] = lookup
+        return self._lookups[field.name]
+
+    def resolve_foreign_key(self, field, value, values):
+        config = self.foreign_keys[field.name]
+        scope = config[1] if isinstance(config, tuple) else None
+        key = value
+        if scope is not None:
+            key = (values.get(self.opts.get_field(scope).attname), value)
+        lookup = self.get_lookup(field)
+        if key not in lookup:
+            raise ValidationError("%s“%s”不存在" % (field.verbose_name, value))
+        if lookup[key] is None:
+            raise ValidationError("%s“%s”匹配到多个对象" % (field.verbose_name, value))
+        return lookup[key]
+
+    # 校验
+
+    def clean_column(self, field, cells, rows):
+        """转换校验一批中的一列，结果写入rows中每行的values，错误写入errors"""
+        choices = {str(label): key for key, label in field.flatchoices} if field.choices else None
+        for cell, row in zip(cells, rows):
+            if cell is None:
+                continue
+            try:
+                if field.primary_key:
+                    value = field.to_python(cell)
+                elif field.many_to_one:
+                    value = self.resolve_foreign_key(field, cell, row['values'])
+                else:
+                    if choices is not None:
+                        cell = choices.get(str(cell), cell)
+                    value = field.clean(cell, None)
+            except ValidationError as e:
+                row['errors'].extend('%s: %s' % (field.verbose_name, message) for message in e.messages)
+            else:
+                row['values'][field.attname] = value
+
+    def clean_batch(self, columns, lines):
+        """按列转换一批行，外键列排在限定范围的外键之后"""
+        rows = [{'line': line, 'values': {}, 'errors': []} for line, cells in lines]
+        scoped = {name for name, config in self.foreign_keys.items() if isinstance(config, tuple)}
+        for i, field in sorted(columns, key=lambda column: column[1].name in scoped):
+            self.clean_column(field, [cells[i] if i < len(cells) else None for line, cells in lines], rows)
+        return rows
+
+    def get_key(self, values):
+        if not self.key_fields:
+            return None
+        key = tuple(values.get(self.opts.get_field(name).attname) for name in self.key_fields)
+        return None if None in key else key
+
+    def get_existing(self, rows):
+        """一次查询本批对应的已有对象，返回({主键: 对象}, {键: [对象]})"""
+        pks = [row['values'][self.opts.pk.attname] for row in rows if self.opts.pk.attname in row['values']]
+        keys = {row['key'] for row in rows if row['key'] is not None}
+        condition = Q(pk__in=pks) if pks else Q()
+        if keys:
+            attnames = [self.opts.get_field(name).attname for name in self.key_fields]
+            condition |= Q(**{'%s__in' % attnames[0]: {key[0] for key in keys}})
+        if not condition:
+            return {}, {}
+        by_pk, by_key = {}, defaultdict(list)
+        for obj in self.model._default_manager.filter(condition):
+            by_pk[obj.pk] = obj
+            key = self.get_key({name: getattr(obj, name) for name in (f.attname for f in self.opts.concrete_fields)})
+            if key in keys:
+                by_key[key].append(obj)
+        return by_pk, by_key
+
+    def check_required(self, values):
+        errors = []
+        for name in self.fields:
+            field = self.opts.get_field(name)
+            if field.attname not in values and not {field.name, field.attname} & set(self.defaults) \
+                    and not field.blank and not field.has_default():
+                errors.append('%s: 必须填写' % field.verbose_name)
+        return errors
+
+    def plan_batch(self, columns, lines, report):
+        """校验一批并与已有对象比较，返回(新增对象列表, [(已修改对象, 原外键值)], 修改的字段)"""
+        rows = self.clean_batch(columns, lines)
+        for row in rows:
+            row['key'] = self.get_key(row['values'])
+        by_pk, by_key = self.get_existing([row for row in rows if not row['errors']])
+
+        created, updated, update_fields, seen = [], [], set(), {}
+        for row in rows:
+            values, errors, line = row['values'], row['errors'], row['line']
+            pk = values.pop(self.opts.pk.attname, None)
+            key = row['key']
+            obj = None
+            if not errors:
+                if pk is not None:
+                    obj = by_pk.get(pk)
+                    if obj is None:
+                        errors.append('ID %s 不存在' % pk)
+                elif key is not None:
+                    matched = by_key.get(key, [])
+                    if len(matched) > 1:
+                        errors.append('匹配到%d个已有对象' % len(matched))
+                    obj = matched[0] if matched else None
+            dedupe = ('pk', obj.pk) if obj is not None else ('key', key)
+            if not errors and dedupe[1] is not None and dedupe in seen:
+                errors.append('与第%d行重复' % seen[dedupe])
+            if errors:
+                report.add(line, 'error', key=self.describe_key(key, pk), errors=errors)
+                continue
+            seen[dedupe] = line
+
+            if obj is None:
+                errors = self.check_required(values)
+                if errors:
+                    report.add(line, 'error', key=self.describe_key(key, pk), errors=errors)
+                    continue
+                obj = self.model(**dict(self.defaults, **values))
+                created.append(obj)
+                report.add(line, 'new', key=self.describe_key(key, pk),
+                           changes={attname: (None, value) for attname, value in values.items()})
+                continue
+
+            changes = {attname: (getattr(obj, attname), value) for attname, value in values.items()
+                       if getattr(obj, attname) != value}
+            if not changes:
+                report.add(line, 'skip', key=self.describe_key(key, obj.pk))
+                continue
+            old = {field.attname: getattr(obj, field.attname) for field in self.opts.concrete_fields
+                   if field.many_to_one}
+            for attname, (old_value, value) in changes.items():
+                setattr(obj, attname, value)
+            updated.append((obj, old))
+            update_fields.update(changes)
+            report.add(line, 'update', key=self.describe_key(key, obj.pk), changes=changes)
+        return created, updated, update_fields
+
+    def describe_key(self, key, pk=None):
+        if pk is not None:
+            return 'ID %s' % pk
+        return ' / '.join(str(value) for value in key) if key else ''
+
+    # 写入
+
+    def write_batch(self, created, updated, update_fields):
+        objs = [obj for obj, old in updated]
+        if update_fields:
+            # bulk_update不经过pre_save，手动更新auto_now字段
+            now = timezone.now()
+            for field in self.opts.concrete_fields:
+                if getattr(field, 'auto_now', False):
+                    update_fields.add(field.attname)
+                    for obj in objs:
+                        setattr(obj, field.attname, now)
+        with transaction.atomic():
+            if created:
+                self.model._default_manager.bulk_create(created, batch_size=self.batch_size)
+                self.fetch_created_pks(created)
+            if objs:
+                self.model._default_manager.bulk_update(
+                    objs, [self.opts.get_field(attname).name for attname in sorted(update_fields)],
+                    batch_size=self.batch_size)
+            self.after_write(created, updated)
+
+    def fetch_created_pks(self, created):
+        """数据库不返回bulk_create主键时(MySQL)按识别字段查询新增对象的主键"""
+        if not created or created[0].pk is not None or not self.key_fields:
+            return
+        by_key = {self.get_key({f.attname: getattr(obj, f.attname) for f in self.opts.concrete_fields}): obj
+                  for obj in created}
+        attnames = [self.opts.get_field(name).attname for name in self.key_fields]
+        queryset = self.model._default_manager.filter(**{'%s__in' % attnames[0]: {key[0] for key in by_key}})
+        for values in queryset.order_by('pk').values(self.opts.pk.attname, *attnames):
+            obj = by_key.get(tuple(values[attname] for attname in attnames))
+            if obj is not None:
+                obj.pk = values[self.opts.pk.attname]
+
+    def after_write(self, created, updated):
+        """代替逐行的post_save信号，在写入事务中调用"""
+        objs = [obj for obj in created if obj.pk is not None] + [obj for obj, old in updated]
+        # 汇总列按批重新统计，新旧父对象都包括
+        for rollup in Rollup.registry:
+            if rollup.child is self.model:
+                parent_ids = {getattr(obj, rollup.attname) for obj in objs}
+                parent_ids.update(old.get(rollup.attname) for obj, old in updated)
+                rollup.update(parent_ids)
+
+        tags = {make_tag(self.model)}
+        for obj in objs:
+            tags.add(make_tag(self.model, obj.pk))
+            for field in self.opts.concrete_fields:
+                if field.many_to_one and getattr(obj, field.attname) is not None:
+                    tags.update((make_tag(field.related_model), make_tag(field.related_model, getattr(obj, field.attname))))
+        transaction.on_commit(lambda: bump_tags(sorted(tags)))
+
+        created = [obj for obj in created if obj.pk is not None]
+        bloom = bloomfilter.get_model_filter(self.model)
+        if bloom is not None and created:
+            transaction.on_commit(lambda: bloom.add_many([obj.pk for obj in created]))
+        for index in search.get_indexes():
+            if index.model is self.model:
+                transaction.on_commit(lambda index=index: self.update_index(index, created, updated))
+
+    @staticmethod
+    def update_index(index, created, updated):
+        # 新增文档没有旧词，批量写入；修改的文档需要先清理旧词
+        backend = search.get_backend()
+        backend.bulk_update(index, created)
+        for obj, old in updated:
+            backend.update(index, obj)
+
+    def run(self, file, name=None, dry_run=False):
+        report = ImportReport(dry_run=dry_run, limit=self.report_limit)
+        rows = read_rows(file, name)
+        headers = next(rows, None)
+        if headers is None:
+            raise ValidationError("文件内容为空")
+        columns = self.get_columns(headers, report)
+        if not columns:
+            raise ValidationError("没有可以导入的列，表头应为%s" % '、'.join(
+                str(self.opts.get_field(name).verbose_name) for name in self.fields))
+
+        batch = []
+        for line, cells in enumerate(rows, 2):
+            if any(cell is not None for cell in cells):
+                batch.append((line, cells))
+            if len(batch) >= self.batch_size:
+                self.process_batch(columns, batch, report)
+                batch = []
+        if batch:
+            self.process_batch(columns, batch, report)
+        return report
+
+    def process_batch(self, columns, batch, report):
+        rows_before = len(report.rows)
+        counts_before = dict(report.counts)
+        created, updated, update_fields = self.plan_batch(columns, batch, report)
+        if report.dry_run or not (created or updated):
+            return
+        try:
+            self.write_batch(created, updated, update_fields)
+        except DatabaseError as e:
+            # 整批回滚，本批有效行都记为错误
+            del report.rows[rows_before:]
+            report.counts = counts_before
+            for line, cells in batch:
+                report.add(line, 'error', errors=['本批写入失败，已回滚: %s' % e])
@@ -1,39 +1,90 @@
 # -*- coding: utf-8 -*-
 __author__ = 'wuhai'
-from datetime import datetime
-
-from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
 from rest_framework_extensions.key_constructor.bits import KeyBitBase, ListSqlQueryKeyBit, PaginationKeyBit, \
-    RetrieveSqlQueryKeyBit, UniqueMethodIdKeyBit
+    QueryParamsKeyBit, RetrieveSqlQueryKeyBit, UniqueMethodIdKeyBit
 from rest_framework_extensions.key_constructor.constructors import KeyConstructor
 
+# 依赖标签版本号key前缀，不设置过期时间
+TAG_VERSION_PREFIX = 'tag_version'
 
-class UpdatedAtKeyBit(KeyBitBase):
 
-    def get_data(self, params, view_instance, view_method, request, args, kwargs):
-        lookup_value = view_instance.kwargs[view_instance.lookup_field]
+def make_tag(model, pk=None):
+    """模型标签model:<label>，对象标签obj:<label>:<pk>，代理模型与原模型共用标签"""
+    label = model._meta.concrete_model._meta.label_lower
+    if pk is None:
+        return 'model:%s' % label
+    return 'obj:%s:%s' % (label, pk)
+
+
+def get_tag_versions(tags):
+    if not tags:
+        return []
+    conn = get_redis_connection()
+    return [int(version or 0) for version in conn.mget(['%s:%s' % (TAG_VERSION_PREFIX, tag) for tag in tags])]
+
+
+def bump_tags(tags):
+    conn = get_redis_connection()
+    pipe = conn.pipeline(transaction=False)
+    for tag in tags:
+        pipe.incr('%s:%s' % (TAG_VERSION_PREFIX, tag))
+    return pipe.execute()
+
 
-        key = ':'.join([
-            "ObjectUpdatedAt",
-            view_instance.__module__,
-            view_instance.get_queryset().model.__name__,
-            lookup_value,
-        ])
+def bump_instance_tags(instance, *related):
+    """
+    模型实例变更后递增模型标签和对象标签的版本号，事务提交后执行
+    :param instance: 变更的模型实例
+    :param related: 受影响的关联对象，(model, pk)元组，如章节变更影响所属课程
+    """
+    tags = {make_tag(instance.__class__), make_tag(instance.__class__, instance.pk)}
+    for model, pk in related:
+        if pk is not None:
+            tags.update((make_tag(model), make_tag(model, pk)))
+    transaction.on_commit(lambda: bump_tags(sorted(tags)))
 
-        value = cache.get(key, None)
-        if not value:
-            value = datetime.utcnow()
-            cache.set(key, value=value)
-        return str(value)
+
+def bump_object_tags(model, pks):
+    """
+    只递增对象标签的版本号，事务提交后执行；用于点击、收藏等计数列变更，
+    详情缓存随之失效，列表缓存不失效，列表中的计数允许在缓存过期前滞后
+    """
+    tags = sorted({make_tag(model, pk) for pk in pks if pk is not None})
+    if tags:
+        transaction.on_commit(lambda: bump_tags(tags))
+
+
+class DependencyTagsKeyBit(KeyBitBase):
+    """
+    依赖标签key bit：缓存依赖视图cache_dependencies声明的模型(默认queryset模型)的模型标签，
+    带lookup参数时还依赖当前对象的对象标签；模型变更信号递增版本号后缓存key随之变化，旧缓存自然过期
+    """
+
+    def get_data(self, params, view_instance, view_method, request, args, kwargs):
+        model = view_instance.get_queryset().model
+        tags = [make_tag(dependency) for dependency in getattr(view_instance, 'cache_dependencies', (model,))]
+
+        lookup_url_kwarg = view_instance.lookup_url_kwarg or view_instance.lookup_field
+        if lookup_url_kwarg in kwargs:
+            tags.append(make_tag(model, kwargs[lookup_url_kwarg]))
+        return ':'.join(str(version) for version in get_tag_versions(tags))
 
 
 class ListKeyConstructor(KeyConstructor):
     unique_method_id = UniqueMethodIdKeyBit()
     list_sql = ListSqlQueryKeyBit()
     pagination = PaginationKeyBit()
+    # 稀疏字段参数，expand只影响预取时sql相同
+    sparse_fields = QueryParamsKeyBit(['fields', 'expand'])
+    dependencies = DependencyTagsKeyBit()
 
 
 class ObjectKeyConstructor(KeyConstructor):
     unique_method_id = UniqueMethodIdKeyBit()
     retrieve_sql = RetrieveSqlQueryKeyBit()
-    # updated_at = UpdatedAtKeyBit()
+    # 单一资源的关联列表(如相关课程)分页返回，page、page_size、cursor参数区分缓存
+    pagination = PaginationKeyBit()
+    sparse_fields = QueryParamsKeyBit(['fields', 'expand'])
+    dependencies = DependencyTagsKeyBit()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import threading
+import time
+from collections import OrderedDict
+
+
+class LocalLRUCache:
+    """
+    进程内LRU缓存，条目timeout秒后过期，超过maxsize时淘汰最久未使用的条目；
+    各进程之间不同步，只用于允许短暂过期的热点小对象
+    """
+
+    def __init__(self, maxsize=1000, timeout=10):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
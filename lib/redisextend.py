@@ -1,7 +1,22 @@
 # -*- coding: utf-8 -*-
 __author__ = 'wuhai'
+import json
+import math
+import random
+import string
+import time
+import uuid
+from collections import OrderedDict
+
+from django.db.models import Prefetch
 from django_redis import get_redis_connection
-from rest_framework import mixins, viewsets, serializers
+from rest_framework import mixins, viewsets, serializers, status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.utils.encoders import JSONEncoder
+
+from .bloomfilter import get_model_filter
+from .exceptions import ServiceUnavailable, ValidationError
+from .response import Response
 
 
 class CustomRedisClient:
@@ -20,6 +35,13 @@ class CustomRedisClient:
 
 # 自定义ModelSerializer，便于拓展
 class CustomModelSerializer(serializers.ModelSerializer):
+    """
+    稀疏字段：GET请求?fields=id,name只返回指定字段；Meta.expandable_fields中的字段在列表中默认不返回，
+    ?expand=lessons时返回。只作用于顶层序列化器，context['sparse']为False时返回全部字段。
+    Meta.field_prefetches声明字段依赖的prefetch_related路径，字段不返回时sparse_queryset去掉对应预取
+    """
+    fields_query_param = 'fields'
+    expand_query_param = 'expand'
 
     @property
     def null_serializer(self):
@@ -27,17 +49,271 @@ class CustomModelSerializer(serializers.ModelSerializer):
         fields = self.get_fields()
         return {field: 'null' for field, f_type in fields.items() if not f_type.write_only}
 
+    def get_fields(self):
+        fields = super(CustomModelSerializer, self).get_fields()
+        selected = self.get_selected_fields(fields)
+        if selected is None:
+            return fields
+        return OrderedDict((name, field) for name, field in fields.items() if name in selected or field.write_only)
+
+    def get_selected_fields(self, fields):
+        """需要返回的字段名，None表示全部"""
+        request = self.context.get('request')
+        in_list = isinstance(self.parent, serializers.ListSerializer)
+        parent = self.parent.parent if in_list else self.parent
+        if request is None or parent is not None or request.method not in SAFE_METHODS \
+                or not self.context.get('sparse', True):
+            return None
+
+        selected = self.split_param(request, self.fields_query_param)
+        if selected:
+            return selected
+        expandable = getattr(self.Meta, 'expandable_fields', ())
+        if not in_list or not expandable:
+            return None
+        expand = self.split_param(request, self.expand_query_param)
+        return {name for name in fields if name not in expandable or name in expand}
+
+    @staticmethod
+    def split_param(request, param):
+        return {name.strip() for name in request.query_params.get(param, '').split(',') if name.strip()}
+
+    @classmethod
+    def sparse_queryset(cls, queryset, request, many=True):
+        """
+        按返回字段裁剪查询：only()只查询需要的列，去掉不需要的select_related和prefetch_related；
+        字段来源为模型属性或方法等无法确定依赖列时不裁剪列，SerializerMethodField(source='*')依赖通过预取声明
+        """
+        serializer = cls(many=many, context={'request': request})
+        fields = (serializer.child if many else serializer).fields
+        readable = [field for field in fields.values() if not field.write_only]
+
+        # 不返回字段依赖的预取
+        field_prefetches = getattr(cls.Meta, 'field_prefetches', {})
+        skipped = {field_prefetches[name] for name in field_prefetches if name not in fields}
+        lookups = [lookup for lookup in queryset._prefetch_related_lookups
+                   if (lookup.prefetch_through if isinstance(lookup, Prefetch) else lookup).split('__')[0] not in skipped]
+        queryset = queryset.prefetch_related(None).prefetch_related(*lookups)
+
+        model_fields = {field.name for field in queryset.model._meta.concrete_fields}
+        columns = {queryset.model._meta.pk.name}
+        for field in readable:
+            if field.source == '*':
+                continue
+            name = field.source.split('.')[0]
+            if name not in model_fields:
+                return queryset
+            columns.add(name)
+
+        related = queryset.query.select_related
+        if isinstance(related, dict):
+            paths = [path for path in cls._related_paths(related) if path.split('__')[0] in columns]
+            queryset = queryset.select_related(None)
+            if paths:
+                queryset = queryset.select_related(*paths)
+        return queryset.only(*columns)
+
+    @classmethod
+    def _related_paths(cls, related, prefix=''):
+        for name, children in related.items():
+            if children:
+                yield from cls._related_paths(children, prefix + name + '__')
+            else:
+                yield prefix + name
+
+
+class CacheAside:
+    """
+    cache-aside缓存：整个对象json序列化后存为一个string，读写各一次往返，可保存嵌套结构；
+    缓存失效时通过互斥锁只允许一个请求回源，其余请求退避重读并重试加锁，超时返回503而不回源，避免击穿；
+    临近过期时按概率提前刷新(XFetch)，热点key不会在同一时刻集中失效
+    """
+    # 写缓存，锁仍为本请求持有时释放锁
+    fill_script = """
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    if redis.call('get', KEYS[2]) == ARGV[3] then
+        redis.call('del', KEYS[2])
+    end
+    """
+    release_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, conn, prefix='cache', expire=43200, null_expire=60, lock_timeout=10, wait_timeout=2,
+                 beta=1.0):
+        """
+        :param conn: redis连接
+        :param expire: 默认缓存过期时间，60 * 60 * 12 s
+        :param null_expire: 不存在资源的空值缓存过期时间，60 s
+        :param lock_timeout: 回源互斥锁过期时间
+        :param wait_timeout: 未拿到锁时等待其他请求回填的最长时间，超时抛出ServiceUnavailable
+        :param beta: 提前刷新系数，越大越提前
+        """
+        self.conn = conn
+        self.prefix = prefix
+        self.expire = expire
+        self.null_expire = null_expire
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.beta = beta
+
+    def make_key(self, key):
+        return ':'.join((self.prefix, key))
+
+    def get(self, key, loader, expire=None, null_expire=None):
+        """
+        读取缓存，不存在时调用loader回源并回填
+        :param loader: 无参函数，返回可json序列化的数据，资源不存在时返回None
+        :return: loader的返回值或缓存值
+        """
+        key = self.make_key(key)
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        raw, pttl = pipe.execute()
+
+        if raw is not None:
+            entry = json.loads(raw)
+            # 提前刷新只由拿到锁的请求执行，其余请求继续返回旧值
+            token = self.should_refresh(entry.get('delta', 0), pttl) and self.acquire(key)
+            if not token:
+                return entry['value']
+        else:
+            token = self.acquire(key)
+            if not token:
+                # 其他请求正在回源，等待回填，持有者超时释放锁后由本请求回源
+                entry, token = self.wait(key)
+                if entry is not None:
+                    return entry['value']
+
+        start = time.time()
+        try:
+            value = loader()
+        except Exception:
+            self.release(key, token)
+            raise
+        self.fill(key, value, time.time() - start, expire, null_expire, token=token)
+        return value
+
+    def set(self, key, value, expire=None):
+        self.fill(self.make_key(key), value, 0, expire)
+
+    def delete(self, *keys):
+        return self.conn.delete(*[self.make_key(key) for key in keys])
+
+    def fill(self, key, value, delta=0, expire=None, null_expire=None, token=None):
+        # 写缓存与释放本请求持有的锁在同一次往返中完成，不会删除其他请求的锁
+        if value is None:
+            expire = null_expire or self.null_expire
+        else:
+            expire = expire or self.expire
+        data = json.dumps({'value': value, 'delta': delta}, cls=JSONEncoder)
+        if token is None:
+            return self.conn.set(key, data, ex=expire)
+        self.conn.eval(self.fill_script, 2, key, self.lock_key(key), data, expire, token)
+
+    def should_refresh(self, delta, pttl):
+        """XFetch：回源耗时越长、剩余时间越短，越可能提前刷新"""
+        if pttl is None or pttl < 0:
+            return False
+        return -delta * self.beta * math.log(1 - random.random()) * 1000 >= pttl
+
+    @staticmethod
+    def lock_key(key):
+        return key + ':lock'
+
+    def acquire(self, key):
+        """加锁，成功返回本请求的锁token，失败返回None"""
+        token = uuid.uuid4().hex
+        if self.conn.set(self.lock_key(key), token, nx=True, ex=self.lock_timeout):
+            return token
+        return None
+
+    def release(self, key, token):
+        return self.conn.eval(self.release_script, 1, self.lock_key(key), token)
+
+    def wait(self, key, interval=0.02, max_interval=0.2):
+        """
+        退避重读缓存，每次重读同时尝试加锁，持有者异常退出、锁过期后由等待者接替回源
+        :return: (缓存项, None)或(None, 锁token)，超过wait_timeout抛出ServiceUnavailable
+        """
+        deadline = time.time() + self.wait_timeout
+        while time.time() < deadline:
+            time.sleep(interval)
+            interval = min(interval * 2, max_interval)
+            raw = self.conn.get(key)
+            if raw is not None:
+                return json.loads(raw), None
+            token = self.acquire(key)
+            if token:
+                return None, token
+        raise ServiceUnavailable()
+
+
+def invalidate_cache(key_format, conn=None, **kwargs):
+    """模型变更信号中调用，按key格式删除CustomModelViewSet的单一资源缓存"""
+    return CacheAside(conn or get_redis_connection()).delete(key_format.format(**kwargs))
+
 
 class CustomModelViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixins.DestroyModelMixin,
                          mixins.RetrieveModelMixin, viewsets.GenericViewSet):
     """redis cache model viewset"""
     conn = get_redis_connection()
+    # 单一资源缓存过期时间，60 * 60 * 12 s
+    cache_expire = 43200
+    # 访问不存在的单一资源时空值缓存过期时间， 60 s, 与THROTTLE_RATES保持一致
+    cache_null_expire = 60
+    # 单一资源缓存key格式，get_cache_key与模型变更信号共用
+    cache_key_format = None
 
     @property
     def custom_conn(self):
         # 自定义redis连接，拓展redis数据库函数
         return CustomRedisClient(self.conn)
 
+    @property
+    def cache(self):
+        return CacheAside(self.conn, expire=self.cache_expire, null_expire=self.cache_null_expire)
+
+    def get_cache_key(self):
+        """
+        单一资源缓存key，按cache_key_format中的字段名填充：lookup_field取url中的lookup值，
+        其余字段依次取url参数、查询参数，不是非负整数时抛出ValidationError
+        """
+        assert self.cache_key_format is not None, (
+            "'%s' should either include a `cache_key_format` attribute, "
+            "or override the `get_cache_key()` method." % self.__class__.__name__
+        )
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        values = {}
+        for _, name, _, _ in string.Formatter().parse(self.cache_key_format):
+            if not name or name in values:
+                continue
+            if name == self.lookup_field:
+                value = self.kwargs.get(lookup_url_kwarg)
+            else:
+                value = self.kwargs.get(name, self.request.query_params.get(name))
+            if value is None or not str(value).isdigit():
+                raise ValidationError(code=-1, detail="%s is invalid." % name)
+            values[name] = value
+        return self.cache_key_format.format(**values)
+
+    @classmethod
+    def invalidate_cache(cls, **kwargs):
+        return invalidate_cache(cls.cache_key_format, conn=cls.conn, **kwargs)
+
+    def bloom_rejected(self):
+        """布隆过滤器判定lookup id一定不存在，每个请求只判定一次，cache_retrieve已判定时get_object不再重复"""
+        if self.lookup_field not in ('id', 'pk') or getattr(self, '_bloom_checked', False):
+            return False
+        self._bloom_checked = True
+        bloom = get_model_filter(self.get_queryset().model)
+        lookup_value = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        return bloom is not None and lookup_value is not None and not bloom.might_contain(lookup_value)
+
     def get_object(self):
         queryset = self.filter_queryset(self.get_queryset())
         lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
@@ -47,6 +323,8 @@ class CustomModelViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixin
                 'attribute on the view correctly.' %
                 (self.__class__.__name__, lookup_url_kwarg)
         )
+        if self.bloom_rejected():
+            return None
 
         filter_kwargs = {self.lookup_field: self.kwargs[lookup_url_kwarg]}
         obj = queryset.filter(**filter_kwargs).first()
@@ -54,43 +332,49 @@ class CustomModelViewSet(mixins.CreateModelMixin, mixins.UpdateModelMixin, mixin
             self.check_object_permissions(self.request, obj)
         return obj
 
-    def cache_retrieve(self, cache_key=None, exist_expire=43200, null_expire=60):
+    def retrieve(self, request, *args, **kwargs):
+        data = self.cache_retrieve(self.get_cache_key())
+        # 缓存完整对象，稀疏字段在读取后过滤
+        fields = self.get_serializer().fields
+        return Response(data={name: value for name, value in data.items() if name in fields},
+                        status=status.HTTP_200_OK)
+
+    def perform_update(self, serializer):
+        super(CustomModelViewSet, self).perform_update(serializer)
+        self.cache.delete(self.get_cache_key())
+
+    def perform_destroy(self, instance):
+        super(CustomModelViewSet, self).perform_destroy(instance)
+        self.cache.delete(self.get_cache_key())
+
+    def cache_retrieve(self, cache_key=None, exist_expire=None, null_expire=None):
         """
         单一资源缓存读取
         :param cache_key: cache name
-        :param exist_expire: 默认缓存过期时间，60 * 60 * 12 s
-        :param null_expire: 访问异常单一资源默认过时间， 60 s
+        :param exist_expire: 缓存过期时间，默认cache_expire
+        :param null_expire: 访问异常单一资源过期时间，默认cache_null_expire
         :return:
         """
-        cache_obj = self.conn.hgetall(cache_key)
-        ttl_time = self.conn.ttl(cache_key)
+        if self.bloom_rejected():
+            # 一定不存在的id不查询缓存和数据库，也不写空值缓存
+            return getattr(self.get_serializer_class()(), 'null_serializer')
 
-        if not cache_obj:
-            # 缓存不存在则数据库中查找，数据库中有则返回，没有则设置一个空对象并设置过期时间防止穿透
+        def load():
             instance = self.get_object()
-            if instance:
-                serializer = self.get_serializer(instance)
-                self.conn.hset(name=cache_key, mapping=serializer.data)
-                self.conn.expire(cache_key, exist_expire)
-                return serializer.data
-            else:
-                # 组装一个空对象字典返回并设置60s过期, 与THROTTLE_RATES保持一致
-                cache_obj = getattr(self.serializer_class(), 'null_serializer')  # 确保serializer存在null_serializer属性
-                self.conn.hmset(cache_key, mapping=cache_obj)
-                self.conn.expire(cache_key, null_expire)
-        # 缓存存在时，检查过期时间小于60s，重新设置过期时间
-        elif ttl_time < 60:
-            self.conn.expire(cache_key, exist_expire)
-        return cache_obj
+            if instance is None:
+                return None
+            context = dict(self.get_serializer_context(), sparse=False)
+            return self.get_serializer_class()(instance, context=context).data
 
-    def cache_update(self, cache_key=None, mapping=None, expire=3600):
-        # 数据库更新完成后，检查是否存在缓存，先删除原先缓存再插入
-        has_name = self.conn.hkeys(cache_key)
+        data = self.cache.get(cache_key, load, expire=exist_expire, null_expire=null_expire)
+        if data is None:
+            # 资源不存在，返回空对象，确保serializer存在null_serializer属性
+            return getattr(self.get_serializer_class()(), 'null_serializer')
+        return data
 
-        if has_name:
-            self.conn.delete(cache_key)
-        self.conn.hset(name=cache_key, mapping=mapping)
-        return self.conn.expire(cache_key, expire)
+    def cache_update(self, cache_key=None, mapping=None, expire=3600):
+        # 数据库更新完成后，直接覆盖原缓存
+        return self.cache.set(cache_key, mapping, expire)
 
 
 if __name__ == '__main__':
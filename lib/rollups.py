@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+from django.db import transaction
+from django.db.models import F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_init, post_save, pre_save
+
+from .keyconstructors import bump_tags, make_tag
+from .search import update_popularity
+
+
+class Rollup:
+    """
+    汇总列：子模型增删改后，在同一事务中用一条带子查询的UPDATE重新统计受影响父对象的汇总列，
+    与重建结果一致不会累积偏差；子对象更换父对象时新旧父对象都会重新统计，外键及聚合字段未变化时不更新
+    :param parent: 父模型
+    :param child: 子模型
+    :param fk: 子模型指向父模型的外键字段名
+    :param aggregates: {父模型字段: 聚合表达式}，如{'video_count': Count('pk'), 'learn_times': Sum('learn_times')}
+    """
+    registry = []
+
+    def __init__(self, parent, child, fk, aggregates):
+        self.parent = parent
+        self.child = child
+        self.fk = fk
+        self.aggregates = aggregates
+        self.attname = child._meta.get_field(fk).attname
+        # 影响汇总结果的子模型列：外键及聚合表达式引用的字段
+        self.tracked = [self.attname] + sorted({
+            child._meta.get_field(expression.name).attname
+            for aggregate in aggregates.values() for expression in aggregate.get_source_expressions()
+            if isinstance(expression, F) and expression.name != 'pk'})
+        self.old_attr = '_rollup_old_%s' % self.attname
+
+    def get_updates(self):
+        updates = {}
+        for field, aggregate in self.aggregates.items():
+            value = self.child._default_manager.filter(**{self.fk: OuterRef('pk')}).order_by() \
+                .values(self.fk).annotate(value=aggregate).values('value')
+            updates[field] = Coalesce(Subquery(value, output_field=IntegerField()), 0)
+        return updates
+
+    def update(self, parent_ids):
+        """重新统计parent_ids对应父对象的汇总列，只UPDATE汇总列，不触发信号与auto_now"""
+        parent_ids = sorted({pk for pk in parent_ids if pk is not None})
+        if not parent_ids:
+            return 0
+        updated = self.parent._default_manager.filter(pk__in=parent_ids).update(**self.get_updates())
+        # update不触发信号，手动使依赖父对象的响应缓存失效
+        tags = [make_tag(self.parent)] + [make_tag(self.parent, pk) for pk in parent_ids]
+        transaction.on_commit(lambda: bump_tags(tags))
+        update_popularity(self.parent, parent_ids, fields=list(self.aggregates))
+        return updated
+
+    def rebuild(self, batch_size=1000):
+        pks = list(self.parent._default_manager.order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), batch_size):
+            self.update(pks[i:i + batch_size])
+        return len(pks)
+
+    def get_tracked(self, instance):
+        return tuple(getattr(instance, attname) for attname in self.tracked)
+
+    def remember_loaded(self, sender=None, instance=None, *args, **kwargs):
+        # 子对象构造时记录外键及聚合字段的原值，不查询数据库；字段被defer时不记录
+        if all(attname in instance.__dict__ for attname in self.tracked):
+            instance.__dict__[self.old_attr] = self.get_tracked(instance)
+
+    def remember_parent(self, sender=None, instance=None, raw=False, *args, **kwargs):
+        # 原值未知(字段被defer)的已有子对象才查询一次原外键及聚合字段
+        if raw or instance._state.adding or instance.pk is None or self.old_attr in instance.__dict__:
+            return
+        old = self.child._default_manager.filter(pk=instance.pk).values_list(*self.tracked).first()
+        instance.__dict__[self.old_attr] = old
+
+    def child_changed(self, sender=None, instance=None, created=None, *args, **kwargs):
+        parent_id = getattr(instance, self.attname)
+        # created为None表示删除
+        if created is None or created:
+            parent_ids = {parent_id}
+        else:
+            old = instance.__dict__.get(self.old_attr)
+            current = self.get_tracked(instance)
+            if old == current:
+                # 外键及聚合字段均未变化，汇总列不变
+                return
+            parent_ids = {parent_id}
+            if old is not None and old[0] != parent_id:
+                parent_ids.add(old[0])
+        instance.__dict__[self.old_attr] = self.get_tracked(instance)
+        # 父对象被级联删除时UPDATE不影响任何行
+        self.update(parent_ids)
+
+    def parent_saved(self, sender=None, instance=None, raw=False, *args, **kwargs):
+        # 父对象整行save时可能用内存中的旧值覆盖汇总列，保存后重新统计
+        if not raw:
+            self.update([instance.pk])
+
+    def connect(self):
+        uid = 'rollup_%s_%s' % (self.parent._meta.label_lower, self.child._meta.label_lower)
+        post_init.connect(self.remember_loaded, sender=self.child, weak=False, dispatch_uid=uid)
+        pre_save.connect(self.remember_parent, sender=self.child, weak=False, dispatch_uid=uid)
+        post_save.connect(self.child_changed, sender=self.child, weak=False, dispatch_uid=uid)
+        post_delete.connect(self.child_changed, sender=self.child, weak=False, dispatch_uid=uid)
+        post_save.connect(self.parent_saved, sender=self.parent, weak=False, dispatch_uid=uid)
+        self.registry.append(self)
+        return self
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import html
+import itertools
+import math
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_delete, post_save
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+from rest_framework import filters
+
+from .utils import order_by_pks
+
+# 英文数字按单词切分，中日韩文字按二元组(bigram)切分
+TOKEN_RE = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+ASCII_RE = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    """去除html标签后切词，UEditorField等富文本字段同样适用"""
+    if not text:
+        return []
+    text = html.unescape(strip_tags(str(text))).lower()
+    tokens = []
+    for word in TOKEN_RE.findall(text):
+        if ASCII_RE.fullmatch(word) or len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class SearchIndex:
+    """
+    搜索索引定义
+    :param name: 索引名，视图通过search_index引用
+    :param model: 索引的模型
+    :param fields: {字段名: 权重}
+    :param popularity_fields: 热度字段，与相关度混合排序
+    """
+
+    def __init__(self, name, model, fields, popularity_fields=()):
+        self.name = name
+        self.model = model
+        self.fields = fields
+        self.popularity_fields = popularity_fields
+
+    def get_terms(self, instance):
+        """返回{词: 加权词频}及加权文档长度"""
+        terms = {}
+        for field, weight in self.fields.items():
+            for token in tokenize(getattr(instance, field, '')):
+                terms[token] = terms.get(token, 0) + weight
+        return terms, sum(terms.values())
+
+    def get_popularity(self, instance):
+        return sum(getattr(instance, field, 0) or 0 for field in self.popularity_fields)
+
+    def get_queryset(self):
+        return self.model._default_manager.order_by('pk')
+
+
+class RedisSearchBackend:
+    """
+    倒排索引保存在redis中，各worker共享，查询时在进程内计算BM25：
+    search:<index>:t:<term>     hash 文档id -> 加权词频
+    search:<index>:terms:<id>   set  文档包含的词，删除或重建文档时使用
+    search:<index>:len          hash 文档id -> 加权文档长度
+    search:<index>:stats        hash docs -> 文档数，total_len -> 加权文档长度之和，写入文档长度时同步维护
+    search:<index>:pop          hash 文档id -> 热度
+    重建索引时写入search:<index>~rebuild:*，完成后逐个RENAME为正式key，重建期间查询不受影响
+    """
+    k1 = 1.2
+    b = 0.75
+    # 写入文档长度并维护文档数与总长度
+    set_len_script = """
+    local old = redis.call('hget', KEYS[1], ARGV[1])
+    redis.call('hset', KEYS[1], ARGV[1], ARGV[2])
+    if not old then
+        redis.call('hincrby', KEYS[2], 'docs', 1)
+        old = 0
+    end
+    redis.call('hincrby', KEYS[2], 'total_len', tonumber(ARGV[2]) - tonumber(old))
+    """
+    del_len_script = """
+    local old = redis.call('hget', KEYS[1], ARGV[1])
+    if old then
+        redis.call('hdel', KEYS[1], ARGV[1])
+        redis.call('hincrby', KEYS[2], 'docs', -1)
+        redis.call('hincrby', KEYS[2], 'total_len', -tonumber(old))
+    end
+    """
+
+    def __init__(self, alias='default', popularity_weight=0.1, max_results=1000, max_candidates=10000, **options):
+        self.alias = alias
+        self.popularity_weight = popularity_weight
+        self.max_results = max_results
+        # 最短倒排表最多读取的候选文档数，高频词查询时限制单次读取量
+        self.max_candidates = max_candidates
+
+    @property
+    def conn(self):
+        return get_redis_connection(self.alias)
+
+    @staticmethod
+    def key(index, *parts):
+        return ':'.join(('search', index.name) + tuple(str(part) for part in parts))
+
+    def update(self, index, instance):
+        terms, length = index.get_terms(instance)
+        old_terms = self.conn.smembers(self.key(index, 'terms', instance.pk))
+        pipe = self.conn.pipeline()
+        self._remove(pipe, index, instance.pk, old_terms)
+        for term, tf in terms.items():
+            pipe.hset(self.key(index, 't', term), instance.pk, tf)
+        if terms:
+            pipe.sadd(self.key(index, 'terms', instance.pk), *terms)
+        self._set_len(pipe, index, instance.pk, length)
+        pipe.hset(self.key(index, 'pop'), instance.pk, index.get_popularity(instance))
+        pipe.execute()
+
+    def bulk_update(self, index, instances):
+        """重建索引使用，写入begin_rebuild返回的空索引，不再逐个清理旧词"""
+        pipe = self.conn.pipeline(transaction=False)
+        for instance in instances:
+            terms, length = index.get_terms(instance)
+            for term, tf in terms.items():
+                pipe.hset(self.key(index, 't', term), instance.pk, tf)
+            if terms:
+                pipe.sadd(self.key(index, 'terms', instance.pk), *terms)
+            self._set_len(pipe, index, instance.pk, length)
+            pipe.hset(self.key(index, 'pop'), instance.pk, index.get_popularity(instance))
+        pipe.execute()
+
+    def rebuild_stats(self, index):
+        """由文档长度hash统计文档数与总长度，stats缺失(升级前建立的索引)时执行一次"""
+        lengths = self.conn.hvals(self.key(index, 'len'))
+        if not lengths:
+            return 0, 0
+        stats = {'docs': len(lengths), 'total_len': sum(int(length) for length in lengths)}
+        self.conn.hset(self.key(index, 'stats'), mapping=stats)
+        return stats['docs'], stats['total_len']
+
+    def update_popularity(self, index, pks):
+        """只重新写入热度，计数列通过QuerySet.update()变更时使用"""
+        rows = index.get_queryset().filter(pk__in=pks).values_list('pk', *index.popularity_fields)
+        mapping = {row[0]: sum(value or 0 for value in row[1:]) for row in rows}
+        if mapping:
+            self.conn.hset(self.key(index, 'pop'), mapping=mapping)
+
+    def remove(self, index, pk):
+        old_terms = self.conn.smembers(self.key(index, 'terms', pk))
+        pipe = self.conn.pipeline()
+        self._remove(pipe, index, pk, old_terms)
+        pipe.eval(self.del_len_script, 2, self.key(index, 'len'), self.key(index, 'stats'), pk)
+        pipe.hdel(self.key(index, 'pop'), pk)
+        pipe.execute()
+
+    def _set_len(self, pipe, index, pk, length):
+        pipe.eval(self.set_len_script, 2, self.key(index, 'len'), self.key(index, 'stats'), pk, length)
+
+    def _remove(self, pipe, index, pk, old_terms):
+        for term in old_terms:
+            pipe.hdel(self.key(index, 't', term.decode() if isinstance(term, bytes) else term), pk)
+        pipe.delete(self.key(index, 'terms', pk))
+
+    def clear(self, index):
+        keys = list(self.conn.scan_iter(match=self.key(index, '*'), count=1000))
+        for i in range(0, len(keys), 1000):
+            self.conn.delete(*keys[i:i + 1000])
+
+    def begin_rebuild(self, index):
+        """返回写入临时key的索引，清理上次中断的重建"""
+        target = SearchIndex('%s~rebuild' % index.name, index.model, index.fields, index.popularity_fields)
+        self.clear(target)
+        return target
+
+    def finish_rebuild(self, index, target):
+        """临时key逐个RENAME为正式key，再删除新索引中不存在的旧词、旧文档key"""
+        live_prefix, tmp_prefix = self.key(index, ''), self.key(target, '')
+        renamed = set()
+        pipe = self.conn.pipeline(transaction=False)
+        for key in self.conn.scan_iter(match=tmp_prefix + '*', count=1000):
+            key = key.decode() if isinstance(key, bytes) else key
+            renamed.add(live_prefix + key[len(tmp_prefix):])
+            pipe.rename(key, live_prefix + key[len(tmp_prefix):])
+            if len(pipe) >= 1000:
+                pipe.execute()
+        pipe.execute()
+
+        stale = [key for key in self.conn.scan_iter(match=live_prefix + '*', count=1000)
+                 if (key.decode() if isinstance(key, bytes) else key) not in renamed]
+        for i in range(0, len(stale), 1000):
+            self.conn.delete(*stale[i:i + 1000])
+
+    def search(self, index, query):
+        """
+        返回按得分倒序的文档id列表，所有查询词都需命中；
+        只HSCAN最短倒排表的前max_candidates个文档，其余词按候选文档HMGET，文档数与平均长度取自stats，
+        不随索引规模增长
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        pipe = self.conn.pipeline(transaction=False)
+        for term in terms:
+            pipe.hlen(self.key(index, 't', term))
+        pipe.hmget(self.key(index, 'stats'), ['docs', 'total_len'])
+        *doc_freqs, (doc_nums, total_len) = pipe.execute()
+        if doc_nums is None:
+            doc_nums, total_len = self.rebuild_stats(index)
+        doc_nums = int(doc_nums or 0)
+        if not doc_nums or not all(doc_freqs):
+            return []
+        avg_len = float(total_len or 0) / doc_nums or 1
+
+        rarest = min(range(len(terms)), key=doc_freqs.__getitem__)
+        candidates = list(itertools.islice(
+            self.conn.hscan_iter(self.key(index, 't', terms[rarest]), count=1000), self.max_candidates))
+        pipe = self.conn.pipeline(transaction=False)
+        docs = [doc for doc, _ in candidates]
+        for i, term in enumerate(terms):
+            if i != rarest:
+                pipe.hmget(self.key(index, 't', term), docs)
+        pipe.hmget(self.key(index, 'len'), docs)
+        pipe.hmget(self.key(index, 'pop'), docs)
+        *tfs, doc_lengths, popularity = pipe.execute()
+        tfs.insert(rarest, [tf for _, tf in candidates])
+
+        idfs = [math.log(1 + (doc_nums - df + 0.5) / (df + 0.5)) for df in doc_freqs]
+        scores = {}
+        for j, doc in enumerate(docs):
+            doc_tfs = [term_tfs[j] for term_tfs in tfs]
+            if None in doc_tfs:
+                continue
+            doc_len = float(doc_lengths[j] or 0)
+            score = 0
+            for idf, tf in zip(idfs, doc_tfs):
+                tf = float(tf)
+                score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len / avg_len))
+            # 相关度与学习人数、收藏数等热度混合
+            scores[int(doc)] = score * (1 + self.popularity_weight * math.log1p(float(popularity[j] or 0)))
+        return sorted(scores, key=scores.get, reverse=True)[:self.max_results]
+
+
+class MySQLFulltextBackend:
+    """
+    MySQL FULLTEXT全文索引，索引由数据库维护，需先执行rebuild_search_index --fulltext创建ngram全文索引；
+    富文本字段中的html标签同样会被索引
+    """
+
+    def __init__(self, popularity_weight=0.1, max_results=1000, **options):
+        self.popularity_weight = popularity_weight
+        self.max_results = max_results
+
+    def update(self, index, instance):
+        pass
+
+    def bulk_update(self, index, instances):
+        pass
+
+    def remove(self, index, pk):
+        pass
+
+    def update_popularity(self, index, pks):
+        pass
+
+    def clear(self, index):
+        pass
+
+    def begin_rebuild(self, index):
+        return index
+
+    def finish_rebuild(self, index, target):
+        pass
+
+    @staticmethod
+    def get_columns(index):
+        return ', '.join('`%s`' % index.model._meta.get_field(field).column for field in index.fields)
+
+    def create_index_sql(self, index):
+        return 'ALTER TABLE `%s` ADD FULLTEXT INDEX `%s_fulltext` (%s) WITH PARSER ngram' % (
+            index.model._meta.db_table, index.name, self.get_columns(index))
+
+    def search(self, index, query):
+        relevance = RawSQL('MATCH (%s) AGAINST (%%s IN NATURAL LANGUAGE MODE)' % self.get_columns(index), (query,))
+        rows = index.model._default_manager.annotate(relevance=relevance).filter(relevance__gt=0) \
+            .order_by('-relevance').values_list('pk', 'relevance', *index.popularity_fields)[:self.max_results]
+        scores = {row[0]: row[1] * (1 + self.popularity_weight * math.log1p(sum(row[2:]))) for row in rows}
+        return sorted(scores, key=scores.get, reverse=True)
+
+
+_indexes = {}
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        config = getattr(settings, 'SEARCH_ENGINE', {})
+        backend_cls = import_string(config.get('BACKEND', 'lib.search.RedisSearchBackend'))
+        _backend = backend_cls(**config.get('OPTIONS', {}))
+    return _backend
+
+
+def get_index(name):
+    return _indexes[name]
+
+
+def get_indexes():
+    return list(_indexes.values())
+
+
+def register(index):
+    """注册索引，模型保存、删除时事务提交后增量更新索引"""
+    _indexes[index.name] = index
+
+    def update(sender=None, instance=None, *args, **kwargs):
+        transaction.on_commit(lambda: get_backend().update(index, instance))
+
+    def remove(sender=None, instance=None, *args, **kwargs):
+        pk = instance.pk
+        transaction.on_commit(lambda: get_backend().remove(index, pk))
+
+    post_save.connect(receiver=update, sender=index.model, weak=False, dispatch_uid='search_%s' % index.name)
+    post_delete.connect(receiver=remove, sender=index.model, weak=False, dispatch_uid='search_rm_%s' % index.name)
+    return index
+
+
+def update_popularity(model, pks, fields=None):
+    """
+    计数列通过QuerySet.update()变更时不触发信号，事务提交后重新写入相关索引的热度
+    :param fields: 变更的字段，不传时视为热度字段均可能变化
+    """
+    pks = [pk for pk in pks if pk is not None]
+    indexes = [index for index in _indexes.values()
+               if index.model._meta.concrete_model is model._meta.concrete_model and index.popularity_fields
+               and (fields is None or set(fields) & set(index.popularity_fields))]
+    if not pks or not indexes:
+        return
+
+    def update():
+        for index in indexes:
+            get_backend().update_popularity(index, pks)
+    transaction.on_commit(update)
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    视图设置search_index时使用全文索引检索，按相关度排序；否则与SearchFilter一致使用LIKE查询
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        index_name = getattr(view, 'search_index', None)
+        query = request.query_params.get(self.search_param, '').strip()
+        if not index_name or not query:
+            return super(FullTextSearchFilter, self).filter_queryset(request, queryset, view)
+
+        pks = get_backend().search(get_index(index_name), query)
+        if not pks:
+            return queryset.none()
+        # 保持相关度顺序，指定ordering参数时由OrderingFilter覆盖
+        return order_by_pks(queryset, pks)
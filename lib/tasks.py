@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+__author__ = 'wuhai'
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from django_redis import get_redis_connection
+
+logger = logging.getLogger()
+
+
+def run_task(func_path, args=(), kwargs=None):
+    """在后台线程或worker进程中执行任务，任务前后清理失效的数据库连接"""
+    close_old_connections()
+    try:
+        return import_string(func_path)(*args, **(kwargs or {}))
+    except Exception:
+        logger.exception("Background task %s failed.", func_path)
+    finally:
+        close_old_connections()
+
+
+class SyncBackend:
+    """同步执行，测试及调试使用，异常直接抛出"""
+
+    def __init__(self, **options):
+        pass
+
+    def submit(self, func_path, *args, **kwargs):
+        return import_string(func_path)(*args, **kwargs)
+
+
+class ThreadPoolBackend:
+    """进程内线程池，uwsgi需开启enable-threads"""
+
+    def __init__(self, max_workers=4, **options):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='task')
+
+    def submit(self, func_path, *args, **kwargs):
+        return self.executor.submit(run_task, func_path, args, kwargs)
+
+
+class RedisQueueBackend:
+    """redis列表作为任务队列，由run_tasks命令启动的worker消费，参数需可json序列化"""
+
+    def __init__(self, queue='tasks', alias='default', **options):
+        self.queue = queue
+        self.alias = alias
+
+    @property
+    def conn(self):
+        return get_redis_connection(self.alias)
+
+    def submit(self, func_path, *args, **kwargs):
+        return self.conn.lpush(self.queue, json.dumps({'func': func_path, 'args': args, 'kwargs': kwargs}))
+
+    def work(self, timeout=5):
+        """阻塞读取一个任务并执行，超时返回False"""
+        item = self.conn.brpop(self.queue, timeout=timeout)
+        if item is None:
+            return False
+        task = json.loads(item[1])
+        run_task(task['func'], task['args'], task['kwargs'])
+        return True
+
+
+_backends = {}
+
+
+def get_backend(func_path=None):
+    """
+    任务使用的后端：BACKGROUND_TASKS['ROUTES']中为该任务指定的后端，否则为默认BACKEND；
+    同一后端类只创建一个实例，共用OPTIONS
+    """
+    config = getattr(settings, 'BACKGROUND_TASKS', {})
+    backend_path = config.get('ROUTES', {}).get(func_path) or config.get('BACKEND', 'lib.tasks.ThreadPoolBackend')
+    if backend_path not in _backends:
+        _backends[backend_path] = import_string(backend_path)(**config.get('OPTIONS', {}))
+    return _backends[backend_path]
+
+
+def get_queue_backend():
+    """默认后端或任一路由后端为RedisQueueBackend时返回该后端，供run_tasks启动worker"""
+    config = getattr(settings, 'BACKGROUND_TASKS', {})
+    for func_path in [None] + list(config.get('ROUTES', {})):
+        backend = get_backend(func_path)
+        if isinstance(backend, RedisQueueBackend):
+            return backend
+    return None
+
+
+def submit_task(func_path, *args, **kwargs):
+    """
+    提交后台任务，在当前事务提交后才真正提交，保证任务能读到本次写入的数据
+    :param func_path: 任务函数路径，如'notifications.tasks.fanout_notifications'
+    """
+    transaction.on_commit(lambda: get_backend(func_path).submit(func_path, *args, **kwargs))
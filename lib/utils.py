@@ -1,6 +1,20 @@
 #!/usr/bin/env python
+import base64
+import binascii
+import json
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db.models import Case, F, IntegerField, Q, When
+from django.http import StreamingHttpResponse
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response as OrgResponse
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from .exceptions import ValidationError
+from .keyconstructors import bump_object_tags
+from .response import Response
 
 
 def get_object(model, object_id=None, *args, **kwargs):
@@ -17,6 +31,31 @@ def get_object(model, object_id=None, *args, **kwargs):
         raise ValidationError("Matching query does not exist.")
 
 
+def order_by_pks(queryset, pks):
+    """按pks给定的顺序返回queryset中对应的记录，如搜索相关度、相关课程排序"""
+    rank = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(pks)], output_field=IntegerField())
+    return queryset.filter(pk__in=pks).annotate(pk_rank=rank).order_by('pk_rank')
+
+
+def modify_counter(instance, field, incr=True):
+    """
+    原子更新计数字段，只UPDATE该列，避免并发读改写丢失更新；减少时不小于0
+    """
+    queryset = instance.__class__._default_manager.filter(pk=instance.pk)
+    if incr:
+        queryset.update(**{field: F(field) + 1})
+        setattr(instance, field, getattr(instance, field) + 1)
+    else:
+        queryset.filter(**{field + '__gt': 0}).update(**{field: F(field) - 1})
+        setattr(instance, field, max(getattr(instance, field) - 1, 0))
+    # update不触发信号，手动使该对象的详情缓存失效；只改计数列，不使列表缓存失效
+    bump_object_tags(instance.__class__, [instance.pk])
+    # 同时刷新搜索索引中的热度，lib.search依赖本模块，在函数内导入
+    from .search import update_popularity
+    update_popularity(instance.__class__, [instance.pk], fields=[field])
+    return getattr(instance, field)
+
+
 class BasePagination(PageNumberPagination):
     """
     Base pagination setting
@@ -25,3 +64,186 @@ class BasePagination(PageNumberPagination):
     page_size_query_param = 'page_size'
     page_query_param = "page"
     # max_page_size = 100
+    # 请求带cursor参数(首页传空值)时使用keyset分页：按cursor_ordering字段定位，不执行COUNT，
+    # 任意页与首页代价相同；视图可通过cursor_ordering属性指定有索引的排序字段，最后一个字段需唯一；
+    # keyset分页固定按cursor_ordering排序，不能与ordering参数、全文检索的相关度排序同时使用
+    cursor_query_param = 'cursor'
+    cursor_ordering = ('-created_time', '-pk')
+    use_cursor = False
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.use_cursor = self.cursor_query_param in request.query_params
+        if not self.use_cursor:
+            return super(BasePagination, self).paginate_queryset(queryset, request, view)
+        conflicts = self.get_ordering_params(request, view)
+        if conflicts:
+            raise ValidationError("%s cannot be used together with %s." % (
+                self.cursor_query_param, ', '.join(conflicts)))
+
+        self.request = request
+        self.ordering = tuple(getattr(view, 'cursor_ordering', self.cursor_ordering))
+        page_size = self.get_page_size(request)
+        values, reverse = self.decode_cursor(request, queryset.model)
+
+        # 向前翻页时反转排序方向查询，再把结果倒回来
+        ordering = [self.reverse_field(field) for field in self.ordering] if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.keyset_filter(ordering, values))
+        results = list(queryset[:page_size + 1])
+        has_more = len(results) > page_size
+        results = results[:page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = bool(results) and (has_more if not reverse else True)
+        self.has_previous = bool(results) and (values is not None if not reverse else has_more)
+        self.page_results = results
+        return results
+
+    @staticmethod
+    def get_ordering_params(request, view):
+        """请求中会改变列表排序的参数：ordering，及视图使用全文索引时的search"""
+        params = [api_settings.ORDERING_PARAM]
+        if getattr(view, 'search_index', None):
+            params.append(api_settings.SEARCH_PARAM)
+        return [param for param in params if request.query_params.get(param, '').strip()]
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super(BasePagination, self).get_paginated_response(data)
+        return OrgResponse(OrderedDict([
+            ('next', self.get_cursor_link(self.page_results[-1], False) if self.has_next else None),
+            ('previous', self.get_cursor_link(self.page_results[0], True) if self.has_previous else None),
+            ('results', data)
+        ]))
+
+    @staticmethod
+    def reverse_field(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def keyset_filter(ordering, values):
+        """(a, b) > (x, y)展开为 a > x OR (a = x AND b > y)，可以使用(a, b)联合索引"""
+        condition = Q()
+        for i, field in enumerate(ordering):
+            name = field.lstrip('-')
+            q = Q(**{'%s__%s' % (name, 'lt' if field.startswith('-') else 'gt'): values[i]})
+            for prev_field, prev_value in zip(ordering[:i], values[:i]):
+                q &= Q(**{prev_field.lstrip('-'): prev_value})
+            condition |= q
+        return condition
+
+    def decode_cursor(self, request, model):
+        """游标为base64编码的json：{'v': 排序字段值, 'r': 是否向前翻页}"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            values, reverse = cursor['v'], bool(cursor['r'])
+            if not isinstance(values, list) or len(values) != len(self.ordering):
+                raise ValueError
+            fields = [model._meta.pk if name == 'pk' else model._meta.get_field(name)
+                      for name in (field.lstrip('-') for field in self.ordering)]
+            values = [field.to_python(value) for field, value in zip(fields, values)]
+        except (TypeError, ValueError, KeyError, binascii.Error, DjangoValidationError):
+            raise ValidationError("Invalid cursor.")
+        return values, reverse
+
+    def get_cursor_link(self, obj, reverse):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        cursor = json.dumps({'v': values, 'r': int(reverse)}, default=str, separators=(',', ':'))
+        url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+        return replace_query_param(url, self.cursor_query_param,
+                                   base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii'))
+
+
+class ListResponseMixin:
+    """
+    列表视图响应：默认按pagination_class分页；?export=json时以流式json导出全部记录，
+    按排序字段keyset分批查询、分批序列化，每批一条有上限的查询，不在内存中构造完整列表；
+    不使用iterator()，MySQLdb等驱动会在客户端缓存整个结果集
+    """
+    export_query_param = 'export'
+    export_chunk_size = 500
+
+    def list_response(self, queryset, key=None):
+        """
+        :param queryset: 已过滤的列表queryset
+        :param key: 不为空时列表数据放在data[key]中
+        """
+        if self.request.query_params.get(self.export_query_param) == 'json':
+            return self.stream_response(queryset, key)
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            data = self.get_paginated_response(self.get_serializer(page, many=True).data).data
+        else:
+            data = self.get_serializer(queryset, many=True).data
+        return Response({key: data} if key else data)
+
+    def stream_response(self, queryset, key=None):
+        response = StreamingHttpResponse(self.stream_json(queryset, key), content_type='application/json')
+        response['Content-Disposition'] = 'attachment; filename="%s.json"' % queryset.model._meta.model_name
+        return response
+
+    def stream_json(self, queryset, key=None):
+        encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+        # 与lib.response.Response一致的code/msg/data结构
+        yield '{"code":0,"msg":"Success","data":%s[' % ('{%s:' % encoder.encode(key) if key else '')
+        first = True
+        for chunk in self.iter_chunks(queryset):
+            data = self.get_serializer(chunk, many=True).data
+            yield ('' if first else ',') + ','.join(encoder.encode(item) for item in data)
+            first = False
+        yield ']}}' if key else ']}'
+
+    def iter_chunks(self, queryset):
+        """
+        按export_chunk_size分批返回queryset的记录，每批按需prefetch_related；
+        排序字段均为非空的本表字段时按(排序字段, pk)keyset分批，
+        否则(如相关度、关联字段排序)先按原顺序读取主键，再按主键分批查询
+        """
+        size = self.export_chunk_size
+        ordering = self.get_keyset_ordering(queryset)
+        if ordering is not None:
+            queryset = queryset.order_by(*ordering)
+            condition = Q()
+            while True:
+                chunk = list(queryset.filter(condition)[:size])
+                if chunk:
+                    yield chunk
+                if len(chunk) < size:
+                    return
+                values = [getattr(chunk[-1], name.lstrip('-')) for name in ordering]
+                condition = BasePagination.keyset_filter(ordering, values)
+
+        pks = list(queryset.values_list('pk', flat=True))
+        for i in range(0, len(pks), size):
+            batch = pks[i:i + size]
+            objs = {obj.pk: obj for obj in queryset.order_by().filter(pk__in=batch)}
+            yield [objs[pk] for pk in batch if pk in objs]
+
+    @staticmethod
+    def get_keyset_ordering(queryset):
+        """
+        queryset排序字段均为非空的本表字段时，返回以pk结尾、可唯一定位记录的排序；否则返回None
+        """
+        opts = queryset.model._meta
+        names = queryset.query.order_by or (opts.ordering if queryset.query.default_ordering else ())
+        ordering = []
+        for name in names:
+            if not isinstance(name, str) or '__' in name or name == '?':
+                return None
+            desc, name = name.startswith('-'), name.lstrip('-')
+            try:
+                field = opts.pk if name == 'pk' else opts.get_field(name)
+            except FieldDoesNotExist:
+                return None
+            if not field.concrete or field.is_relation or field.null:
+                return None
+            ordering.append(('-' if desc else '') + field.attname)
+            if field.primary_key:
+                return ordering
+        return ordering + ['-pk' if ordering and ordering[-1].startswith('-') else 'pk']